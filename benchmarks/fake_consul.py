@@ -0,0 +1,424 @@
+"""
+In-memory consul stand-in for benchmarks: catalog, health, kv, txn and session endpoints
+with blocking queries. Catalog is changed with operations sent over a pipe, see FakeConsul.apply.
+"""
+import base64
+import datetime
+import json
+import logging
+import multiprocessing
+import threading
+import time
+import uuid
+
+from tornado import gen, ioloop, web
+from tornado.locks import Condition
+
+PASSING = 'passing'
+
+
+def parse_wait(wait):
+    """
+    :type wait: string - consul duration, like 10s or 5m
+    :rtype: float - seconds
+    """
+    if not wait:
+        return 300.0
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    for unit in ('ms', 's', 'm', 'h'):
+        if wait.endswith(unit):
+            return float(wait[:-len(unit)]) * units[unit]
+    return float(wait)
+
+
+class FakeConsul(object):
+    """
+    Consul state. Every change gets its own raft index, blocking queries wake up when index
+    of resource they watch grows: catalog, health state, service health or kv prefix.
+    """
+
+    def __init__(self):
+        self.index = 1
+        self.indexes = {}
+        # service name -> node -> instance, node -> node health
+        self.catalog = {}
+        self.nodes = {}
+        self.kv = {}
+        self.kv_deleted = {}
+        self.sessions = {}
+        self.changed = Condition()
+
+    def bump(self, *resources):
+        self.index += 1
+        for resource in resources:
+            self.indexes[resource] = self.index
+        self.changed.notify_all()
+
+    def get_index(self, resource):
+        return self.indexes.get(resource, 1)
+
+    # catalog
+
+    def register(self, service, node, address, port, tags, status=PASSING):
+        self.nodes.setdefault(node, {'address': address, 'status': PASSING})
+        # instance id changes with new container, like registrator does
+        instance = {'id': '%s:%s' % (service, port), 'port': port, 'tags': list(tags), 'status': status}
+        self.catalog.setdefault(service, {})[node] = instance
+        self.bump('catalog', 'health', 'service:%s' % service)
+
+    def deregister(self, service, node):
+        instances = self.catalog.get(service, {})
+        if instances.pop(node, None) is None:
+            return
+        if not instances:
+            del self.catalog[service]
+        self.bump('catalog', 'health', 'service:%s' % service)
+
+    def set_status(self, service, node, status):
+        self.catalog[service][node]['status'] = status
+        self.bump('health', 'service:%s' % service)
+
+    def set_node_status(self, node, status):
+        """
+        Node level check (serfHealth), affects all services of node
+        """
+        self.nodes[node]['status'] = status
+        self.bump('health', *['service:%s' % service for service, instances in self.catalog.items()
+                              if node in instances])
+
+    def set_tags(self, service, tags):
+        for instance in self.catalog.get(service, {}).values():
+            instance['tags'] = list(tags)
+        self.bump('catalog', 'service:%s' % service)
+
+    def apply(self, operations):
+        """
+        :type operations: list - (method name, args) tuples
+        """
+        for method, args in operations:
+            getattr(self, method)(*args)
+
+    def get_services(self):
+        return dict((service, sorted(set(tag for instance in instances.values() for tag in instance['tags'])))
+                    for service, instances in self.catalog.items())
+
+    def get_checks(self):
+        checks = [self.format_check(node, node_health['status'])
+                  for node, node_health in sorted(self.nodes.items())]
+        for service, instances in sorted(self.catalog.items()):
+            for node, instance in sorted(instances.items()):
+                checks.append(self.format_check(node, instance['status'], service, instance['id']))
+        return checks
+
+    def get_health(self, service, passing=False):
+        entries = []
+        for node, instance in sorted(self.catalog.get(service, {}).items()):
+            node_health = self.nodes[node]
+            if passing and (instance['status'] != PASSING or node_health['status'] != PASSING):
+                continue
+            entries.append({
+                'Node': {'Node': node, 'Address': node_health['address']},
+                'Service': {'ID': instance['id'], 'Service': service, 'Tags': instance['tags'], 'Address': '',
+                            'Port': instance['port']},
+                'Checks': [self.format_check(node, node_health['status']),
+                           self.format_check(node, instance['status'], service, instance['id'])],
+            })
+        return entries
+
+    @classmethod
+    def format_check(cls, node, status, service='', service_id=''):
+        """
+        Node level serfHealth check without service, service check otherwise
+        """
+        check_id = 'service:%s' % service_id if service_id else 'serfHealth'
+        return {'Node': node, 'CheckID': check_id, 'Name': check_id, 'Status': status, 'ServiceID': service_id,
+                'ServiceName': service, 'Notes': '', 'Output': ''}
+
+    # kv
+
+    def get_kv_index(self, prefix, recurse):
+        indexes = [item['ModifyIndex'] for key, item in self.kv.items()
+                   if key == prefix or (recurse and key.startswith(prefix))]
+        indexes += [index for key, index in self.kv_deleted.items()
+                    if key == prefix or (recurse and key.startswith(prefix))]
+        return max(indexes) if indexes else self.get_index('kv')
+
+    def get_kv(self, prefix, recurse):
+        if recurse:
+            return [self.kv[key] for key in sorted(self.kv) if key.startswith(prefix)]
+        return [self.kv[prefix]] if prefix in self.kv else []
+
+    def put_kv(self, key, value, cas=None, acquire=None, release=None, flags=0):
+        item = self.kv.get(key)
+        if cas is not None and (item['ModifyIndex'] if item else 0) != cas:
+            return False
+
+        session = item['Session'] if item else None
+        lock_index = item['LockIndex'] if item else 0
+        if acquire:
+            if acquire not in self.sessions or (session and session != acquire):
+                return False
+            if session != acquire:
+                lock_index += 1
+            session = acquire
+            self.sessions[acquire]['keys'].add(key)
+        if release:
+            if session != release:
+                return False
+            session = None
+
+        self.bump('kv')
+        self.kv[key] = {'Key': key, 'Value': value, 'Flags': flags, 'Session': session, 'LockIndex': lock_index,
+                        'CreateIndex': item['CreateIndex'] if item else self.index, 'ModifyIndex': self.index}
+        self.kv_deleted.pop(key, None)
+        return True
+
+    def delete_kv(self, key, recurse=False, cas=None):
+        item = self.kv.get(key)
+        if cas is not None and (not item or item['ModifyIndex'] != cas):
+            return False
+
+        keys = [k for k in self.kv if k.startswith(key)] if recurse else [key] if item else []
+        if keys:
+            self.bump('kv')
+            for k in keys:
+                del self.kv[k]
+                self.kv_deleted[k] = self.index
+        return True
+
+    def txn(self, operations):
+        """
+        :return: list of errors, operations are applied only when empty
+        """
+        pending = {}
+
+        def lookup(key):
+            return pending[key] if key in pending else self.kv.get(key)
+
+        errors = []
+        for i, operation in enumerate(op['KV'] for op in operations):
+            verb, key = operation['Verb'], operation['Key']
+            item = lookup(key)
+            if verb in ('cas', 'delete-cas') and (item['ModifyIndex'] if item else 0) != operation['Index']:
+                errors.append({'OpIndex': i, 'What': 'failed to %s key %s, index is stale' % (verb, key)})
+            elif verb == 'check-session' and (not item or item['Session'] != operation['Session']):
+                errors.append({'OpIndex': i, 'What': 'failed session check for key %s' % key})
+            elif verb in ('set', 'cas'):
+                item = item or {'Flags': 0, 'Session': None, 'LockIndex': 0, 'CreateIndex': None, 'ModifyIndex': 0}
+                pending[key] = dict(item, Key=key, Value=base64.b64decode(operation['Value']))
+            elif verb in ('delete', 'delete-cas'):
+                pending[key] = None
+
+        if errors or not pending:
+            return errors
+
+        self.bump('kv')
+        for key, item in pending.items():
+            if item is None:
+                if self.kv.pop(key, None) is not None:
+                    self.kv_deleted[key] = self.index
+                continue
+            item['ModifyIndex'] = self.index
+            item['CreateIndex'] = item['CreateIndex'] or self.index
+            self.kv[key] = item
+            self.kv_deleted.pop(key, None)
+        return errors
+
+    # sessions
+
+    def create_session(self, behavior='release'):
+        session_id = str(uuid.uuid4())
+        self.sessions[session_id] = {'ID': session_id, 'Behavior': behavior, 'keys': set()}
+        return session_id
+
+    def destroy_session(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if not session:
+            return
+        for key in session['keys']:
+            item = self.kv.get(key)
+            if item and item['Session'] == session_id:
+                if session['Behavior'] == 'delete':
+                    self.delete_kv(key)
+                else:
+                    self.bump('kv')
+                    item.update(Session=None, ModifyIndex=self.index)
+
+
+class Handler(web.RequestHandler):
+    def initialize(self, consul):
+        self.consul = consul
+
+    @gen.coroutine
+    def block(self, get_index):
+        """
+        Wait until resource index is greater than requested one or wait time passes
+        :rtype: int - resource index
+        """
+        index = int(self.get_argument('index', 0))
+        deadline = time.time() + parse_wait(self.get_argument('wait', None))
+        while index and get_index() <= index and time.time() < deadline:
+            yield self.consul.changed.wait(timeout=datetime.timedelta(seconds=deadline - time.time()))
+        raise gen.Return(get_index())
+
+    def respond(self, index, data, status=200):
+        self.set_status(status)
+        self.set_header('X-Consul-Index', str(index))
+        self.set_header('X-Consul-Knownleader', 'true')
+        self.set_header('X-Consul-Lastcontact', '0')
+        self.set_header('Content-Type', 'application/json')
+        if data is not None:
+            self.write(json.dumps(data))
+
+
+class CatalogServicesHandler(Handler):
+    @gen.coroutine
+    def get(self):
+        index = yield self.block(lambda: self.consul.get_index('catalog'))
+        self.respond(index, self.consul.get_services())
+
+
+class HealthServiceHandler(Handler):
+    @gen.coroutine
+    def get(self, service):
+        index = yield self.block(lambda: self.consul.get_index('service:%s' % service))
+        passing = self.get_argument('passing', None) is not None
+        self.respond(index, self.consul.get_health(service, passing))
+
+
+class HealthStateHandler(Handler):
+    @gen.coroutine
+    def get(self, state):
+        index = yield self.block(lambda: self.consul.get_index('health'))
+        checks = self.consul.get_checks()
+        if state != 'any':
+            checks = [check for check in checks if check['Status'] == state]
+        self.respond(index, checks)
+
+
+class KVHandler(Handler):
+    @gen.coroutine
+    def get(self, key):
+        recurse = self.get_argument('recurse', None) is not None
+        index = yield self.block(lambda: self.consul.get_kv_index(key, recurse))
+        items = self.consul.get_kv(key, recurse)
+        if not items:
+            self.respond(index, None, 404)
+            return
+        self.respond(index, [dict(item, Value=base64.b64encode(item['Value']) if item['Value'] is not None else None)
+                             for item in items])
+
+    def put(self, key):
+        cas = self.get_argument('cas', None)
+        result = self.consul.put_kv(key, self.request.body, cas=int(cas) if cas is not None else None,
+                                    acquire=self.get_argument('acquire', None),
+                                    release=self.get_argument('release', None),
+                                    flags=int(self.get_argument('flags', 0)))
+        self.respond(self.consul.index, result)
+
+    def delete(self, key):
+        cas = self.get_argument('cas', None)
+        result = self.consul.delete_kv(key, recurse=self.get_argument('recurse', None) is not None,
+                                       cas=int(cas) if cas is not None else None)
+        self.respond(self.consul.index, result)
+
+
+class TxnHandler(Handler):
+    def put(self):
+        errors = self.consul.txn(json.loads(self.request.body))
+        if errors:
+            self.respond(self.consul.index, {'Results': None, 'Errors': errors}, 409)
+        else:
+            self.respond(self.consul.index, {'Results': [], 'Errors': None})
+
+
+class SessionCreateHandler(Handler):
+    def put(self):
+        options = json.loads(self.request.body) if self.request.body else {}
+        self.respond(self.consul.index, {'ID': self.consul.create_session(options.get('behavior', 'release'))})
+
+
+class SessionDestroyHandler(Handler):
+    def put(self, session_id):
+        self.consul.destroy_session(session_id)
+        self.respond(self.consul.index, True)
+
+
+class SessionRenewHandler(Handler):
+    def put(self, session_id):
+        session = self.consul.sessions.get(session_id)
+        if not session:
+            self.respond(self.consul.index, None, 404)
+            return
+        self.respond(self.consul.index, [{'ID': session_id, 'Behavior': session['Behavior']}])
+
+
+def make_app(consul):
+    options = {'consul': consul}
+    return web.Application([
+        (r'/v1/catalog/services', CatalogServicesHandler, options),
+        (r'/v1/health/service/(.+)', HealthServiceHandler, options),
+        (r'/v1/health/state/(.+)', HealthStateHandler, options),
+        (r'/v1/kv/(.*)', KVHandler, options),
+        (r'/v1/txn', TxnHandler, options),
+        (r'/v1/session/create', SessionCreateHandler, options),
+        (r'/v1/session/destroy/(.+)', SessionDestroyHandler, options),
+        (r'/v1/session/renew/(.+)', SessionRenewHandler, options),
+    ])
+
+
+def serve(port, connection):
+    """
+    Run consul stand-in until None is received, catalog operations are read from connection
+    """
+    logging.getLogger('tornado.access').setLevel(logging.ERROR)
+    io_loop = ioloop.IOLoop()
+    io_loop.make_current()
+    consul = FakeConsul()
+    make_app(consul).listen(port, '127.0.0.1')
+
+    def read_operations():
+        while True:
+            try:
+                operations = connection.recv()
+            except EOFError:
+                break
+            if operations is None:
+                break
+            io_loop.add_callback(consul.apply, operations)
+        io_loop.add_callback(io_loop.stop)
+
+    reader = threading.Thread(target=read_operations)
+    reader.daemon = True
+    reader.start()
+    connection.send('ready')
+    io_loop.start()
+
+
+class FakeConsulProcess(object):
+    """
+    Consul stand-in in a child process, so its cpu time is not accounted to vergilius
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve, args=(port, child_connection))
+        self.process.daemon = True
+
+    def start(self):
+        self.process.start()
+        self.connection.recv()
+
+    def apply(self, operations):
+        """
+        :type operations: list - (FakeConsul method name, args) tuples, applied in order
+        """
+        self.connection.send(operations)
+
+    def stop(self):
+        self.connection.send(None)
+        self.connection.close()
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
@@ -0,0 +1,238 @@
+"""
+Leak benchmark: registers services in consul stand-in batch by batch, waits until vergilius writes their configs,
+deregisters them and waits until they are removed. Reports memory, live service objects, open file descriptors and
+files left behind after every batch as json, all of them stay flat if removed services are freed.
+
+    PYTHONPATH=src python benchmarks/leak.py --services 10000 --batch 500 --output report.json
+
+nginx is replaced with /bin/true unless --nginx-binary is given, vergilius settings are taken from env.
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from tornado import gen, ioloop
+
+from fake_consul import FakeConsulProcess
+from scale import get_free_port, get_rss_kb
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='vergilius leak benchmark')
+    parser.add_argument('--services', type=int, default=10000, help='number of services created and deleted')
+    parser.add_argument('--batch', type=int, default=500, help='services living at the same time')
+    parser.add_argument('--http2', type=float, default=0.01, help='fraction of services with certificate')
+    parser.add_argument('--timeout', type=float, default=120.0, help='seconds to wait for every batch')
+    parser.add_argument('--nginx-binary', default='/bin/true')
+    parser.add_argument('--output', help='report file, stdout if not set')
+    parser.add_argument('--verbose', action='store_true', help='show vergilius log')
+    return parser.parse_args(argv)
+
+
+def count_objects():
+    """
+    :rtype: dict - live objects of classes that must not outlive their service
+    """
+    from vergilius.components.consul_watch import ConsulWatch
+    from vergilius.models.certificate import Certificate
+    from vergilius.models.service import Service
+
+    gc.collect()
+    counts = {'Service': 0, 'Certificate': 0, 'ConsulWatch': 0}
+    for obj in gc.get_objects():
+        for cls in (Service, Certificate, ConsulWatch):
+            if isinstance(obj, cls):
+                counts[cls.__name__] += 1
+    return counts
+
+
+def count_fds():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+def count_files(path):
+    return sum(len(file_names) for _, _, file_names in os.walk(path))
+
+
+class Benchmark(object):
+    def __init__(self, args, consul):
+        self.args = args
+        self.consul = consul
+        self.service_watcher = None
+        self.batches = []
+
+    @gen.coroutine
+    def run(self):
+        self.start_vergilius()
+        # settle global watches, so the first batch is measured against running vergilius
+        yield gen.sleep(0.5)
+        self.baseline = self.take_sample()
+
+        for start in xrange(0, self.args.services, self.args.batch):
+            names = ['service-%05d' % i for i in xrange(start, min(start + self.args.batch, self.args.services))]
+            started = time.time()
+
+            self.consul.apply([('register', (name, 'node-000', '10.0.0.1', 20000, self.get_tags(i + start)))
+                               for i, name in enumerate(names)])
+            created = yield self.wait(lambda: all(name in self.service_watcher.services and
+                                                  self.service_watcher.services[name].deployed_fingerprint
+                                                  for name in names))
+            created_at = time.time()
+
+            self.consul.apply([('deregister', (name, 'node-000')) for name in names])
+            deleted = yield self.wait(lambda: not any(name in self.service_watcher.services for name in names))
+            # let in-flight queries of removed services return and shutdowns finish
+            yield gen.sleep(0.2)
+
+            sample = self.take_sample()
+            sample.update({
+                'batch': len(self.batches) + 1,
+                'created': created,
+                'deleted': deleted,
+                'create_seconds': created_at - started,
+                'delete_seconds': time.time() - created_at,
+            })
+            self.batches.append(sample)
+            logging.getLogger('benchmark').info('batch %s: rss %s kB, objects %s' % (
+                sample['batch'], sample['rss_kb'], sample['objects']))
+
+    def get_tags(self, i):
+        domain = 'service-%05d.example.com' % i
+        if self.args.http2 and i % max(1, int(round(1 / self.args.http2))) == 0:
+            return ['http2', 'http2:%s' % domain]
+        return ['http', 'http:%s' % domain]
+
+    def start_vergilius(self):
+        import vergilius
+        from vergilius.components import port_allocator
+        from vergilius.loop.certificate_watcher import CertificateWatcher
+        from vergilius.loop.config_validator import ConfigValidator
+        from vergilius.loop.health_watcher import HealthWatcher
+        from vergilius.loop.nginx_reloader import NginxReloader
+        from vergilius.loop.service_watcher import ServiceWatcher
+
+        port_allocator.rebuild()
+        # certificates are signed by gateway identity
+        if self.args.http2:
+            vergilius.Vergilius.init()
+
+        self.service_watcher = ServiceWatcher()
+        futures = [self.service_watcher.watch_services(), NginxReloader.nginx_reload(),
+                   CertificateWatcher.watch_certificates()]
+        if vergilius.config.NGINX_BATCH_VALIDATION:
+            futures.append(ConfigValidator.validate_configs())
+        if vergilius.config.DISCOVERY_MODE == 'health':
+            futures.append(HealthWatcher(self.service_watcher.services).watch_health())
+
+        for future in futures:
+            ioloop.IOLoop.current().add_future(future, lambda f: f.result())
+
+    @gen.coroutine
+    def wait(self, condition):
+        deadline = time.time() + self.args.timeout
+        while time.time() < deadline:
+            if condition():
+                raise gen.Return(True)
+            yield gen.sleep(0.05)
+        raise gen.Return(False)
+
+    def take_sample(self):
+        import vergilius
+        from vergilius.loop.certificate_watcher import CertificateWatcher
+        from vergilius.loop.config_validator import ConfigValidator
+        from vergilius.loop.renewal_scheduler import RenewalScheduler
+
+        return {
+            'rss_kb': get_rss_kb(),
+            'objects': count_objects(),
+            'gc_garbage': len(gc.garbage),
+            'fds': count_fds(),
+            'config_files': count_files(vergilius.config.NGINX_CONFIG_PATH),
+            'registries': {
+                'certificate_watcher': len(CertificateWatcher.certificates),
+                'renewal_scheduler': len(RenewalScheduler.entries),
+                'renewal_heap': len(RenewalScheduler.heap),
+                'validator_pending': len(ConfigValidator.pending),
+                'validator_quarantined': len(ConfigValidator.quarantined),
+            },
+        }
+
+    def get_report(self):
+        import vergilius
+
+        config = vergilius.config
+        # first batch warms up caches and pools, growth is measured after it
+        warm = self.batches[0] if self.batches else self.baseline
+        last = self.batches[-1] if self.batches else self.baseline
+        return {
+            'services': self.args.services,
+            'batch': self.args.batch,
+            'http2': self.args.http2,
+            'settings': {
+                'DISCOVERY_MODE': config.DISCOVERY_MODE,
+                'NGINX_BATCH_VALIDATION': config.NGINX_BATCH_VALIDATION,
+                'UPSTREAM_BACKEND': config.UPSTREAM_BACKEND,
+                'NGINX_CONFIG_SHARDS': config.NGINX_CONFIG_SHARDS,
+                'HOST_ROUTING': config.HOST_ROUTING,
+            },
+            'baseline': self.baseline,
+            'batches': self.batches,
+            'rss_growth_kb': last['rss_kb'] - warm['rss_kb'] if last['rss_kb'] is not None else None,
+            'fds_growth': last['fds'] - warm['fds'] if last['fds'] is not None else None,
+            'leaked': {
+                'objects': dict((name, count - self.baseline['objects'][name])
+                                for name, count in last['objects'].items()),
+                'gc_garbage': last['gc_garbage'],
+                'config_files': last['config_files'] - self.baseline['config_files'],
+            },
+        }
+
+
+def main(argv):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(asctime)s %(message)s')
+    logging.getLogger('benchmark').setLevel(logging.INFO)
+
+    # consul stand-in is forked before io loop and vergilius clients are created
+    port = get_free_port()
+    consul = FakeConsulProcess(port)
+    consul.start()
+
+    work_dir = tempfile.mkdtemp(prefix='vergilius-leak-')
+    os.environ.update({
+        'CONSUL_HOST': '127.0.0.1',
+        'CONSUL_PORT': str(port),
+        'NGINX_BINARY': args.nginx_binary,
+        'NGINX_CONFIG_PATH': os.path.join(work_dir, 'nginx') + '/',
+        'NGINX_CACHE_PATH': os.path.join(work_dir, 'cache') + '/',
+        'DATA_PATH': os.path.join(work_dir, 'data') + '/',
+    })
+    os.environ.setdefault('SECRET', 'benchmark')
+    os.mkdir(os.environ['DATA_PATH'])
+
+    try:
+        benchmark = Benchmark(args, consul)
+        ioloop.IOLoop.current().run_sync(benchmark.run)
+        report = json.dumps(benchmark.get_report(), indent=2, sort_keys=True)
+    finally:
+        consul.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,408 @@
+"""
+Scale benchmark: runs vergilius watchers against consul stand-in with N services x M nodes, applies churn
+scenarios and reports event-to-disk latency, reloads, cpu time and memory as json.
+
+    PYTHONPATH=src python benchmarks/scale.py --services 500 --nodes 5 --scenario rolling-deploy \
+        --scenario mass-failure --output report.json
+
+nginx is replaced with /bin/true unless --nginx-binary is given, vergilius settings are taken from env.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+from tornado import gen, ioloop
+
+from fake_consul import FakeConsulProcess, PASSING
+
+SCENARIOS = ('rolling-deploy', 'mass-failure', 'tag-edit')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='vergilius scale benchmark')
+    parser.add_argument('--services', type=int, default=100, help='number of services')
+    parser.add_argument('--nodes', type=int, default=3, help='number of nodes, every service runs on every node')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='churn scenario, can be repeated')
+    parser.add_argument('--churn', type=float, default=0.1,
+                        help='fraction of services deployed or edited, fraction of nodes failed')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between scenario steps')
+    parser.add_argument('--timeout', type=float, default=120.0, help='seconds to wait for convergence')
+    parser.add_argument('--nginx-binary', default='/bin/true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='report file, stdout if not set')
+    parser.add_argument('--verbose', action='store_true', help='show vergilius log')
+    return parser.parse_args(argv)
+
+
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class Model(object):
+    """
+    Expected catalog state, mirrors operations sent to consul stand-in
+    """
+
+    def __init__(self, services, nodes):
+        self.services = ['service-%04d' % i for i in xrange(services)]
+        self.nodes = ['node-%03d' % i for i in xrange(nodes)]
+        self.addresses = dict((node, '10.0.%d.%d' % (i // 250, i % 250 + 1)) for i, node in enumerate(self.nodes))
+        self.node_status = dict((node, PASSING) for node in self.nodes)
+        self.instances = dict((service, {}) for service in self.services)
+
+    def get_tags(self, service, version=0):
+        domain = '%s.example.com' % service if not version else '%s-v%s.example.com' % (service, version)
+        return ['http', 'http:%s' % domain]
+
+    def register(self, service, node, port, tags):
+        self.instances[service][node] = {'port': port, 'tags': tags}
+        return 'register', (service, node, self.addresses[node], port, tags)
+
+    def replace(self, service, node):
+        """
+        New container of service on node: deregister old instance and register new one on next port
+        """
+        instance = self.instances[service].pop(node)
+        return [('deregister', (service, node)), self.register(service, node, instance['port'] + 1, instance['tags'])]
+
+    def set_node_status(self, node, status):
+        self.node_status[node] = status
+        return 'set_node_status', (node, status)
+
+    def set_tags(self, service, tags):
+        for instance in self.instances[service].values():
+            instance['tags'] = tags
+        return 'set_tags', (service, tags)
+
+    def populate(self):
+        return [self.register(service, node, 20000 + i, self.get_tags(service))
+                for i, service in enumerate(self.services) for node in self.nodes]
+
+    def expected(self, service):
+        """
+        :rtype: tuple - upstream servers and http domains of passing instances
+        """
+        passing = [(node, instance) for node, instance in self.instances[service].items()
+                   if self.node_status[node] == PASSING]
+        return (frozenset('%s:%s' % (self.addresses[node], instance['port']) for node, instance in passing),
+                frozenset(tag[5:] for node, instance in passing for tag in instance['tags'] if tag.startswith('http:')))
+
+
+def rolling_deploy(model, rng, churn):
+    """
+    Chosen services get new containers, one node at a time
+    """
+    services = rng.sample(model.services, int(math.ceil(len(model.services) * churn)))
+    for node in model.nodes:
+        yield services, [operation for service in services for operation in model.replace(service, node)]
+
+
+def mass_failure(model, rng, churn):
+    """
+    Chosen nodes fail with all their services and recover
+    """
+    nodes = rng.sample(model.nodes, int(math.ceil(len(model.nodes) * churn)))
+    yield model.services, [model.set_node_status(node, 'critical') for node in nodes]
+    yield model.services, [model.set_node_status(node, PASSING) for node in nodes]
+
+
+def tag_edit(model, rng, churn):
+    """
+    Chosen services change their domains twice
+    """
+    services = rng.sample(model.services, int(math.ceil(len(model.services) * churn)))
+    for version in (1, 2):
+        yield services, [model.set_tags(service, model.get_tags(service, version)) for service in services]
+
+
+class Recorder(object):
+    """
+    Records state of service configs every time they are written to disk
+    """
+
+    def __init__(self):
+        self.writes = {}
+
+    def install(self, service_class):
+        write_nginx_configs = service_class.write_nginx_configs
+        recorder = self
+
+        def recording_write_nginx_configs(service, nginx_configs, fingerprint, *args, **kwargs):
+            result = write_nginx_configs(service, nginx_configs, fingerprint, *args, **kwargs)
+            # batch validated configs may be stale, only record writes matching current service state
+            if fingerprint == service.get_fingerprint():
+                recorder.writes.setdefault(service.id, []).append((time.time(), recorder.get_service_state(service)))
+            return result
+
+        service_class.write_nginx_configs = recording_write_nginx_configs
+
+    @classmethod
+    def get_service_state(cls, service):
+        return frozenset(service.get_upstream_servers()), frozenset(service.binds['http'])
+
+    def get_state(self, service_id):
+        writes = self.writes.get(service_id)
+        return writes[-1][1] if writes else None
+
+    def get_latencies(self, events):
+        """
+        :type events: list - (time, service id, expected state)
+        :return: latencies of events written to disk and number of events superseded by later events
+                 or reverted before they were written
+        """
+        latencies = []
+        superseded = 0
+        next_event = {}
+        for event_time, service_id, state in reversed(events):
+            until = next_event.get(service_id)
+            next_event[service_id] = event_time
+            writes = self.writes.get(service_id, [])
+            written = [t for t, written_state in writes if event_time <= t and written_state == state]
+            previous = [written_state for t, written_state in writes if t < event_time]
+            if written and (until is None or written[0] < until):
+                latencies.append(written[0] - event_time)
+            elif until is not None or (previous and previous[-1] == state):
+                superseded += 1
+        return sorted(latencies), superseded
+
+
+def summarize(values):
+    if not values:
+        return {'count': 0}
+
+    def percentile(p):
+        return values[min(len(values) - 1, int(math.ceil(p * len(values))) - 1)]
+
+    return {'count': len(values), 'mean': sum(values) / len(values), 'p50': percentile(0.5),
+            'p90': percentile(0.9), 'p99': percentile(0.99), 'max': values[-1]}
+
+
+def get_rss_kb():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() // 1024
+    except IOError:
+        return None
+
+
+def take_snapshot():
+    from vergilius.components.metrics import watch_errors, watch_timeouts, watch_wakeups
+    from vergilius.loop.config_validator import nginx_test_duration
+    from vergilius.loop.nginx_reloader import event_to_reload, reload_duration
+    from vergilius.models.service import render_duration
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    renders = render_duration.values.values()
+
+    return {
+        'time': time.time(),
+        'service_watcher': {
+            'watch_wakeups': dict((key[0], value) for key, value in watch_wakeups.values.items()),
+            'watch_errors': dict((key[0], value) for key, value in watch_errors.values.items()),
+            'watch_timeouts': dict((key[0], value) for key, value in watch_timeouts.values.items()),
+        },
+        'service': {
+            'renders': sum(data['count'] for data in renders),
+            'render_seconds': sum(data['sum'] for data in renders),
+            'nginx_tests': nginx_test_duration.get()['count'],
+            'nginx_test_seconds': nginx_test_duration.get()['sum'],
+        },
+        'nginx_reloader': {
+            'reloads': reload_duration.get()['count'],
+            'reload_seconds': reload_duration.get()['sum'],
+            'event_to_reload_seconds': event_to_reload.get()['sum'],
+        },
+        'cpu': {
+            'user': usage.ru_utime,
+            'system': usage.ru_stime,
+            'children_user': children.ru_utime,
+            'children_system': children.ru_stime,
+        },
+    }
+
+
+def diff_snapshots(before, after):
+    def diff(a, b):
+        if isinstance(b, dict):
+            return dict((key, diff(a.get(key, 0), value)) for key, value in b.items())
+        return b - a
+
+    return diff(before, after)
+
+
+class Benchmark(object):
+    def __init__(self, args, consul):
+        self.args = args
+        self.consul = consul
+        self.model = Model(args.services, args.nodes)
+        self.rng = random.Random(args.seed)
+        self.recorder = Recorder()
+        self.phases = []
+
+    @gen.coroutine
+    def run(self):
+        from vergilius.models.service import Service
+
+        self.recorder.install(Service)
+
+        start = time.time()
+        self.consul.apply(self.model.populate())
+        self.start_vergilius()
+        events = [(start, service, self.model.expected(service)) for service in self.model.services]
+        yield self.finish_phase('startup', events, self.model.services, take_snapshot(), start)
+
+        scenarios = {'rolling-deploy': rolling_deploy, 'mass-failure': mass_failure, 'tag-edit': tag_edit}
+        for name in self.args.scenario or ['rolling-deploy']:
+            before = take_snapshot()
+            start = time.time()
+            events = []
+            affected = set()
+            for i, (services, operations) in enumerate(scenarios[name](self.model, self.rng, self.args.churn)):
+                if i:
+                    yield gen.sleep(self.args.interval)
+                event_time = time.time()
+                self.consul.apply(operations)
+                events.extend((event_time, service, self.model.expected(service)) for service in services)
+                affected.update(services)
+            yield self.finish_phase(name, events, affected, before, start)
+
+    def start_vergilius(self):
+        import vergilius
+        from vergilius.components import port_allocator
+        from vergilius.loop.certificate_watcher import CertificateWatcher
+        from vergilius.loop.config_validator import ConfigValidator
+        from vergilius.loop.health_watcher import HealthWatcher
+        from vergilius.loop.nginx_reloader import NginxReloader
+        from vergilius.loop.service_watcher import ServiceWatcher
+
+        # services are http only, identity is needed for certificates only
+        port_allocator.rebuild()
+
+        service_watcher = ServiceWatcher()
+        futures = [service_watcher.watch_services(), NginxReloader.nginx_reload(),
+                   CertificateWatcher.watch_certificates()]
+        if vergilius.config.NGINX_BATCH_VALIDATION:
+            futures.append(ConfigValidator.validate_configs())
+        if vergilius.config.DISCOVERY_MODE == 'health':
+            futures.append(HealthWatcher(service_watcher.services).watch_health())
+
+        for future in futures:
+            ioloop.IOLoop.current().add_future(future, lambda f: f.result())
+
+    @gen.coroutine
+    def wait_converged(self, services):
+        from vergilius.loop.nginx_reloader import NginxReloader
+
+        deadline = time.time() + self.args.timeout
+        while time.time() < deadline:
+            if all(self.recorder.get_state(service) == self.model.expected(service) for service in services):
+                break
+            yield gen.sleep(0.05)
+        else:
+            raise gen.Return(False)
+
+        # let coalesced reload of the last changes finish
+        while NginxReloader.first_change is not None and time.time() < deadline:
+            yield gen.sleep(0.05)
+        yield gen.sleep(0.5)
+        raise gen.Return(True)
+
+    @gen.coroutine
+    def finish_phase(self, name, events, services, before, start):
+        converged = yield self.wait_converged(services)
+        after = take_snapshot()
+        latencies, superseded = self.recorder.get_latencies(events)
+
+        phase = diff_snapshots(before, after)
+        phase.update({
+            'name': name,
+            'converged': converged,
+            'duration': after['time'] - start,
+            'events': len(events),
+            'superseded': superseded,
+            'missed': len(events) - len(latencies) - superseded,
+            'event_to_disk': summarize(latencies),
+            'rss_kb': get_rss_kb(),
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        })
+        del phase['time']
+        self.phases.append(phase)
+        logging.getLogger('benchmark').info('%s: %s events, p50 %s' % (
+            name, len(events), phase['event_to_disk'].get('p50')))
+
+    def get_report(self):
+        import vergilius
+
+        config = vergilius.config
+        return {
+            'services': self.args.services,
+            'nodes': self.args.nodes,
+            'churn': self.args.churn,
+            'interval': self.args.interval,
+            'seed': self.args.seed,
+            'settings': {
+                'DISCOVERY_MODE': config.DISCOVERY_MODE,
+                'NGINX_BATCH_VALIDATION': config.NGINX_BATCH_VALIDATION,
+                'UPSTREAM_BACKEND': config.UPSTREAM_BACKEND,
+                'NGINX_RELOAD_QUIET_PERIOD': config.NGINX_RELOAD_QUIET_PERIOD,
+                'NGINX_RELOAD_MIN_INTERVAL': config.NGINX_RELOAD_MIN_INTERVAL,
+                'NGINX_RELOAD_MAX_DELAY': config.NGINX_RELOAD_MAX_DELAY,
+                'NGINX_BINARY': config.NGINX_BINARY,
+            },
+            'phases': self.phases,
+        }
+
+
+def main(argv):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(asctime)s %(message)s')
+    logging.getLogger('benchmark').setLevel(logging.INFO)
+
+    # consul stand-in is forked before io loop and vergilius clients are created
+    port = get_free_port()
+    consul = FakeConsulProcess(port)
+    consul.start()
+
+    work_dir = tempfile.mkdtemp(prefix='vergilius-benchmark-')
+    os.environ.update({
+        'CONSUL_HOST': '127.0.0.1',
+        'CONSUL_PORT': str(port),
+        'NGINX_BINARY': args.nginx_binary,
+        'NGINX_CONFIG_PATH': os.path.join(work_dir, 'nginx') + '/',
+        'DATA_PATH': os.path.join(work_dir, 'data') + '/',
+    })
+    os.environ.setdefault('SECRET', 'benchmark')
+    os.environ.setdefault('PROXY_PORTS', '10000-%d' % (10000 + args.services * 2))
+    os.mkdir(os.environ['DATA_PATH'])
+
+    try:
+        benchmark = Benchmark(args, consul)
+        ioloop.IOLoop.current().run_sync(benchmark.run)
+        report = json.dumps(benchmark.get_report(), indent=2, sort_keys=True)
+    finally:
+        consul.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
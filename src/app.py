@@ -4,11 +4,17 @@ import signal
 
 import time
 import tornado
+import tornado.web
 
 import vergilius
 from vergilius import logger
+from vergilius.components.metrics_handler import MetricsHandler
+from vergilius.loop.certificate_watcher import CertificateWatcher
+from vergilius.loop.config_validator import ConfigValidator
+from vergilius.loop.health_watcher import HealthWatcher
 from vergilius.loop.nginx_reloader import NginxReloader
 from vergilius.loop.service_watcher import ServiceWatcher
+from vergilius.loop.ticket_key_watcher import TicketKeyWatcher
 
 MAX_WAIT_SECONDS_BEFORE_SHUTDOWN = 10
 
@@ -50,12 +56,27 @@ def main():
 
     vergilius.Vergilius.init()
 
-    consul_handler = ServiceWatcher().watch_services()
+    service_watcher = ServiceWatcher()
+    consul_handler = service_watcher.watch_services()
     nginx_reloader = NginxReloader().nginx_reload()
 
+    admin_app = tornado.web.Application([(r'/metrics', MetricsHandler)])
+    admin_app.listen(vergilius.config.ADMIN_PORT)
+
     io_loop = tornado.ioloop.IOLoop.current()
     io_loop.add_future(consul_handler, handle_future)
     io_loop.add_future(nginx_reloader, handle_future)
+    io_loop.add_future(CertificateWatcher.watch_certificates(), handle_future)
+
+    if vergilius.config.TLS_SESSION_TICKETS:
+        io_loop.add_future(TicketKeyWatcher.watch_ticket_keys(), handle_future)
+
+    if vergilius.config.NGINX_BATCH_VALIDATION:
+        io_loop.add_future(ConfigValidator.validate_configs(), handle_future)
+
+    if vergilius.config.DISCOVERY_MODE == 'health':
+        health_handler = HealthWatcher(service_watcher.services).watch_health()
+        io_loop.add_future(health_handler, handle_future)
 
     io_loop.start()
 
@@ -4,6 +4,8 @@ from setuptools import find_packages
 install_requires = [
     'python-consul',
     'tornado',
+    'futures',
+    'cryptography',
     'setuptools>=1.0',
     'zope.component',
     'zope.interface',
@@ -1,20 +1,48 @@
 import logging
 import os
 
-from consul import Consul
-from consul import tornado as consul_from_tornado
 from tornado import template
 
 import config
 from components.dummy_certificate_provider import DummyCertificateProvider
+from vergilius.components import consul_client, port_allocator
+from vergilius.components.api_upstream_backend import ApiUpstreamBackend
+from vergilius.components.certificate_issuer import CertificateIssuer
+from vergilius.components.config_shards import ConfigShards
+from vergilius.components.crypto_certificate_provider import CryptoCertificateProvider
+from vergilius.components.dynamic_upstream_backend import DynamicUpstreamBackend
+from vergilius.components.host_routing import HostRouting
 from vergilius.models.identity import Identity
 
 logger = logging.getLogger(__name__)
 template_loader = template.Loader(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
 certificate_provider = DummyCertificateProvider()
+if config.CERTIFICATE_PROVIDER == 'crypto':
+    certificate_provider = CryptoCertificateProvider(key_type=config.CERTIFICATE_KEY_TYPE)
+certificate_issuer = CertificateIssuer(certificate_provider, config.CERTIFICATE_ISSUANCE_CONCURRENCY)
 
-consul = Consul(host=config.CONSUL_HOST)
-consul_tornado = consul_from_tornado.Consul(host=config.CONSUL_HOST)
+upstream_backend = None
+if config.UPSTREAM_BACKEND == 'api':
+    upstream_backend = ApiUpstreamBackend(config.UPSTREAM_BACKEND_URL)
+elif config.UPSTREAM_BACKEND == 'dynamic':
+    upstream_backend = DynamicUpstreamBackend(config.UPSTREAM_BACKEND_URL)
+
+config_shards = None
+if config.NGINX_CONFIG_OUTPUT == 'sharded':
+    config_shards = ConfigShards(config.NGINX_CONFIG_PATH, config.NGINX_CONFIG_SHARDS)
+
+host_routing = HostRouting(config.NGINX_CONFIG_PATH, config.HOST_ROUTING)
+
+consul = consul_client.SyncConsul(config.CONSUL_CONSISTENCY, config.CONSUL_MAX_STALE, host=config.CONSUL_HOST,
+                                  port=config.CONSUL_PORT)
+# blocking queries hold connection for up to wait time, one-shot requests should not queue behind them
+consul_tornado = consul_client.Consul('watch', config.CONSUL_WATCH_MAX_CLIENTS, config.CONSUL_WATCH_REQUEST_TIMEOUT,
+                                      config.CONSUL_CONSISTENCY, config.CONSUL_MAX_STALE, host=config.CONSUL_HOST,
+                                      port=config.CONSUL_PORT)
+consul_tornado_requests = consul_client.Consul('request', config.CONSUL_REQUEST_MAX_CLIENTS,
+                                               config.CONSUL_REQUEST_TIMEOUT, config.CONSUL_CONSISTENCY,
+                                               config.CONSUL_MAX_STALE, host=config.CONSUL_HOST,
+                                               port=config.CONSUL_PORT)
 
 
 class Vergilius(object):
@@ -23,3 +51,4 @@ class Vergilius(object):
     @classmethod
     def init(cls):
         cls.identity = Identity()
+        port_allocator.rebuild()
@@ -0,0 +1,33 @@
+import json
+
+import zope.interface
+from tornado import gen, httpclient
+
+from vergilius.components.upstream_backend import IUpstreamBackend
+
+
+class ApiUpstreamBackend(object):
+    """
+    Manages upstreams with nginx plus api, url looks like http://127.0.0.1:8080/api/6
+    """
+    zope.interface.implements(IUpstreamBackend)
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.client = httpclient.AsyncHTTPClient()
+
+    def get_servers_url(self, upstream, stream):
+        return '%s/%s/upstreams/%s/servers' % (self.url, 'stream' if stream else 'http', upstream)
+
+    @gen.coroutine
+    def update_upstream(self, upstream, servers, stream=False):
+        url = self.get_servers_url(upstream, stream)
+        response = yield self.client.fetch(url)
+        deployed = dict((server['server'], server['id']) for server in json.loads(response.body))
+
+        for server in set(servers) - set(deployed):
+            yield self.client.fetch(url, method='POST', body=json.dumps({'server': server}),
+                                    headers={'Content-Type': 'application/json'})
+
+        for server in set(deployed) - set(servers):
+            yield self.client.fetch('%s/%s' % (url, deployed[server]), method='DELETE')
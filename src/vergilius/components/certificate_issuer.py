@@ -0,0 +1,49 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import zope.interface
+from tornado import ioloop
+
+from vergilius.components.certificate_provider import IAsyncCertificateProvider
+
+
+def get_certificate(provider, id, domains):
+    # module level function, bound methods can not be pickled to worker process
+    return provider.get_certificate(id, domains)
+
+
+class CertificateIssuer(object):
+    """
+    Runs synchronous certificate provider in process pool with bounded concurrency,
+    requests for the same domains set share one issuance.
+    """
+    zope.interface.implements(IAsyncCertificateProvider)
+
+    def __init__(self, provider, concurrency):
+        """
+        :type provider: ICertificateProvider
+        :type concurrency: int - max parallel issuances
+        """
+        self.provider = provider
+        self.concurrency = concurrency
+        self.executor = None
+        self.in_flight = {}
+
+    def get_certificate(self, id, domains):
+        return self.provider.get_certificate(id, domains)
+
+    def get_certificate_async(self, id, domains):
+        key = (id, tuple(sorted(domains)))
+        if key not in self.in_flight:
+            if not self.executor:
+                self.executor = ProcessPoolExecutor(max_workers=self.concurrency)
+
+            future = self.in_flight[key] = self.executor.submit(get_certificate, self.provider, id, set(domains))
+            # done callback runs on executor thread, or at once if issuance is already finished
+            io_loop = ioloop.IOLoop.current()
+            future.add_done_callback(lambda f: io_loop.add_callback(self.release, key, f))
+
+        return self.in_flight[key]
+
+    def release(self, key, future):
+        if self.in_flight.get(key) is future:
+            del self.in_flight[key]
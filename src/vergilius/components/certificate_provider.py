@@ -6,6 +6,17 @@ class ICertificateProvider(zope.interface.Interface):
         """
         :param id: string
         :param domains: set
-        :rtype: object with keys private_key, public_key and expires
+        :rtype: object with keys private_key, public_key (paths to pem files) or private_key_pem, public_key_pem
+        and expires
+        """
+        pass
+
+
+class IAsyncCertificateProvider(ICertificateProvider):
+    def get_certificate_async(self, id, domains):
+        """
+        :param id: string
+        :param domains: set
+        :rtype: Future resolving to object like get_certificate result
         """
         pass
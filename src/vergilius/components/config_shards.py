@@ -0,0 +1,151 @@
+import hashlib
+import os
+import re
+import tempfile
+
+import vergilius
+
+SHARD_FILE_PATTERN = re.compile(r'^shards\.(\d+)\.(\w+)\.conf$')
+SERVICE_MARKER = '# service: '
+
+
+class ConfigShards(object):
+    """
+    Combines service configs into shard files, one per shard and config type. Services are spread over shards
+    by hash of service id, so a change rewrites only one shard file, written atomically with rename.
+    Shard files match the same includes as per service files, service ids never contain dots.
+    """
+
+    def __init__(self, path, shards):
+        """
+        :type path: string - nginx config directory
+        :type shards: int - number of shards per config type
+        """
+        self.path = path
+        self.shards = shards
+        # (shard, config type) -> service id -> config
+        self.configs = {}
+        self.loaded = False
+
+    def get_shard(self, service_id):
+        return int(hashlib.sha1(service_id.encode('utf-8')).hexdigest()[:8], 16) % self.shards
+
+    def get_path(self, shard, config_type):
+        return os.path.join(self.path, 'shards.%02d.%s.conf' % (shard, config_type))
+
+    def load(self):
+        """
+        Restore configs from shard files written by previous run, so services that are not loaded yet
+        are not dropped from rewritten shards
+        """
+        self.loaded = True
+        if not os.path.isdir(self.path):
+            return
+
+        for file_name in os.listdir(self.path):
+            match = SHARD_FILE_PATTERN.match(file_name)
+            if not match or int(match.group(1)) >= self.shards:
+                continue
+
+            with open(os.path.join(self.path, file_name), 'r') as shard_file:
+                content = shard_file.read()
+
+            configs = self.configs.setdefault((int(match.group(1)), match.group(2)), {})
+            for block in content.split('\n' + SERVICE_MARKER)[1:]:
+                service_id, _, nginx_config = block.partition('\n')
+                configs[service_id] = nginx_config
+
+    def update(self, service_id, nginx_configs):
+        """
+        :type nginx_configs: dict - configs by config type, types missing from it are removed
+        :return: bool - True if any shard file changed
+        """
+        if not self.loaded:
+            self.load()
+
+        shard = self.get_shard(service_id)
+        config_types = set(nginx_configs.keys()) | set(
+                config_type for (s, config_type), configs in self.configs.items()
+                if s == shard and service_id in configs)
+
+        has_changes = False
+        for config_type in config_types:
+            configs = self.configs.setdefault((shard, config_type), {})
+            if configs.get(service_id) == nginx_configs.get(config_type):
+                continue
+
+            if config_type in nginx_configs:
+                configs[service_id] = nginx_configs[config_type]
+            else:
+                del configs[service_id]
+            self.write(shard, config_type)
+            has_changes = True
+
+        return has_changes
+
+    def remove(self, service_id):
+        return self.update(service_id, {})
+
+    def prune(self, service_ids):
+        """
+        Drop services restored from shard files that are not known anymore, like ones deregistered while
+        gateway was down
+        :type service_ids: set - ids of known services
+        :return: bool - True if any shard file changed
+        """
+        if not self.loaded:
+            self.load()
+
+        has_changes = False
+        for (shard, config_type), configs in self.configs.items():
+            stale = set(configs) - service_ids
+            if not stale:
+                continue
+
+            for service_id in stale:
+                del configs[service_id]
+            self.write(shard, config_type)
+            has_changes = True
+
+        return has_changes
+
+    def render(self, shard, config_type, overrides=None):
+        """
+        :type overrides: dict - configs by config type, by service id, replace current ones
+        :rtype: string - shard file content, empty if shard has no services
+        """
+        if not self.loaded:
+            self.load()
+
+        configs = dict(self.configs.get((shard, config_type), {}))
+        for service_id, nginx_configs in (overrides or {}).items():
+            if self.get_shard(service_id) != shard:
+                continue
+            if config_type in nginx_configs:
+                configs[service_id] = nginx_configs[config_type]
+            else:
+                configs.pop(service_id, None)
+
+        return ''.join('\n%s%s\n%s' % (SERVICE_MARKER, service_id, configs[service_id]) for service_id in
+                       sorted(configs))
+
+    def write(self, shard, config_type):
+        path = self.get_path(shard, config_type)
+        content = self.render(shard, config_type)
+        if not content:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return
+
+        temp_file = tempfile.NamedTemporaryFile(dir=self.path, prefix='.shards', suffix='.tmp', delete=False)
+        try:
+            temp_file.write(content)
+            temp_file.close()
+            os.chmod(temp_file.name, 0o644)
+            os.rename(temp_file.name, path)
+        except Exception:
+            vergilius.logger.error('[config shards]: failed to write %s' % path)
+            os.remove(temp_file.name)
+            raise
@@ -0,0 +1,247 @@
+import functools
+import sys
+
+from consul import std as consul_std, tornado as consul_from_tornado
+from tornado import gen, httpclient, simple_httpclient
+
+import vergilius
+from vergilius.components.metrics import Counter, Gauge
+
+# endpoints served by agent cache with background refresh
+CACHED_PATHS = ('/v1/health/service/', '/v1/catalog/services')
+
+pool_in_flight = Gauge('vergilius_consul_pool_in_flight', 'Consul requests in flight', ('pool',))
+pool_queued = Gauge('vergilius_consul_pool_queued', 'Consul requests waiting for free connection', ('pool',))
+pool_max_clients = Gauge('vergilius_consul_pool_max_clients', 'Consul connection pool size', ('pool',))
+stale_retries = Counter('vergilius_consul_stale_retries_total', 'Stale consul reads repeated through leader', ('pool',))
+
+
+class StaleRead(Exception):
+    pass
+
+
+class ReadConsistency(object):
+    """
+    Sends reads as stale or agent cached ones, so they are served by any server or by local agent instead of leader.
+    Reads older than max stale seconds are repeated in default mode, reads asking for consistent mode are left as is.
+    """
+    pool = None
+    # default, stale or cached (stale for endpoints agent does not cache)
+    read_mode = 'default'
+    max_stale = None
+
+    def get_read_params(self, path, params):
+        """
+        :rtype: dict - query params, None if read is sent as is
+        """
+        params = dict(params or {})
+        if self.read_mode not in ('stale', 'cached') or 'consistent' in params:
+            return None
+
+        params['stale'] = '1'
+        if self.read_mode == 'cached' and path.startswith(CACHED_PATHS):
+            params['cached'] = '1'
+        return params
+
+    def check_staleness(self, callback):
+        """
+        :return: callback raising StaleRead for response older than max stale or served without known leader
+        """
+        def checked(response):
+            headers = response.headers
+            last_contact = int(headers.get('X-Consul-LastContact') or 0) / 1000.0
+            age = int(headers.get('Age') or 0)
+            if headers.get('X-Consul-KnownLeader') == 'false' or max(last_contact, age) > self.max_stale:
+                raise StaleRead()
+            return callback(response)
+
+        return checked
+
+
+class CancellableConnection(simple_httpclient._HTTPConnection):
+    """
+    Connection registered in its client by request, so it can be closed before response comes
+    """
+
+    def __init__(self, io_loop, client, request, *args):
+        client.connections[request.request] = self
+        super(CancellableConnection, self).__init__(io_loop, client, request, *args)
+
+    def _release(self):
+        self.client.connections.pop(self.request.request, None)
+        super(CancellableConnection, self)._release()
+
+    def cancel(self):
+        if self.final_callback is None:
+            return False
+
+        try:
+            raise httpclient.HTTPError(599, 'Cancelled')
+        except httpclient.HTTPError:
+            self._handle_exception(*sys.exc_info())
+        return True
+
+
+class CancellableHTTPClient(simple_httpclient.SimpleAsyncHTTPClient):
+    """
+    Http client able to cancel queued or in-flight request, blocking query of removed service would hold
+    connection until its wait time ends otherwise
+    """
+
+    def initialize(self, *args, **kwargs):
+        super(CancellableHTTPClient, self).initialize(*args, **kwargs)
+        self.connections = {}
+
+    def _connection_class(self):
+        return CancellableConnection
+
+    def cancel(self, request):
+        """
+        Finish request with 599 error
+        :type request: HTTPRequest - request passed to fetch
+        :return: bool - True if request was queued or in flight
+        """
+        if request in self.connections:
+            return self.connections[request].cancel()
+
+        for key, (queued_request, callback, timeout_handle) in self.waiting.items():
+            if queued_request.request is request:
+                if timeout_handle is not None:
+                    self.io_loop.remove_timeout(timeout_handle)
+                self._on_timeout(key)
+                return True
+        return False
+
+
+class PooledHTTPClient(ReadConsistency, consul_from_tornado.HTTPClient):
+    """
+    Consul http client with its own connection pool instead of tornado shared AsyncHTTPClient.
+    """
+
+    def __init__(self, host, port, scheme, verify, pool, max_clients, request_timeout, read_mode='default',
+                 max_stale=None):
+        self.host = host
+        self.port = port
+        self.scheme = scheme
+        self.verify = verify
+        self.base_uri = '%s://%s:%s' % (self.scheme, self.host, self.port)
+
+        self.pool = pool
+        self.read_mode = read_mode
+        self.max_stale = max_stale
+        self.max_clients = max_clients
+        self.in_flight = 0
+        self.client = CancellableHTTPClient(force_instance=True, max_clients=max_clients,
+                                            defaults={'request_timeout': request_timeout})
+        pool_max_clients.set(max_clients, pool=pool)
+
+    @gen.coroutine
+    def _request(self, callback, request, requests=None):
+        """
+        :type requests: list - collects sent requests, so they can be cancelled
+        """
+        if requests is not None:
+            if not isinstance(request, httpclient.HTTPRequest):
+                request = httpclient.HTTPRequest(request, validate_cert=self.verify)
+            requests.append(request)
+
+        self.in_flight += 1
+        self.update_gauges()
+        if self.in_flight == self.max_clients + 1:
+            vergilius.logger.warn('[consul][%s]: connection pool exhausted (%s clients), requests are queued' %
+                                  (self.pool, self.max_clients))
+
+        try:
+            response = yield super(PooledHTTPClient, self)._request(callback, request)
+        finally:
+            self.in_flight -= 1
+            self.update_gauges()
+
+        raise gen.Return(response)
+
+    def get(self, callback, path, params=None):
+        """
+        :return: future, its cancel() finishes read in flight with base.Timeout
+        """
+        requests = []
+        future = self.read(callback, path, params, requests)
+        future.cancel = functools.partial(self.cancel, requests)
+        return future
+
+    @gen.coroutine
+    def read(self, callback, path, params, requests):
+        read_params = self.get_read_params(path, params)
+        if read_params is None:
+            response = yield self._request(callback, self.uri(path, params), requests)
+            raise gen.Return(response)
+
+        try:
+            response = yield self._request(self.check_staleness(callback), self.uri(path, read_params), requests)
+        except StaleRead:
+            stale_retries.inc(pool=self.pool)
+            response = yield self._request(callback, self.uri(path, params), requests)
+        raise gen.Return(response)
+
+    def cancel(self, requests):
+        """
+        :return: bool - True if any request was cancelled
+        """
+        return any([self.client.cancel(request) for request in requests])
+
+    def update_gauges(self):
+        pool_in_flight.set(self.in_flight, pool=self.pool)
+        pool_queued.set(max(0, self.in_flight - self.max_clients), pool=self.pool)
+
+
+class Consul(consul_from_tornado.Consul):
+    def __init__(self, pool, max_clients, request_timeout, read_mode='default', max_stale=None, **kwargs):
+        """
+        :type pool: string - pool name for logs and metrics
+        :type max_clients: int - max simultaneous connections
+        :type request_timeout: int - seconds, should be greater than blocking query wait time
+        :type read_mode: string - default, stale or cached
+        :type max_stale: float - seconds, older stale reads are repeated in default mode
+        """
+        self.pool = pool
+        self.max_clients = max_clients
+        self.request_timeout = request_timeout
+        self.read_mode = read_mode
+        self.max_stale = max_stale
+        super(Consul, self).__init__(**kwargs)
+
+    def connect(self, host, port, scheme, verify=True):
+        return PooledHTTPClient(host, port, scheme, verify, self.pool, self.max_clients, self.request_timeout,
+                                self.read_mode, self.max_stale)
+
+
+class SyncHTTPClient(ReadConsistency, consul_std.HTTPClient):
+    """
+    Blocking consul http client for startup and lock paths, with read consistency of async clients
+    """
+
+    def __init__(self, host, port, scheme, verify, read_mode, max_stale):
+        super(SyncHTTPClient, self).__init__(host, port, scheme, verify)
+        self.pool = 'sync'
+        self.read_mode = read_mode
+        self.max_stale = max_stale
+
+    def get(self, callback, path, params=None):
+        read_params = self.get_read_params(path, params)
+        if read_params is None:
+            return super(SyncHTTPClient, self).get(callback, path, params)
+
+        try:
+            return super(SyncHTTPClient, self).get(self.check_staleness(callback), path, read_params)
+        except StaleRead:
+            stale_retries.inc(pool=self.pool)
+            return super(SyncHTTPClient, self).get(callback, path, params)
+
+
+class SyncConsul(consul_std.Consul):
+    def __init__(self, read_mode='default', max_stale=None, **kwargs):
+        self.read_mode = read_mode
+        self.max_stale = max_stale
+        super(SyncConsul, self).__init__(**kwargs)
+
+    def connect(self, host, port, scheme, verify=True):
+        return SyncHTTPClient(host, port, scheme, verify, self.read_mode, self.max_stale)
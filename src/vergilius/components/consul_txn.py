@@ -0,0 +1,70 @@
+import base64
+import json
+
+from consul import ConsulException
+
+import vergilius
+
+MAX_OPERATIONS = 64
+
+
+class Transaction(object):
+    """
+    Batches KV writes into single atomic /v1/txn request, all operations are applied or none
+    """
+
+    def __init__(self, consul):
+        """
+        :type consul: consul.base.Consul - sync or tornado client, commit result follows its flavour
+        """
+        self.consul = consul
+        self.operations = []
+
+    def add(self, verb, key, **kwargs):
+        operation = {'Verb': verb, 'Key': key}
+        operation.update(kwargs)
+        self.operations.append({'KV': operation})
+        return self
+
+    def set(self, key, value, cas=None):
+        """
+        :type cas: int - write only if key modify index matches, 0 - only if key does not exist
+        """
+        if cas is None:
+            return self.add('set', key, Value=base64.b64encode(value))
+        return self.add('cas', key, Value=base64.b64encode(value), Index=cas)
+
+    def delete(self, key, cas=None):
+        if cas is None:
+            return self.add('delete', key)
+        return self.add('delete-cas', key, Index=cas)
+
+    def check_session(self, key, session_id):
+        """
+        Fail transaction if key is not locked with given session
+        """
+        # consul treats missing session as check of unlocked key
+        if not session_id:
+            raise ConsulException('Session is required to check lock of %s' % key)
+        return self.add('check-session', key, Session=session_id)
+
+    def commit(self):
+        """
+        :return: bool - True if committed, False if rolled back due to failed check
+        """
+        if len(self.operations) > MAX_OPERATIONS:
+            raise ConsulException('Too many operations in transaction: %s' % len(self.operations))
+
+        return self.consul.http.put(self.parse_response, '/v1/txn', data=json.dumps(self.operations))
+
+    def parse_response(self, response):
+        if response.code == 200:
+            return True
+
+        if response.code == 409:
+            errors = json.loads(response.body).get('Errors') or []
+            vergilius.logger.debug('[consul]: transaction rolled back: %s' %
+                                   ', '.join(error.get('What', '') for error in errors))
+            return False
+
+        raise ConsulException('%d %s' % (response.code, response.body))
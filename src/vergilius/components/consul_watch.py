@@ -0,0 +1,146 @@
+import random
+import time
+
+from consul import tornado, base, ConsulException
+from tornado import concurrent, gen
+
+import vergilius
+from vergilius.components.metrics import Gauge, watch_errors, watch_timeouts, watch_wakeups
+
+watch_failing = Gauge('vergilius_consul_watches_failing', 'Consul watches backing off after errors', ('watch',))
+
+
+class ConsulWatch(object):
+    """
+    Runs consul blocking query in a loop and passes changed data to callback. Failed queries are retried with
+    exponential backoff and jitter, index is reset by consul rules, wait time is jittered, so watches started
+    together do not wake up together. Stopped watch cancels query in flight, if its future supports it,
+    returns at once and drops references to its callbacks.
+    """
+
+    def __init__(self, name, query, callback, active=None):
+        """
+        :type name: string - watched endpoint, metrics label
+        :type query: callable - blocking query, gets index and wait keyword arguments, returns (index, data)
+        :type callback: callable - gets data of new index, may return future
+        :type active: callable - watch stops when it returns False
+        """
+        self.name = name
+        self.query = query
+        self.callback = callback
+        self.active = active or (lambda: True)
+
+        self.index = None
+        self.stopped = False
+        self.pending = None
+        self.waiter = None
+        # per watch statistics, labeled counters aggregate all watches of a kind
+        self.errors = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_success = None
+
+    @tornado.gen.coroutine
+    def run(self):
+        while not self.stopped and self.active():
+            try:
+                self.pending = self.query(index=self.index, wait=self.get_wait())
+                response = yield self.wait_for(self.pending)
+                self.pending = None
+                if self.stopped:
+                    break
+
+                index, data = response
+                watch_wakeups.inc(watch=self.name)
+                previous, self.index = self.index, self.get_next_index(self.index, index)
+                if self.failures:
+                    vergilius.logger.info('[consul watch][%s]: recovered after %s failures' %
+                                          (self.name, self.failures))
+                    watch_failing.dec(watch=self.name)
+                self.failures = 0
+                self.last_success = time.time()
+
+                # wait time passed without changes
+                if previous is not None and previous == self.index:
+                    continue
+                yield gen.maybe_future(self.callback(data))
+            except (ConsulException, base.Timeout) as e:
+                if isinstance(e, base.Timeout):
+                    watch_timeouts.inc(watch=self.name)
+                else:
+                    watch_errors.inc(watch=self.name)
+                    vergilius.logger.error('[consul watch][%s]: consul exception: %s' % (self.name, e))
+
+                if not self.failures:
+                    watch_failing.inc(watch=self.name)
+                self.errors += 1
+                self.failures += 1
+                self.last_error = time.time()
+                yield self.wait_for(gen.sleep(self.get_backoff(self.failures)))
+
+        if self.failures:
+            watch_failing.dec(watch=self.name)
+
+    def wait_for(self, future):
+        """
+        :return: future resolved with result of given one, or with None when watch is stopped
+        """
+        waiter = self.waiter = concurrent.Future()
+
+        def copy(done):
+            # exception of abandoned future is taken too, so it is not logged as unhandled
+            exc_info = done.exc_info()
+            if waiter.done():
+                return
+            if exc_info:
+                waiter.set_exc_info(exc_info)
+            else:
+                waiter.set_result(done.result())
+
+        future.add_done_callback(copy)
+        return waiter
+
+    def stop(self):
+        """
+        Stop watch, query in flight is cancelled, waiting backoff is abandoned
+        """
+        self.stopped = True
+        self.query = self.callback = self.active = None
+        if self.pending and not self.pending.done():
+            self.pending.cancel()
+        self.pending = None
+        if self.waiter and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    @classmethod
+    def get_next_index(cls, previous, index):
+        """
+        Index going backwards means consul state was reset, data is read again without blocking.
+        Index below 1 would make next query return at once, so it is raised to 1.
+        :rtype: int
+        """
+        try:
+            index = int(index)
+        except (TypeError, ValueError):
+            return None
+
+        if previous is not None and index < previous:
+            return None
+        return max(index, 1)
+
+    @classmethod
+    def get_wait(cls):
+        """
+        :rtype: string - blocking query wait time, reduced by random jitter
+        """
+        wait = vergilius.config.CONSUL_WATCH_WAIT
+        return '%ss' % int(wait - random.uniform(0, wait / 16.0))
+
+    @classmethod
+    def get_backoff(cls, failures):
+        """
+        :rtype: float - seconds, exponential backoff with half of it jittered
+        """
+        delay = min(vergilius.config.CONSUL_WATCH_BACKOFF_MAX,
+                    vergilius.config.CONSUL_WATCH_BACKOFF_MIN * 2 ** min(failures - 1, 32))
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
@@ -0,0 +1,94 @@
+import datetime
+import time
+
+import zope.interface
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.x509.oid import NameOID
+
+import vergilius
+from vergilius.components.certificate_provider import ICertificateProvider
+
+RSA_KEY_SIZE = 2048
+DAYS = 3650
+
+
+class CryptoCertificateProvider(object):
+    """
+    Issues certificates signed by identity CA in-process, without openssl binary and temp files.
+    """
+    zope.interface.implements(ICertificateProvider)
+
+    def __init__(self, key_type='rsa', days=DAYS):
+        """
+        :type key_type: string - rsa or ecdsa (P-256)
+        """
+        if key_type not in ('rsa', 'ecdsa'):
+            raise Exception('Unsupported key type: %s' % key_type)
+
+        self.key_type = key_type
+        self.days = days
+        self.ca = None
+
+    def get_ca(self):
+        if not self.ca:
+            identity = vergilius.Vergilius.identity
+            with open(identity.get_private_key_path(), 'rb') as f:
+                ca_key = serialization.load_pem_private_key(f.read(), password=vergilius.config.SECRET,
+                                                            backend=default_backend())
+            with open(identity.get_certificate_path(), 'rb') as f:
+                ca_cert = x509.load_pem_x509_certificate(f.read(), default_backend())
+            self.ca = (ca_key, ca_cert)
+
+        return self.ca
+
+    def generate_key(self):
+        if self.key_type == 'ecdsa':
+            return ec.generate_private_key(ec.SECP256R1(), default_backend())
+
+        return rsa.generate_private_key(public_exponent=65537, key_size=RSA_KEY_SIZE, backend=default_backend())
+
+    def get_csr(self, key, domains):
+        return x509.CertificateSigningRequestBuilder().subject_name(x509.Name([
+            x509.NameAttribute(NameOID.COMMON_NAME, domains[0]),
+            x509.NameAttribute(NameOID.EMAIL_ADDRESS, unicode(vergilius.config.EMAIL)),
+        ])).add_extension(
+                x509.SubjectAlternativeName([x509.DNSName(domain) for domain in domains]), critical=False
+        ).sign(key, hashes.SHA256(), default_backend())
+
+    def sign(self, csr):
+        ca_key, ca_cert = self.get_ca()
+        now = datetime.datetime.utcnow()
+
+        builder = x509.CertificateBuilder().subject_name(csr.subject).issuer_name(ca_cert.subject) \
+            .public_key(csr.public_key()) \
+            .serial_number(x509.random_serial_number()) \
+            .not_valid_before(now - datetime.timedelta(days=1)) \
+            .not_valid_after(now + datetime.timedelta(days=self.days)) \
+            .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True) \
+            .add_extension(x509.KeyUsage(digital_signature=True, key_encipherment=self.key_type == 'rsa',
+                                         content_commitment=False, data_encipherment=False, key_agreement=False,
+                                         key_cert_sign=False, crl_sign=False, encipher_only=False,
+                                         decipher_only=False), critical=True)
+
+        for extension in csr.extensions:
+            builder = builder.add_extension(extension.value, critical=extension.critical)
+
+        return builder.sign(ca_key, hashes.SHA256(), default_backend())
+
+    def get_certificate(self, id, domains):
+        """
+        :param id: string
+        :type domains: set
+        """
+        domains = sorted(unicode(domain) for domain in domains)
+        key = self.generate_key()
+        certificate = self.sign(self.get_csr(key, domains))
+
+        return {'private_key_pem': key.private_bytes(serialization.Encoding.PEM,
+                                                     serialization.PrivateFormat.TraditionalOpenSSL,
+                                                     serialization.NoEncryption()),
+                'public_key_pem': certificate.public_bytes(serialization.Encoding.PEM),
+                'expires': int(time.time()) + self.days * 24 * 60 * 60}
@@ -0,0 +1,35 @@
+import re
+import urllib
+
+import zope.interface
+from tornado import gen, httpclient
+
+from vergilius.components.upstream_backend import IUpstreamBackend
+
+
+class DynamicUpstreamBackend(object):
+    """
+    Manages upstreams with ngx_dynamic_upstream module, url looks like http://127.0.0.1:6000/dynamic
+    """
+    zope.interface.implements(IUpstreamBackend)
+
+    def __init__(self, url):
+        self.url = url
+        self.client = httpclient.AsyncHTTPClient()
+
+    def get_url(self, upstream, stream, **params):
+        params['upstream'] = upstream
+        if stream:
+            params['stream'] = ''
+        return '%s?%s' % (self.url, urllib.urlencode(sorted(params.items())))
+
+    @gen.coroutine
+    def update_upstream(self, upstream, servers, stream=False):
+        response = yield self.client.fetch(self.get_url(upstream, stream))
+        deployed = set(re.findall(r'server ([^;\s]+)', response.body))
+
+        for server in set(servers) - deployed:
+            yield self.client.fetch(self.get_url(upstream, stream, server=server, add=''))
+
+        for server in deployed - set(servers):
+            yield self.client.fetch(self.get_url(upstream, stream, server=server, remove=''))
@@ -0,0 +1,198 @@
+import os
+import re
+import tempfile
+
+import vergilius
+
+ROUTING_FILE = 'vergilius.routing.conf'
+# hostname allowed in map table, other tag values are left out of map mode routing
+DOMAIN_PATTERN = re.compile(r'^[a-z0-9]([a-z0-9_-]*[a-z0-9])?(\.[a-z0-9]([a-z0-9_-]*[a-z0-9])?)*$', re.IGNORECASE)
+SERVICE_PATTERN = re.compile(r'^# service (\S+) crossdomain=([01]) http=(\S*) http2=(\S*)$')
+
+
+def get_hash_sizes(names, min_bucket_size=64, min_max_size=512):
+    """
+    Size nginx hash so a bucket fits the longest name and the table has room for all names
+    :rtype: tuple - bucket size, max size
+    """
+    longest = max([len(name) for name in names] or [0])
+    bucket_size = min_bucket_size
+    # hash element is value pointer, length and name aligned to pointer, bucket ends with null pointer
+    while bucket_size < longest + 32:
+        bucket_size *= 2
+
+    max_size = min_max_size
+    while max_size < len(names) * 2:
+        max_size *= 2
+
+    return bucket_size, max_size
+
+
+class HostRouting(object):
+    """
+    Keeps domains of all services in routing file: server names and map hash sizes computed from them and,
+    in map mode, single http server choosing upstream by `map $host` table instead of server block per service.
+    File covers all services, so updates only mark it dirty and it is written once by flush before nginx reload.
+    """
+
+    def __init__(self, path, mode):
+        """
+        :type path: string - nginx config directory
+        :type mode: string - server or map
+        """
+        self.path = path
+        self.mode = mode
+        # service id -> (http domains, http2 domains, allow crossdomain)
+        self.services = {}
+        self.content = None
+        self.loaded = False
+        self.dirty = False
+
+    def get_path(self):
+        return os.path.join(self.path, ROUTING_FILE)
+
+    def load(self):
+        """
+        Restore domains from routing file written by previous run, so services that are not loaded yet
+        are not dropped from the map
+        """
+        self.loaded = True
+        try:
+            with open(self.get_path(), 'r') as routing_file:
+                self.content = routing_file.read()
+        except IOError:
+            return
+
+        for line in self.content.splitlines():
+            match = SERVICE_PATTERN.match(line)
+            if match:
+                self.services[match.group(1)] = (frozenset(filter(None, match.group(3).split(','))),
+                                                 frozenset(filter(None, match.group(4).split(','))),
+                                                 match.group(2) == '1')
+
+    def update(self, service_id, http_domains, http2_domains, allow_crossdomain):
+        """
+        :return: bool - True if routing changed and file has to be flushed
+        """
+        if not self.loaded:
+            self.load()
+
+        services = self.get_services({service_id: self.get_service(http_domains, http2_domains, allow_crossdomain)})
+        if services == self.services:
+            return False
+
+        self.services = services
+        self.dirty = True
+        return True
+
+    def remove(self, service_id):
+        return self.update(service_id, (), (), False)
+
+    def prune(self, service_ids):
+        """
+        Drop services restored from routing file that are not known anymore, their map entries would point
+        to missing upstreams and hold domains of live services
+        :type service_ids: set - ids of known services
+        :return: bool - True if routing changed and file has to be flushed
+        """
+        if not self.loaded:
+            self.load()
+
+        stale = set(self.services) - service_ids
+        if not stale:
+            return False
+
+        for service_id in stale:
+            del self.services[service_id]
+        self.dirty = True
+        return True
+
+    @classmethod
+    def get_service(cls, http_domains, http2_domains, allow_crossdomain):
+        return frozenset(http_domains), frozenset(http2_domains), bool(allow_crossdomain)
+
+    def get_services(self, overrides=None):
+        """
+        :type overrides: dict - service tuples by service id, replace current ones
+        """
+        services = dict(self.services)
+        for service_id, service in (overrides or {}).items():
+            if service[0] or service[1]:
+                services[service_id] = service
+            else:
+                services.pop(service_id, None)
+        return services
+
+    def get_routes(self, services):
+        """
+        :rtype: list - (domain, service id, allow crossdomain), first service by id wins conflicting domain
+        """
+        routes = {}
+        for service_id, (http_domains, http2_domains, allow_crossdomain) in sorted(services.items()):
+            for domain in sorted(http_domains):
+                if not DOMAIN_PATTERN.match(domain):
+                    vergilius.logger.warn('[routing][%s]: invalid domain %s is not routed' % (service_id, domain))
+                elif domain.lower() in routes:
+                    vergilius.logger.warn('[routing][%s]: domain %s is already routed to %s' % (
+                        service_id, domain, routes[domain.lower()][1]))
+                else:
+                    routes[domain.lower()] = (domain.lower(), service_id, allow_crossdomain)
+        return sorted(routes.values())
+
+    def render(self, overrides=None):
+        """
+        :type overrides: dict - service tuples by service id, replace current ones
+        :rtype: string - routing file content
+        """
+        if not self.loaded:
+            self.load()
+
+        services = self.get_services(overrides)
+        routes = self.get_routes(services) if self.mode == 'map' else []
+
+        server_names = []
+        for http_domains, http2_domains, allow_crossdomain in services.values():
+            domains = http2_domains if self.mode == 'map' else http_domains | http2_domains
+            server_names.extend(name for domain in domains for name in (domain, '*.%s' % domain))
+
+        return vergilius.template_loader.load('routing.html').generate(
+                mode=self.mode, services=sorted(services.items()), routes=routes, config=vergilius.config,
+                server_names_hash=get_hash_sizes(server_names),
+                map_hash=get_hash_sizes(['.%s' % domain for domain, service_id, crossdomain in routes],
+                                        min_max_size=2048))
+
+    def flush(self):
+        """
+        Write routing file once for all updates since previous flush
+        :rtype: bool - True if routing file changed
+        """
+        if not self.dirty:
+            return False
+
+        has_changes = self.write()
+        self.dirty = False
+        return has_changes
+
+    def write(self):
+        """
+        Write routing file atomically if content changed
+        :rtype: bool
+        """
+        content = self.render()
+        if content == self.content:
+            return False
+
+        path = self.get_path()
+        temp_file = tempfile.NamedTemporaryFile(dir=self.path, prefix='.routing', suffix='.tmp', delete=False)
+        try:
+            temp_file.write(content)
+            temp_file.close()
+            os.chmod(temp_file.name, 0o644)
+            os.rename(temp_file.name, path)
+        except Exception:
+            vergilius.logger.error('[routing]: failed to write %s' % path)
+            os.remove(temp_file.name)
+            raise
+
+        self.content = content
+        return True
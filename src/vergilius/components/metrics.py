@@ -0,0 +1,142 @@
+import contextlib
+import threading
+import time
+
+registry = []
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, description, labels=()):
+        """
+        :type name: string - metric name
+        :type labels: tuple - label names
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(labels.get(label, '') for label in self.labels)
+
+    def get(self, **labels):
+        value = self.values.get(self.key(labels), 0)
+        return value() if callable(value) else value
+
+    def remove(self, **labels):
+        with self.lock:
+            self.values.pop(self.key(labels), None)
+
+    def format_labels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in pairs)
+
+    def samples(self):
+        values = self.values.items() or ([((), 0)] if not self.labels else [])
+        for key, value in sorted(values):
+            yield '%s%s %s' % (self.name, self.format_labels(key), format_value(value() if callable(value) else value))
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, value=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+    def set_function(self, function, **labels):
+        """
+        Compute value on read
+        """
+        with self.lock:
+            self.values[self.key(labels)] = function
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = {'buckets': [0] * len(self.buckets), 'sum': 0, 'count': 0}
+            data = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data['buckets'][i] += 1
+            data['sum'] += value
+            data['count'] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), {'buckets': [0] * len(self.buckets), 'sum': 0, 'count': 0})
+
+    def samples(self):
+        for key, data in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, data['buckets']):
+                yield '%s_bucket%s %s' % (self.name, self.format_labels(key, [('le', format_value(bound))]), count)
+            yield '%s_bucket%s %s' % (self.name, self.format_labels(key, [('le', '+Inf')]), data['count'])
+            yield '%s_sum%s %s' % (self.name, self.format_labels(key), format_value(data['sum']))
+            yield '%s_count%s %s' % (self.name, self.format_labels(key), data['count'])
+
+
+def escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def exposition():
+    """
+    Render all metrics in prometheus text format
+    """
+    lines = []
+    for metric in registry:
+        lines.append('# HELP %s %s' % (metric.name, metric.description))
+        lines.append('# TYPE %s %s' % (metric.name, metric.type))
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+# consul blocking queries, watch label is the watched endpoint
+watch_wakeups = Counter('vergilius_consul_watch_wakeups_total', 'Consul blocking query responses', ('watch',))
+watch_errors = Counter('vergilius_consul_watch_errors_total', 'Consul blocking query errors', ('watch',))
+watch_timeouts = Counter('vergilius_consul_watch_timeouts_total', 'Consul blocking query timeouts', ('watch',))
@@ -0,0 +1,13 @@
+import tornado.web
+
+from vergilius.components import metrics
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    Prometheus exposition of control plane metrics
+    """
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.exposition())
@@ -1,20 +1,177 @@
+from collections import deque
+
+import vergilius
+from vergilius.components.consul_txn import Transaction
+from vergilius.components.metrics import Gauge
 from vergilius.config import PROXY_PORTS
 
-allocated = set()
+PORTS_PREFIX = 'vergilius/ports/'
+CLAIMS_PREFIX = 'vergilius/port_claims/'
+
+allocated_ports = Gauge('vergilius_allocated_ports', 'Allocated tcp/udp proxy ports')
+
+
+class PortAllocator(object):
+    """
+    Allocates ports from [min_port, max_port) range with free list, every operation is O(1).
+    Reserved ports stay in free list and are skipped lazily.
+    """
+
+    def __init__(self, min_port, max_port):
+        self.min_port = min_port
+        self.max_port = max_port
+        self.free = deque(xrange(min_port, max_port))
+        # bitmap of ports present in free list, keeps free list without duplicates
+        self.queued = bytearray(b'\x01' * (max_port - min_port))
+        self.allocated = {}
+        # owner -> last port allocated to it
+        self.owners = {}
+
+    def allocate(self, owner=None):
+        while self.free:
+            port = self.free.popleft()
+            self.queued[port - self.min_port] = 0
+            if port not in self.allocated:
+                self.set_owner(port, owner)
+                return port
+
+        raise Exception('Failed to allocate port')
+
+    def reserve(self, port, owner=None):
+        port = int(port)
+        if not self.in_range(port):
+            raise Exception('Port %s is out of range %s-%s' % (port, self.min_port, self.max_port))
+        if self.allocated.get(port, owner) != owner:
+            raise Exception('Port %s is already allocated to %s' % (port, self.allocated[port]))
+        self.set_owner(port, owner)
+
+    def set_owner(self, port, owner):
+        self.allocated[port] = owner
+        if owner is not None:
+            self.owners[owner] = port
+
+    def get_port(self, owner):
+        return self.owners.get(owner)
+
+    def in_range(self, port):
+        return self.min_port <= int(port) < self.max_port
+
+    def release(self, port):
+        port = int(port)
+        owner = self.allocated.pop(port, None)
+        if owner is not None and self.owners.get(owner) == port:
+            del self.owners[owner]
+        if self.in_range(port) and not self.queued[port - self.min_port]:
+            self.queued[port - self.min_port] = 1
+            self.free.appendleft(port)
+
+    def __contains__(self, port):
+        return int(port) in self.allocated
+
+
+allocator = PortAllocator(PROXY_PORTS[0], PROXY_PORTS[1])
+allocated_ports.set_function(lambda: len(allocator.allocated))
+
 
+def reset():
+    global allocator
+    allocator = PortAllocator(PROXY_PORTS[0], PROXY_PORTS[1])
 
-def allocate():
-    min_port = PROXY_PORTS[0]
-    max_port = PROXY_PORTS[1]
 
-    while min_port < max_port:
-        if min_port not in allocated:
-            allocated.add(min_port)
-            return min_port
-        min_port += 1
+def rebuild():
+    """
+    Restore allocations of all services from consul with single recursive read
+    """
+    reset()
+    index, data = vergilius.consul.kv.get(PORTS_PREFIX, recurse=True, consistency='consistent')
+    for item in data or []:
+        try:
+            allocator.reserve(item['Value'], item['Key'][len(PORTS_PREFIX):])
+        except Exception as e:
+            vergilius.logger.error('[ports]: %s' % e)
 
-    raise Exception('Failed to allocate port')
+
+def allocate(owner=None):
+    return allocator.allocate(owner)
 
 
 def release(port):
-    allocated.discard(int(port))
+    allocator.release(port)
+
+
+def get_port(name):
+    """
+    :rtype: int - port claimed by service, None if it has no claim
+    """
+    return allocator.get_port(name)
+
+
+def claim(name, pinned=None):
+    """
+    Get port of service, agreed between gateways: port claim and service port keys are written
+    in one check-and-set transaction
+    :type name: string - service name
+    :type pinned: int - port requested with service tag
+    :rtype: int
+    """
+    index, data = vergilius.consul.kv.get(PORTS_PREFIX + name, consistency='consistent')
+    # port out of range is left by pin of older version or changed PROXY_PORTS, service is moved into range
+    if data and allocator.in_range(data['Value']) and (not pinned or int(data['Value']) == pinned):
+        allocator.reserve(data['Value'], name)
+        return int(data['Value'])
+
+    while True:
+        if pinned:
+            port, pinned = pinned, None
+            try:
+                allocator.reserve(port, name)
+            except Exception as e:
+                vergilius.logger.error('[ports][%s]: can not pin port: %s' % (name, e))
+                if data:
+                    return claim(name)
+                continue
+        else:
+            port = allocator.allocate(name)
+
+        txn = Transaction(vergilius.consul) \
+            .set(CLAIMS_PREFIX + str(port), name, cas=0) \
+            .set(PORTS_PREFIX + name, str(port), cas=data['ModifyIndex'] if data else 0)
+        if data:
+            txn.delete(CLAIMS_PREFIX + data['Value'])
+
+        if txn.commit():
+            break
+
+        allocator.release(port)
+
+        index, current = vergilius.consul.kv.get(PORTS_PREFIX + name, consistency='consistent')
+        if (current and current['ModifyIndex']) != (data and data['ModifyIndex']):
+            # another gateway was faster, use its port
+            return claim(name)
+
+        # port claimed by another gateway
+        index, claim_data = vergilius.consul.kv.get(CLAIMS_PREFIX + str(port), consistency='consistent')
+        owner = claim_data['Value'] if claim_data else None
+        if owner == name:
+            # stale claim of this service, left by interrupted claim
+            vergilius.consul.kv.delete(CLAIMS_PREFIX + str(port), cas=claim_data['ModifyIndex'])
+            pinned = port
+            continue
+
+        vergilius.logger.warn('[ports][%s]: port %s is already claimed by %s' % (name, port, owner))
+        allocator.reserve(port, owner)
+        if data:
+            return claim(name)
+
+    if data:
+        allocator.release(data['Value'])
+
+    return port
+
+
+def unclaim(name, port):
+    allocator.release(port)
+    Transaction(vergilius.consul) \
+        .delete(PORTS_PREFIX + name) \
+        .delete(CLAIMS_PREFIX + str(port)) \
+        .commit()
@@ -0,0 +1,13 @@
+import zope.interface
+
+
+class IUpstreamBackend(zope.interface.Interface):
+    def update_upstream(self, upstream, servers, stream=False):
+        """
+        Bring running nginx upstream membership to given servers without reload
+        :param upstream: string - upstream zone name
+        :param servers: set - 'address:port' strings
+        :param stream: bool - upstream is in stream context
+        :rtype: Future
+        """
+        pass
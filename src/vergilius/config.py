@@ -1,17 +1,81 @@
 import os
 
 CONSUL_HOST = os.environ.get('CONSUL_HOST', 'localhost')
+CONSUL_PORT = int(os.environ.get('CONSUL_PORT', 8500))
+# service - blocking query per service, health - single blocking query for the whole catalog
+DISCOVERY_MODE = os.environ.get('DISCOVERY_MODE', 'service')
+# connection pools for consul blocking queries and one-shot requests, timeouts in seconds
+CONSUL_WATCH_MAX_CLIENTS = int(os.environ.get('CONSUL_WATCH_MAX_CLIENTS', 1000))
+CONSUL_WATCH_REQUEST_TIMEOUT = int(os.environ.get('CONSUL_WATCH_REQUEST_TIMEOUT', 330))
+CONSUL_REQUEST_MAX_CLIENTS = int(os.environ.get('CONSUL_REQUEST_MAX_CLIENTS', 10))
+CONSUL_REQUEST_TIMEOUT = int(os.environ.get('CONSUL_REQUEST_TIMEOUT', 20))
+# consul reads: default - through leader, stale - from any server, cached - from agent cache where supported,
+# stale reads older than max stale seconds are repeated through leader, port claims always read through leader
+CONSUL_CONSISTENCY = os.environ.get('CONSUL_CONSISTENCY', 'default')
+CONSUL_MAX_STALE = float(os.environ.get('CONSUL_MAX_STALE', 10))
+# blocking query wait seconds, less than watch request timeout; failed watches back off from min to max seconds
+CONSUL_WATCH_WAIT = int(os.environ.get('CONSUL_WATCH_WAIT', 300))
+CONSUL_WATCH_BACKOFF_MIN = float(os.environ.get('CONSUL_WATCH_BACKOFF_MIN', 1))
+CONSUL_WATCH_BACKOFF_MAX = float(os.environ.get('CONSUL_WATCH_BACKOFF_MAX', 60))
+
+ADMIN_PORT = int(os.environ.get('ADMIN_PORT', 8888))
 
 DATA_PATH = os.environ.get('DATA_PATH', '/data/')
 
 NGINX_CONFIG_PATH = os.environ.get('NGINX_CONFIG_PATH', '/etc/nginx/conf.d/')
+# service - config files per service, sharded - services combined into shard files, shards per config type
+NGINX_CONFIG_OUTPUT = os.environ.get('NGINX_CONFIG_OUTPUT', 'service')
+NGINX_CONFIG_SHARDS = int(os.environ.get('NGINX_CONFIG_SHARDS', 16))
+# server - server block per http service, map - single http server routing hosts with map table to upstreams
+HOST_ROUTING = os.environ.get('HOST_ROUTING', 'server')
 NGINX_BINARY = os.environ.get('NGINX_BINARY', '/usr/sbin/nginx')
 NGINX_HTTP_PORT = os.environ.get('NGINX_HTTP_PORT', 80)
 NGINX_HTTP2_PORT = os.environ.get('NGINX_HTTP2_PORT', 443)
+# reload coalescing, seconds: wait for quiet period, but not longer than max delay; min interval between reloads
+NGINX_RELOAD_QUIET_PERIOD = float(os.environ.get('NGINX_RELOAD_QUIET_PERIOD', 1))
+NGINX_RELOAD_MIN_INTERVAL = float(os.environ.get('NGINX_RELOAD_MIN_INTERVAL', 5))
+NGINX_RELOAD_MAX_DELAY = float(os.environ.get('NGINX_RELOAD_MAX_DELAY', 10))
+# validate pending configs of all services with one nginx -t, batch is collected for delay seconds
+NGINX_BATCH_VALIDATION = os.environ.get('NGINX_BATCH_VALIDATION', '0') == '1'
+NGINX_VALIDATION_BATCH_DELAY = float(os.environ.get('NGINX_VALIDATION_BATCH_DELAY', 0.5))
+# apply upstream membership changes without reload: api (nginx plus) or dynamic (ngx_dynamic_upstream)
+UPSTREAM_BACKEND = os.environ.get('UPSTREAM_BACKEND', '')
+UPSTREAM_BACKEND_URL = os.environ.get('UPSTREAM_BACKEND_URL', 'http://127.0.0.1:8080/api/6')
+# shared memory zone of every upstream, balancing state is shared between nginx workers
+UPSTREAM_ZONE_SIZE = os.environ.get('UPSTREAM_ZONE_SIZE', '64k')
+# balancing strategy of upstreams: least_conn, round_robin, random (two choices) or hash[:<key>], overridden with tag
+UPSTREAM_BALANCE = os.environ.get('UPSTREAM_BALANCE', 'least_conn')
+# idle keepalive connections to backends per upstream (0 disables) and their timeout, overridden with service tags
+UPSTREAM_KEEPALIVE = int(os.environ.get('UPSTREAM_KEEPALIVE', 16))
+UPSTREAM_KEEPALIVE_TIMEOUT = os.environ.get('UPSTREAM_KEEPALIVE_TIMEOUT', '60s')
+# response caches of services with cache:<size>:<ttl> tag, directory per service; keys zone size per service
+NGINX_CACHE_PATH = os.environ.get('NGINX_CACHE_PATH', '/var/cache/nginx/vergilius/')
+NGINX_CACHE_KEYS_ZONE_SIZE = os.environ.get('NGINX_CACHE_KEYS_ZONE_SIZE', '10m')
+# request header that skips cache lookup, response is fetched from backend and cached
+NGINX_CACHE_BYPASS_HEADER = os.environ.get('NGINX_CACHE_BYPASS_HEADER', 'X-Cache-Bypass')
+# nodes with warning checks: backup - backup servers, weight - reduced weight, exclude - only passing nodes are routed
+WARNING_NODES = os.environ.get('WARNING_NODES', 'backup')
+# weight of warning nodes, percent of passing nodes weight
+WARNING_NODE_WEIGHT = int(os.environ.get('WARNING_NODE_WEIGHT', 10))
+# derive fail_timeout and max_fails of servers from consul check interval and failures before critical
+PASSIVE_HEALTH = os.environ.get('PASSIVE_HEALTH', '1') == '1'
 PROXY_PORTS = [int(s) for s in os.environ.get('PROXY_PORTS', '7000-8000').split('-')]
 
 ACME_DIRECTORY_URL = os.environ.get('ACME_DIRECTORY_URL', 'https://acme-staging.api.letsencrypt.org/directory')
 
+# dummy - openssl binary, crypto - in-process with rsa or ecdsa (P-256) keys
+CERTIFICATE_PROVIDER = os.environ.get('CERTIFICATE_PROVIDER', 'dummy')
+CERTIFICATE_KEY_TYPE = os.environ.get('CERTIFICATE_KEY_TYPE', 'rsa')
+CERTIFICATE_ISSUANCE_CONCURRENCY = int(os.environ.get('CERTIFICATE_ISSUANCE_CONCURRENCY', 4))
+# renew certificates lead time seconds before expiry, minus random jitter; retry failed renewal after retry seconds
+CERTIFICATE_RENEWAL_LEAD_TIME = int(os.environ.get('CERTIFICATE_RENEWAL_LEAD_TIME', 30 * 24 * 60 * 60))
+CERTIFICATE_RENEWAL_JITTER = int(os.environ.get('CERTIFICATE_RENEWAL_JITTER', 24 * 60 * 60))
+CERTIFICATE_RENEWAL_RETRY = int(os.environ.get('CERTIFICATE_RENEWAL_RETRY', 10 * 60))
+# tls session ticket keys shared by all gateways through consul, rotated every rotation seconds, keys kept
+TLS_SESSION_TICKETS = os.environ.get('TLS_SESSION_TICKETS', '1') == '1'
+TLS_TICKET_KEY_ROTATION = int(os.environ.get('TLS_TICKET_KEY_ROTATION', 12 * 60 * 60))
+TLS_TICKET_KEYS = int(os.environ.get('TLS_TICKET_KEYS', 4))
+
 OPENSSL_BINARY = os.environ.get('OPENSSL_BINARY', '/usr/bin/openssl')
 
 EMAIL = os.environ.get('EMAIL', 'root@localhost')
@@ -0,0 +1,93 @@
+import functools
+import hashlib
+
+from consul import tornado
+from tornado import ioloop
+
+import vergilius
+from vergilius.components.consul_watch import ConsulWatch
+
+CERTIFICATES_PREFIX = 'vergilius/certificates/'
+
+
+class CertificateWatcher(object):
+    """
+    Watches certificates of all services with single recursive blocking query and
+    dispatches changed keys to certificates by service id key prefix. Keys are loaded concurrently,
+    a certificate requesting new keys does not hold back others nor the watch.
+    """
+    certificates = {}
+    snapshot = None
+    digests = {}
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    def watch_certificates(cls):
+        return ConsulWatch('certificates',
+                           functools.partial(vergilius.consul_tornado.kv.get, CERTIFICATES_PREFIX, recurse=True),
+                           cls.check_certificates).run()
+
+    @classmethod
+    @tornado.gen.coroutine
+    def check_certificates(cls, data):
+        cls.snapshot = cls.group_by_service(data)
+
+        for service_id, certificate in cls.certificates.items():
+            items = cls.snapshot.get(service_id)
+            digest = cls.get_digest(items)
+            if cls.digests.get(service_id) == digest:
+                continue
+
+            cls.digests[service_id] = digest
+            ioloop.IOLoop.current().add_future(certificate.load_keys_from_consul(items),
+                                               functools.partial(cls.check_loaded, service_id))
+
+    @classmethod
+    def check_loaded(cls, service_id, future):
+        try:
+            future.result()
+        except Exception as e:
+            vergilius.logger.error('[certificate watcher][%s]: failed to load keys: %s' % (service_id, e))
+
+    @classmethod
+    def register(cls, certificate):
+        """
+        :return: known keys of certificate service, None if watcher has no data yet
+        """
+        service_id = certificate.service.id
+        cls.certificates[service_id] = certificate
+
+        if cls.snapshot is None:
+            return None
+
+        items = cls.snapshot.get(service_id)
+        cls.digests[service_id] = cls.get_digest(items)
+        return items or []
+
+    @classmethod
+    def unregister(cls, certificate):
+        service_id = certificate.service.id
+        if cls.certificates.get(service_id) is certificate:
+            del cls.certificates[service_id]
+            cls.digests.pop(service_id, None)
+
+    @classmethod
+    def group_by_service(cls, data):
+        groups = {}
+        for item in data or []:
+            service_id = item['Key'][len(CERTIFICATES_PREFIX):].split('/', 1)[0]
+            groups.setdefault(service_id, []).append(item)
+        return groups
+
+    @classmethod
+    def get_digest(cls, items):
+        """
+        Digest of certificate keys, lock changes are ignored
+        """
+        digest = hashlib.sha1()
+        for item in sorted(items or [], key=lambda i: i['Key']):
+            if not item['Key'].endswith('/lock'):
+                digest.update('%s\0%s\0' % (item['Key'], item['Value'] or ''))
+        return digest.hexdigest()
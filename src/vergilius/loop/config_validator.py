@@ -0,0 +1,184 @@
+import os
+import tempfile
+from shutil import rmtree
+
+from consul import tornado
+from tornado import gen, process
+from tornado.locks import Event
+
+import vergilius
+from vergilius.components.metrics import Counter, Gauge, Histogram
+
+CONFIG_TYPES = ('upstream', 'stream_upstream', 'http', 'http2', 'tcp', 'udp')
+
+validations_total = Counter('vergilius_nginx_validations_total', 'nginx -t runs', ('result',))
+nginx_test_duration = Histogram('vergilius_nginx_test_duration_seconds', 'nginx -t duration')
+quarantined_services = Gauge('vergilius_nginx_quarantined_services', 'Services with invalid nginx config')
+
+
+class ConfigValidator(object):
+    """
+    Collects pending service configs and validates them with one `nginx -t` per batch against deployed configs.
+    Failed batch is bisected to find and quarantine invalid services, valid ones are deployed. Quarantined services
+    are validated one by one after the batch, so a service stuck with invalid config does not fail every batch.
+    """
+    validation_event = Event()
+    pending = {}
+    quarantined = set()
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    @tornado.gen.coroutine
+    def validate_configs(cls):
+        while True:
+            yield cls.validation_event.wait()
+            yield gen.sleep(vergilius.config.NGINX_VALIDATION_BATCH_DELAY)
+            cls.validation_event.clear()
+
+            services = cls.pending.values()
+            cls.pending = {}
+
+            try:
+                yield cls.deploy(services)
+            except Exception as e:
+                vergilius.logger.error('[validator]: batch validation failed, retrying: %s' % e)
+                for service in services:
+                    if service.active:
+                        cls.pending.setdefault(service.id, service)
+                cls.validation_event.set()
+
+    @classmethod
+    @tornado.gen.coroutine
+    def deploy(cls, services):
+        """
+        Validate configs of services and write valid ones
+        """
+        nginx_configs = {}
+        fingerprints = {}
+        for service in services:
+            if service.active:
+                nginx_configs[service] = service.get_nginx_configs()
+                fingerprints[service] = service.rendered_fingerprint
+
+        valid = yield cls.validate_batch(dict(
+                (service, configs) for service, configs in nginx_configs.items() if service.id not in cls.quarantined))
+        accepted = dict((service, nginx_configs[service]) for service in valid)
+        for service in sorted(nginx_configs, key=lambda s: s.id):
+            if service.id in cls.quarantined and (yield cls.validate_batch({service: nginx_configs[service]},
+                                                                           accepted)):
+                valid.append(service)
+                accepted[service] = nginx_configs[service]
+
+        for service in valid:
+            cls.quarantined.discard(service.id)
+            if service.active:
+                service.write_nginx_configs(nginx_configs[service], fingerprints[service])
+        quarantined_services.set(len(cls.quarantined))
+
+    @classmethod
+    def queue_validation(cls, service):
+        cls.pending[service.id] = service
+        cls.validation_event.set()
+
+    @classmethod
+    def discard(cls, service):
+        """
+        Forget deleted service, its pending configs and quarantine
+        """
+        if cls.pending.get(service.id) is service:
+            del cls.pending[service.id]
+        if service.id in cls.quarantined:
+            cls.quarantined.discard(service.id)
+            quarantined_services.set(len(cls.quarantined))
+
+    @classmethod
+    @tornado.gen.coroutine
+    def validate_batch(cls, nginx_configs, accepted=None):
+        """
+        :type nginx_configs: dict - configs by config type, by service
+        :type accepted: dict - already validated configs by service, tested together with batch
+        :return: list of services with configs valid together with each other and accepted ones
+        """
+        if not nginx_configs:
+            raise gen.Return([])
+
+        accepted = dict(accepted or {})
+        tested = dict(accepted)
+        tested.update(nginx_configs)
+        if (yield cls.nginx_test(tested)):
+            raise gen.Return(list(nginx_configs.keys()))
+
+        services = sorted(nginx_configs.keys(), key=lambda s: s.id)
+        if len(services) == 1:
+            vergilius.logger.error('[validator][%s]: invalid nginx config, service quarantined' % services[0].id)
+            cls.quarantined.add(services[0].id)
+            raise gen.Return([])
+
+        # right half is tested with valid part of left one, services valid alone may conflict with each other
+        middle = len(services) // 2
+        left = yield cls.validate_batch(dict((s, nginx_configs[s]) for s in services[:middle]), accepted)
+        accepted.update((s, nginx_configs[s]) for s in left)
+        right = yield cls.validate_batch(dict((s, nginx_configs[s]) for s in services[middle:]), accepted)
+        raise gen.Return(left + right)
+
+    @classmethod
+    @tornado.gen.coroutine
+    def nginx_test(cls, nginx_configs):
+        """
+        Build config tree from deployed configs overridden by pending ones and check it with nginx
+        :rtype: bool
+        """
+        temp_dir = tempfile.mkdtemp()
+
+        try:
+            for file_name in os.listdir(vergilius.config.NGINX_CONFIG_PATH):
+                if file_name.endswith(tuple('.%s.conf' % config_type for config_type in CONFIG_TYPES + ('routing',))):
+                    os.symlink(os.path.join(vergilius.config.NGINX_CONFIG_PATH, file_name),
+                               os.path.join(temp_dir, file_name))
+
+            config_shards = vergilius.config_shards
+            for service, configs in nginx_configs.items():
+                # configs service does not need anymore are left out too
+                for config_type in CONFIG_TYPES:
+                    path = os.path.join(temp_dir, '%s.%s.conf' % (service.id, config_type))
+                    if os.path.lexists(path):
+                        os.remove(path)
+                    if config_type in configs and not config_shards:
+                        with open(path, 'w+') as config_file:
+                            config_file.write(configs[config_type])
+
+            if config_shards:
+                overrides = dict((service.id, configs) for service, configs in nginx_configs.items())
+                shards = set(config_shards.get_shard(service_id) for service_id in overrides)
+                for shard in shards:
+                    for config_type in CONFIG_TYPES:
+                        path = os.path.join(temp_dir, os.path.basename(config_shards.get_path(shard, config_type)))
+                        if os.path.lexists(path):
+                            os.remove(path)
+                        content = config_shards.render(shard, config_type, overrides)
+                        if content:
+                            with open(path, 'w+') as config_file:
+                                config_file.write(content)
+
+            routing_path = os.path.join(temp_dir, os.path.basename(vergilius.host_routing.get_path()))
+            if os.path.lexists(routing_path):
+                os.remove(routing_path)
+            with open(routing_path, 'w+') as routing_file:
+                routing_file.write(vergilius.host_routing.render(
+                        dict((service.id, service.get_routing()) for service in nginx_configs)))
+
+            nginx_config_path = os.path.join(temp_dir, 'nginx')
+            with open(nginx_config_path, 'w+') as nginx_config_file:
+                nginx_config_file.write(vergilius.template_loader.load('batch_validate.html').generate(
+                        path=temp_dir, pid_file=os.path.join(temp_dir, 'pid')))
+
+            with nginx_test_duration.time():
+                proc = process.Subprocess([vergilius.config.NGINX_BINARY, '-t', '-c', nginx_config_path])
+                return_code = yield proc.wait_for_exit(raise_error=False)
+        finally:
+            rmtree(temp_dir, ignore_errors=True)
+
+        validations_total.inc(result='success' if return_code == 0 else 'failure')
+        raise gen.Return(return_code == 0)
@@ -0,0 +1,82 @@
+import functools
+
+from consul import tornado, base, ConsulException
+
+import vergilius
+from vergilius.components.consul_watch import ConsulWatch
+
+
+class HealthWatcher(object):
+    """
+    Watches health state of the whole catalog with a single blocking query and
+    feeds only changed services with fresh node sets.
+    """
+
+    def __init__(self, services):
+        """
+        :type services: dict - services by name, shared with ServiceWatcher
+        """
+        self.services = services
+        self.snapshot = {}
+
+    def watch_health(self):
+        return ConsulWatch('health', functools.partial(vergilius.consul_tornado.health.state, 'any'),
+                           self.check_health).run()
+
+    @tornado.gen.coroutine
+    def check_health(self, data):
+        snapshot = self.build_snapshot(data)
+
+        for service_name in self.diff(self.snapshot, snapshot):
+            service = self.services.get(service_name)
+            if service is None or not service.active:
+                self.snapshot.pop(service_name, None)
+                continue
+
+            try:
+                index, nodes = yield vergilius.consul_tornado_requests.health.service(
+                        service.id, passing=service.get_passing_filter())
+                service.parse_data(nodes)
+            except (ConsulException, base.Timeout) as e:
+                # keep previous state, so service is refreshed on next wake up
+                vergilius.logger.error('[health watcher][%s]: failed to refresh: %s' % (service_name, e))
+                continue
+
+            if service_name in snapshot:
+                self.snapshot[service_name] = snapshot[service_name]
+            else:
+                self.snapshot.pop(service_name, None)
+
+    @classmethod
+    def build_snapshot(cls, checks):
+        """
+        Reduce checks list to per service state. Node level checks (like serfHealth) are
+        attached to every service on that node.
+        :type checks: list
+        :rtype: dict
+        """
+        node_checks = {}
+        service_checks = {}
+
+        for check in checks or []:
+            if check[u'ServiceName']:
+                service_checks.setdefault(check[u'ServiceName'], set()).add(
+                        (check[u'Node'], check[u'ServiceID'], check[u'CheckID'], check[u'Status']))
+            else:
+                node_checks.setdefault(check[u'Node'], set()).add(
+                        (check[u'Node'], u'', check[u'CheckID'], check[u'Status']))
+
+        snapshot = {}
+        for service_name, state in service_checks.items():
+            for node in set(item[0] for item in state):
+                state = state | node_checks.get(node, set())
+            snapshot[service_name] = frozenset(state)
+
+        return snapshot
+
+    @classmethod
+    def diff(cls, previous, current):
+        """
+        :rtype: set - names of services with changed state
+        """
+        return set(name for name in set(previous) | set(current) if previous.get(name) != current.get(name))
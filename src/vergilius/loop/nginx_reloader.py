@@ -1,8 +1,13 @@
-import subprocess
+import time
 from consul import tornado
+from tornado import gen, process
 from tornado.locks import Event
 
 import vergilius
+from vergilius.components.metrics import Histogram
+
+reload_duration = Histogram('vergilius_nginx_reload_duration_seconds', 'nginx reload duration')
+event_to_reload = Histogram('vergilius_event_to_reload_seconds', 'Time from config change to finished nginx reload')
 
 try:
     from subprocess import DEVNULL  # py3k
@@ -12,8 +17,17 @@ except ImportError:
 
 
 class NginxReloader(object):
+    """
+    Coalesces config changes into nginx reloads. Reload starts after quiet period with no changes,
+    but not later than max delay after first change and not earlier than min interval after previous reload.
+    """
     nginx_update_event = Event()
 
+    pending_changes = 0
+    first_change = None
+    last_change = None
+    last_reload = 0
+
     def __init__(self):
         pass
 
@@ -22,10 +36,56 @@ class NginxReloader(object):
     def nginx_reload(cls):
         while True:
             yield cls.nginx_update_event.wait()
+
+            delay = cls.get_reload_delay(time.time())
+            while delay > 0:
+                yield gen.sleep(delay)
+                delay = cls.get_reload_delay(time.time())
+
             cls.nginx_update_event.clear()
-            vergilius.logger.info('[nginx]: reload')
-            subprocess.check_call([vergilius.config.NGINX_BINARY, '-s', 'reload'], stdout=DEVNULL)
+            changes = cls.pending_changes
+            first_change = cls.first_change
+            cls.pending_changes = 0
+            cls.first_change = None
+
+            yield cls.reload(changes)
+            event_to_reload.observe(time.time() - first_change)
+
+    @classmethod
+    @tornado.gen.coroutine
+    def reload(cls, changes):
+        vergilius.logger.info('[nginx]: reload, absorbed %s changes' % changes)
+        cls.last_reload = time.time()
+
+        try:
+            vergilius.host_routing.flush()
+        except Exception as e:
+            vergilius.logger.error('[nginx]: routing flush failed: %s' % e)
+
+        with reload_duration.time():
+            proc = process.Subprocess([vergilius.config.NGINX_BINARY, '-s', 'reload'], stdout=DEVNULL)
+            return_code = yield proc.wait_for_exit(raise_error=False)
+        if return_code != 0:
+            vergilius.logger.error('[nginx]: reload failed with code %s' % return_code)
+
+    @classmethod
+    def get_reload_delay(cls, now):
+        """
+        :return: seconds to wait before reload, 0 when reload should start now
+        """
+        if cls.first_change is None:
+            return 0
+
+        delay = min(cls.last_change + vergilius.config.NGINX_RELOAD_QUIET_PERIOD,
+                    cls.first_change + vergilius.config.NGINX_RELOAD_MAX_DELAY) - now
+        delay = max(delay, cls.last_reload + vergilius.config.NGINX_RELOAD_MIN_INTERVAL - now)
+        return max(delay, 0)
 
     @classmethod
     def queue_reload(cls):
+        now = time.time()
+        if cls.first_change is None:
+            cls.first_change = now
+        cls.last_change = now
+        cls.pending_changes += 1
         cls.nginx_update_event.set()
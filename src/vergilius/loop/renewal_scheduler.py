@@ -0,0 +1,110 @@
+import datetime
+import heapq
+import itertools
+import random
+import time
+
+from consul import tornado
+from tornado import ioloop
+
+import vergilius
+from vergilius.components.metrics import Gauge
+
+next_renewal = Gauge('vergilius_certificate_next_renewal_seconds', 'Seconds until next certificate renewal')
+
+
+class RenewalScheduler(object):
+    """
+    Renews certificates ahead of expiry. Certificates are kept in min-heap by renewal time,
+    single IOLoop timer is set for the nearest one.
+    """
+    heap = []
+    entries = {}
+    counter = itertools.count()
+    timeout = None
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    def schedule(cls, certificate, renew_at=None):
+        """
+        :type renew_at: float - timestamp, by default renewal lead time with jitter before expiry
+        """
+        if renew_at is None:
+            renew_at = int(certificate.expires) - vergilius.config.CERTIFICATE_RENEWAL_LEAD_TIME - \
+                       random.uniform(0, vergilius.config.CERTIFICATE_RENEWAL_JITTER)
+
+        cls.unschedule(certificate)
+        entry = [renew_at, next(cls.counter), certificate]
+        cls.entries[certificate.service.id] = entry
+        heapq.heappush(cls.heap, entry)
+        cls.reset_timer()
+
+    @classmethod
+    def unschedule(cls, certificate):
+        entry = cls.entries.get(certificate.service.id)
+        if entry and entry[2] is certificate:
+            # removed lazily, when entry gets to heap top
+            entry[2] = None
+            del cls.entries[certificate.service.id]
+
+        # deleted services would leave far in future entries behind, heap is compacted when they prevail
+        if len(cls.heap) > 2 * len(cls.entries) + 64:
+            cls.heap = [entry for entry in cls.heap if entry[2] is not None]
+            heapq.heapify(cls.heap)
+
+    @classmethod
+    def get_next_renewal(cls):
+        while cls.heap and cls.heap[0][2] is None:
+            heapq.heappop(cls.heap)
+        return cls.heap[0][0] if cls.heap else None
+
+    @classmethod
+    def get_seconds_until_next_renewal(cls):
+        renew_at = cls.get_next_renewal()
+        return max(renew_at - time.time(), 0) if renew_at is not None else 0
+
+    @classmethod
+    def reset_timer(cls):
+        io_loop = ioloop.IOLoop.instance()
+        if cls.timeout:
+            io_loop.remove_timeout(cls.timeout)
+            cls.timeout = None
+
+        renew_at = cls.get_next_renewal()
+        if renew_at is not None:
+            cls.timeout = io_loop.add_timeout(datetime.timedelta(seconds=max(renew_at - time.time(), 0)), cls.run)
+
+    @classmethod
+    def run(cls):
+        cls.timeout = None
+        now = time.time()
+
+        while cls.get_next_renewal() is not None and cls.heap[0][0] <= now:
+            entry = heapq.heappop(cls.heap)
+            certificate = entry[2]
+            # services with colliding ids share entries key, it may belong to other certificate
+            if cls.entries.get(certificate.service.id) is entry:
+                del cls.entries[certificate.service.id]
+            ioloop.IOLoop.instance().add_future(cls.renew(certificate), lambda f: f.result())
+
+        cls.reset_timer()
+
+    @classmethod
+    @tornado.gen.coroutine
+    def renew(cls, certificate):
+        vergilius.logger.info('[renewal][%s]: renewing certificate, expires at %s' %
+                              (certificate.service.id, certificate.expires))
+        try:
+            renewed = yield certificate.renew()
+        except Exception as e:
+            vergilius.logger.error('[renewal][%s]: %s' % (certificate.service.id, e))
+            renewed = False
+
+        if not renewed and certificate.active and certificate.service.id not in cls.entries:
+            # another gateway may hold the lock, its keys reschedule certificate when they arrive
+            cls.schedule(certificate, time.time() + vergilius.config.CERTIFICATE_RENEWAL_RETRY)
+
+
+next_renewal.set_function(RenewalScheduler.get_seconds_until_next_renewal)
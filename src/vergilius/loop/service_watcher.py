@@ -1,8 +1,14 @@
-import vergilius
+from tornado import ioloop
 
-from consul import tornado, base
+import vergilius
+from vergilius.components.consul_watch import ConsulWatch
+from vergilius.components.metrics import Gauge
+from vergilius.loop.nginx_reloader import NginxReloader
 from vergilius.models.service import Service
 
+services_count = Gauge('vergilius_services', 'Routed services')
+nodes_count = Gauge('vergilius_nodes', 'Healthy nodes of routed services')
+
 
 class ServiceWatcher(object):
     def __init__(self):
@@ -10,28 +16,52 @@ class ServiceWatcher(object):
 
         self.data = {}
         self.modified = False
+        # configs restored from previous run are pruned once catalog is known
+        self.synced = False
+
+        services_count.set_function(lambda: len(self.services))
+        nodes_count.set_function(lambda: sum(len(service.nodes) for service in self.services.values()))
 
-    @tornado.gen.coroutine
     def watch_services(self):
-        index = None
-        while True:
-            try:
-                index, data = yield vergilius.consul_tornado.catalog.services(index, wait=None)
-                self.check_services(data)
-            except base.Timeout:
-                pass
+        return ConsulWatch('services', vergilius.consul_tornado.catalog.services, self.check_services).run()
 
     def check_services(self, data):
+        health_mode = vergilius.config.DISCOVERY_MODE == 'health'
+
         # check if service has any of our tags
         services_to_publish = dict(
                 (k, v) for k, v in data.items() if any(x in v for x in [u'http', u'http2', u'tcp', u'udp']))
         for service_name in services_to_publish:
             if service_name not in self.services:
                 vergilius.logger.info('[service watcher]: new service: %s' % service_name)
-                self.services[service_name] = Service(service_name)
+                self.services[service_name] = Service(service_name, watch=not health_mode)
+            elif health_mode and self.data.get(service_name) != data[service_name]:
+                # tags changes are not visible in health state, refresh service explicitly
+                vergilius.logger.info('[service watcher]: service tags changed: %s' % service_name)
+                self.services[service_name].fetch()
 
         # cleanup stale services
         for service_name in self.services.keys():
             if service_name not in services_to_publish.iterkeys():
                 vergilius.logger.info('[service watcher]: removing stale service: %s' % service_name)
-                del self.services[service_name]
+                ioloop.IOLoop.current().add_future(self.services.pop(service_name).shutdown(),
+                                                   lambda f: f.result())
+
+        if not self.synced:
+            self.synced = True
+            self.prune_restored()
+
+        self.data = data
+
+    def prune_restored(self):
+        """
+        Drop configs of services deregistered while gateway was down, only services it knows are removed otherwise
+        """
+        service_ids = set(service.id for service in self.services.values())
+        has_changes = vergilius.host_routing.prune(service_ids)
+        if vergilius.config_shards:
+            has_changes = vergilius.config_shards.prune(service_ids) or has_changes
+
+        if has_changes:
+            vergilius.logger.info('[service watcher]: pruned configs of services gone from catalog')
+            NginxReloader.queue_reload()
@@ -0,0 +1,173 @@
+import base64
+import datetime
+import functools
+import hashlib
+import json
+import os
+import random
+import tempfile
+import time
+
+from consul import tornado
+from tornado import ioloop
+
+import vergilius
+from vergilius.components.consul_watch import ConsulWatch
+from vergilius.components.metrics import Counter
+from vergilius.loop.nginx_reloader import NginxReloader
+
+TICKET_KEYS_KEY = 'vergilius/ticket_keys'
+TICKETS_FILE = 'vergilius.tickets.conf'
+# aes256 session ticket key, nginx 1.11.8+
+TICKET_KEY_SIZE = 80
+# seconds before failed rotation is retried
+ROTATION_RETRY = 60
+
+rotations_total = Counter('vergilius_ticket_key_rotations_total', 'TLS session ticket key rotations', ('result',))
+
+
+class TicketKeyWatcher(object):
+    """
+    Keeps TLS session ticket keys shared by all gateways in consul, newest first, and writes them for
+    `ssl_session_ticket_key`. Any gateway may rotate keys when they get old, consul check-and-set lets only one
+    rotation through. Newest key is staged: gateways load it for decryption only and encrypt with it after next
+    rotation, so tickets issued by any gateway are accepted by all others whatever order they reload in.
+    """
+    keys = None
+    timeout = None
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    def watch_ticket_keys(cls):
+        return ConsulWatch('ticket_keys', functools.partial(vergilius.consul_tornado.kv.get, TICKET_KEYS_KEY),
+                           cls.check_keys).run()
+
+    @classmethod
+    def check_keys(cls, data):
+        """
+        :type data: dict - consul kv item of ticket keys, None if keys are not generated yet
+        """
+        rotated = 0
+        if data:
+            try:
+                value = json.loads(data['Value'])
+                keys, rotated = value['keys'], value['rotated']
+            except (TypeError, ValueError, KeyError):
+                vergilius.logger.error('[ticket keys]: malformed ticket keys, replaced on rotation')
+            else:
+                if keys != cls.keys:
+                    cls.write_keys(keys)
+                    cls.keys = keys
+
+        # gateways do not race for rotation all at once, check-and-set settles it anyway
+        cls.schedule_rotation(rotated + vergilius.config.TLS_TICKET_KEY_ROTATION +
+                              random.uniform(0, min(60, vergilius.config.TLS_TICKET_KEY_ROTATION / 10.0)))
+
+    @classmethod
+    def schedule_rotation(cls, rotate_at):
+        io_loop = ioloop.IOLoop.instance()
+        if cls.timeout:
+            io_loop.remove_timeout(cls.timeout)
+        cls.timeout = io_loop.add_timeout(datetime.timedelta(seconds=max(rotate_at - time.time(), 0)), cls.run)
+
+    @classmethod
+    def run(cls):
+        cls.timeout = None
+        ioloop.IOLoop.instance().add_future(cls.rotate(), lambda f: f.result())
+
+    @classmethod
+    @tornado.gen.coroutine
+    def rotate(cls):
+        """
+        Put new staged key in front of current keys, if nobody changed them since they were read
+        :rtype: bool
+        """
+        try:
+            index, data = yield vergilius.consul_tornado_requests.kv.get(TICKET_KEYS_KEY, consistency='consistent')
+            keys = []
+            if data:
+                try:
+                    keys = json.loads(data['Value'])['keys']
+                except (TypeError, ValueError, KeyError):
+                    pass
+
+            keys = [cls.generate_key()] + keys[:vergilius.config.TLS_TICKET_KEYS - 1]
+            rotated = yield vergilius.consul_tornado_requests.kv.put(
+                    TICKET_KEYS_KEY, json.dumps({'keys': keys, 'rotated': int(time.time())}),
+                    cas=data['ModifyIndex'] if data else 0)
+        except Exception as e:
+            vergilius.logger.error('[ticket keys]: rotation failed: %s' % e)
+            rotations_total.inc(result='failure')
+            cls.schedule_rotation(time.time() + ROTATION_RETRY)
+            raise tornado.gen.Return(False)
+
+        if rotated:
+            vergilius.logger.info('[ticket keys]: rotated ticket keys')
+        rotations_total.inc(result='success' if rotated else 'conflict')
+        # changed keys, own or of other gateway, are delivered by watch and reschedule rotation
+        raise tornado.gen.Return(rotated)
+
+    @classmethod
+    def generate_key(cls):
+        return base64.b64encode(os.urandom(TICKET_KEY_SIZE))
+
+    @classmethod
+    def get_path(cls):
+        return os.path.join(vergilius.config.NGINX_CONFIG_PATH, 'tickets')
+
+    @classmethod
+    def get_ordered_keys(cls, keys):
+        """
+        Current key encrypts new tickets, so it goes first, staged and previous keys only decrypt
+        :type keys: list - newest first
+        """
+        return keys[1:2] + keys[:1] + keys[2:]
+
+    @classmethod
+    def write_keys(cls, keys):
+        """
+        Write key files named by key digest and nginx config referencing them, queue reload if it changed
+        """
+        path = cls.get_path()
+        if not os.path.exists(path):
+            os.mkdir(path, 0o700)
+
+        key_paths = []
+        for key in cls.get_ordered_keys(keys):
+            key_data = base64.b64decode(key)
+            key_path = os.path.join(path, '%s.key' % hashlib.sha1(key_data).hexdigest()[:16])
+            if not os.path.exists(key_path):
+                cls.write_file(key_path, key_data, 0o600)
+            key_paths.append(key_path)
+
+        config_path = os.path.join(vergilius.config.NGINX_CONFIG_PATH, TICKETS_FILE)
+        content = vergilius.template_loader.load('tickets.html').generate(key_paths=key_paths)
+        try:
+            with open(config_path, 'r') as config_file:
+                changed = config_file.read() != content
+        except IOError:
+            changed = True
+
+        if changed:
+            cls.write_file(config_path, content, 0o644)
+            vergilius.logger.info('[ticket keys]: got new ticket keys')
+            NginxReloader.queue_reload()
+
+        for file_name in os.listdir(path):
+            if os.path.join(path, file_name) not in key_paths:
+                os.remove(os.path.join(path, file_name))
+
+    @classmethod
+    def write_file(cls, path, content, mode):
+        temp_file = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.tickets', suffix='.tmp',
+                                                delete=False)
+        try:
+            os.chmod(temp_file.name, mode)
+            temp_file.write(content)
+            temp_file.close()
+            os.rename(temp_file.name, path)
+        except Exception:
+            os.remove(temp_file.name)
+            raise
@@ -1,14 +1,17 @@
+import hashlib
 import os
 import time
 from tornado import ioloop
 
-from consul import tornado, base
-from vergilius import consul, logger, certificate_provider, config
+from consul import tornado
+from vergilius import consul, logger, certificate_issuer, config
+from vergilius.components.consul_txn import Transaction
+from vergilius.loop.certificate_watcher import CertificateWatcher
+from vergilius.loop.nginx_reloader import NginxReloader
+from vergilius.loop.renewal_scheduler import RenewalScheduler
 
 
 class Certificate(object):
-    tc = tornado.Consul(host=config.CONSUL_HOST)
-
     def __init__(self, service, domains):
         """
         :type domains: set
@@ -22,54 +25,65 @@ class Certificate(object):
 
         self.private_key = None
         self.public_key = None
+        self.files_digest = None
 
         self.active = True
-        self.lock_session_id = None
+        self.loading = None
+        # request in flight, shared by concurrent callers so lock is taken once
+        self.requesting = None
 
         if not os.path.exists(os.path.join(config.NGINX_CONFIG_PATH, 'certs')):
             os.mkdir(os.path.join(config.NGINX_CONFIG_PATH, 'certs'))
 
-        ioloop.IOLoop.instance().add_callback(self.unlock)
-        self.fetch()
-        self.watch()
+        # changes are delivered by CertificateWatcher, initial keys are taken from its snapshot when available
+        data = CertificateWatcher.register(self)
+        if data is None:
+            self.fetch()
+        else:
+            self.loading = self.load_keys_from_consul(data)
 
     def fetch(self):
         index, data = consul.kv.get('vergilius/certificates/%s/' % self.service.id, recurse=True)
-        self.load_keys_from_consul(data)
+        self.loading = self.load_keys_from_consul(data)
 
     @tornado.gen.coroutine
-    def watch(self):
-        index = None
-        while True and self.active:
-            try:
-                index, data = \
-                    yield self.tc.kv.get('vergilius/certificates/%s/' % self.service.id, index=index, recurse=True)
-                self.load_keys_from_consul(data)
-            except base.Timeout:
-                pass
-
     def load_keys_from_consul(self, data=None):
         if data:
             for item in data:
                 key = item['Key'].replace('vergilius/certificates/%s/' % self.service.id, '')
-                if hasattr(self, key):
+                if hasattr(self, key) and not callable(getattr(self, key)):
                     setattr(self, key, item['Value'])
 
             if not self.validate():
                 logger.warn('[certificate][%s]: cant validate existing keys' % self.service.id)
                 self.discard_certificate()
-                if not self.request_certificate():
-                    return False
+                if not (yield self.request_certificate()):
+                    raise tornado.gen.Return(False)
             else:
                 logger.debug('[certificate][%s]: using existing keys' % self.service.id)
         else:
-            if not self.request_certificate():
-                return False
+            if not (yield self.request_certificate()):
+                raise tornado.gen.Return(False)
+
+        # service was deleted while certificate was requested
+        if not self.active:
+            raise tornado.gen.Return(False)
 
         self.write_certificate_files()
-        return True
+        RenewalScheduler.schedule(self)
+        # keys may arrive after service config was rendered without them
+        ioloop.IOLoop.instance().add_callback(self.service.flush_nginx_config)
+        raise tornado.gen.Return(True)
 
     def write_certificate_files(self):
+        """
+        Write keys if they differ from already written ones, reload nginx if it could use old ones
+        :return: bool - files changed
+        """
+        digest = hashlib.sha1('%s\0%s' % (self.private_key, self.public_key)).hexdigest()
+        if digest == self.files_digest:
+            return False
+
         key_file = open(self.get_key_path(), 'w+')
         key_file.write(self.private_key)
         key_file.close()
@@ -78,7 +92,15 @@ class Certificate(object):
         pem_file.write(self.public_key)
         pem_file.close()
 
+        if self.files_digest:
+            NginxReloader.queue_reload()
+            logger.info('[certificate][%s]: keys changed' % self.service.id)
+
+        self.files_digest = digest
+        return True
+
     def delete_certificate_files(self):
+        self.files_digest = None
         if os.path.exists(self.get_key_path()):
             os.remove(self.get_key_path())
         if os.path.exists(self.get_cert_path()):
@@ -93,49 +115,133 @@ class Certificate(object):
     def lock(self):
         """
         Create a lock in consul to prevent certificate request race condition
+        :return: string - session holding the lock, None if lock is held by other session
         """
-        self.lock_session_id = consul.session.create(behavior='delete')
-        return consul.kv.put('vergilius/certificates/%s/lock' % self.service.id, '', acquire=self.lock_session_id)
-
-    def unlock(self):
-        if not self.lock_session_id:
-            return
+        session_id = consul.session.create(behavior='delete')
+        acquired = False
+        try:
+            acquired = consul.kv.put('vergilius/certificates/%s/lock' % self.service.id, '', acquire=session_id)
+        finally:
+            # session without lock would never be destroyed
+            if not acquired:
+                consul.session.destroy(session_id)
+        return session_id if acquired else None
 
-        consul.kv.put('vergilius/certificates/%s/lock' % self.service.id, '', release=self.lock_session_id)
-        consul.session.destroy(self.lock_session_id)
-        self.lock_session_id = None
+    def unlock(self, session_id):
+        consul.kv.put('vergilius/certificates/%s/lock' % self.service.id, '', release=session_id)
+        consul.session.destroy(session_id)
 
     def request_certificate(self):
+        """
+        Request new keys, callers arriving while request is in flight get the same future
+        :rtype: Future - bool, keys saved
+        """
+        if self.requesting is None or self.requesting.done():
+            self.requesting = self.request_certificate_locked()
+        return self.requesting
+
+    @tornado.gen.coroutine
+    def request_certificate_locked(self):
         logger.debug('[certificate][%s] Requesting new keys for %s ' % (self.service.name, self.domains))
 
-        if not self.lock():
+        session_id = self.lock()
+        if not session_id:
             logger.debug('[certificate][%s] failed to acquire lock for keys generation' % self.service.name)
-            return False
+            raise tornado.gen.Return(False)
 
         try:
-            data = certificate_provider.get_certificate(self.service.id, self.domains)
+            # lock holder releases it after keys are saved, they are issued at most once per renewal
+            committed = self.load_issued_keys()
+            if committed:
+                logger.info('[certificate][%s]: keys were issued by other gateway' % self.service.name)
+            else:
+                committed = yield self.issue_certificate(session_id)
+
+            # keys are kept in consul for other gateways, files are not needed if service was deleted
+            if committed and self.active:
+                self.write_certificate_files()
+        except Exception as e:
+            logger.error(e)
+            raise e
+        finally:
+            self.unlock(session_id)
+
+        raise tornado.gen.Return(committed)
 
+    def load_issued_keys(self):
+        """
+        Take keys other gateway issued while lock was held by it, read through leader
+        :return: bool - keys newer than current ones were loaded
+        """
+        prefix = 'vergilius/certificates/%s/' % self.service.id
+        index, data = consul.kv.get(prefix, recurse=True, consistency='consistent')
+        keys = dict((item['Key'].replace(prefix, ''), item['Value']) for item in data or [])
+
+        if not keys.get('private_key') or not keys.get('public_key') or not (keys.get('expires') or '').isdigit():
+            return False
+        # current keys are still valid on renewal, only newer ones save issuance
+        if int(keys['expires']) <= max(int(self.expires or 0), int(time.time())) or \
+                keys.get('key_domains') != self.serialize_domains():
+            return False
+
+        self.private_key = keys['private_key']
+        self.public_key = keys['public_key']
+        self.expires = keys['expires']
+        self.key_domains = keys['key_domains']
+        return True
+
+    @tornado.gen.coroutine
+    def issue_certificate(self, session_id):
+        """
+        Issue keys with provider and save them in consul while lock is held
+        :type session_id: string - session holding certificate lock
+        :return: bool - keys saved
+        """
+        data = yield certificate_issuer.get_certificate_async(self.service.id, self.domains)
+
+        if 'private_key_pem' in data:
+            self.private_key = data['private_key_pem']
+            self.public_key = data['public_key_pem']
+        else:
             with open(data['private_key'], 'r') as f:
                 self.private_key = f.read()
                 f.close()
-                consul.kv.put('vergilius/certificates/%s/private_key' % self.service.id, self.private_key)
 
             with open(data['public_key'], 'r') as f:
                 self.public_key = f.read()
                 f.close()
-                consul.kv.put('vergilius/certificates/%s/public_key' % self.service.id, self.public_key)
 
-            self.expires = data['expires']
-            self.key_domains = self.serialize_domains()
-            consul.kv.put('vergilius/certificates/%s/expires' % self.service.id, str(self.expires))
-            consul.kv.put('vergilius/certificates/%s/key_domains' % self.service.id, self.serialize_domains())
+        self.expires = data['expires']
+        self.key_domains = self.serialize_domains()
+
+        # other gateways should never see new key with old expiry or domains
+        prefix = 'vergilius/certificates/%s/' % self.service.id
+        committed = Transaction(consul) \
+            .check_session(prefix + 'lock', session_id) \
+            .set(prefix + 'private_key', self.private_key) \
+            .set(prefix + 'public_key', self.public_key) \
+            .set(prefix + 'expires', str(self.expires)) \
+            .set(prefix + 'key_domains', self.key_domains) \
+            .commit()
+        if committed:
             logger.info('[certificate][%s]: got new keys for %s ' % (self.service.name, self.domains))
-            self.write_certificate_files()
-        except Exception as e:
-            logger.error(e)
-            raise e
-        finally:
-            self.unlock()
+        else:
+            logger.error('[certificate][%s]: lost lock, new keys are not saved' % self.service.name)
+        raise tornado.gen.Return(committed)
+
+    @tornado.gen.coroutine
+    def renew(self):
+        """
+        Issue new keys ahead of expiry
+        :return: bool - keys renewed by this gateway
+        """
+        if not self.active:
+            raise tornado.gen.Return(False)
+
+        renewed = yield self.request_certificate()
+        if renewed:
+            RenewalScheduler.schedule(self)
+        raise tornado.gen.Return(renewed)
 
     def serialize_domains(self):
         return '|'.join(sorted(self.domains))
@@ -159,6 +265,8 @@ class Certificate(object):
 
         return True
 
-    def __del__(self):
+    def delete(self):
         self.active = False
+        CertificateWatcher.unregister(self)
+        RenewalScheduler.unschedule(self)
         self.delete_certificate_files()
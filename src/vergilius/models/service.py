@@ -1,30 +1,58 @@
+import functools
+import hashlib
+import json
 import os
 import re
 import subprocess
 import tempfile
 import unicodedata
 
-import itertools
-from consul import tornado, base, ConsulException
+from consul import tornado
+from tornado.locks import Lock
 from shutil import rmtree
 
-from vergilius import config, consul_tornado, consul, logger, template_loader
+from vergilius import config, config_shards, consul_tornado, consul, host_routing, logger, template_loader, \
+    upstream_backend
 from vergilius.components import port_allocator
+from vergilius.components.consul_watch import ConsulWatch
+from vergilius.components.metrics import Histogram
+from vergilius.loop.config_validator import CONFIG_TYPES, ConfigValidator, nginx_test_duration
 from vergilius.loop.nginx_reloader import NginxReloader
 from vergilius.models.certificate import Certificate
 
+# nginx time value, like 30s
+TIME_PATTERN = re.compile(r'^\d+(ms|s|m|h)?$')
+# nginx size value, like 100m
+SIZE_PATTERN = re.compile(r'^\d+[kmg]?$', re.IGNORECASE)
+# hash key without whitespace or nginx syntax characters, like $remote_addr$request_uri
+HASH_KEY_PATTERN = re.compile(r'^[^\s;{}\'"]+$')
+# consul check interval, like 10s or 1m30s
+DURATION_PATTERN = re.compile(r'^(\d+(h|m|s|ms))+$')
+# server parameters from service tags and node meta, like weight:5 tag or vergilius_weight node meta,
+# slow_start is nginx plus only
+SERVER_PARAMS = [('weight', re.compile(r'^\d+$')), ('max_fails', re.compile(r'^\d+$')), ('fail_timeout', TIME_PATTERN),
+                 ('slow_start', TIME_PATTERN)]
+
+render_duration = Histogram('vergilius_render_duration_seconds', 'Config render duration', ('config_type',))
+
 
 class Service(object):
-    def __init__(self, name):
+    def __init__(self, name, watch=True):
         """
         :type name: unicode - service name got from consul
+        :type watch: bool - start own health watch, disable when health is watched for the whole catalog
         """
         self.name = name
         self.id = self.slugify(name)
         logger.info('[service][%s]: new and loading' % self.name)
         self.allow_crossdomain = False
+        self.balance, self.hash_key = self.parse_balance(config.UPSTREAM_BALANCE)
+        self.keepalive = config.UPSTREAM_KEEPALIVE
+        self.keepalive_timeout = config.UPSTREAM_KEEPALIVE_TIMEOUT
+        self.cache = None
         self.nodes = {}
         self.port = None
+        self.pinned_port = None
         self.binds = {
             u'http': set(),
             u'http2': set(),
@@ -34,28 +62,31 @@ class Service(object):
 
         self.active = True
         self.certificate = None
+        self.watcher = None
+
+        # render cache, keyed by routing state fingerprint
+        self.rendered_fingerprint = None
+        self.rendered_configs = {}
+        self.deployed_fingerprint = None
+        self.deployed_digests = {}
+        self.upstream_lock = Lock()
 
         if not os.path.exists(config.NGINX_CONFIG_PATH):
             os.mkdir(config.NGINX_CONFIG_PATH)
 
         self.fetch()
-        self.watch()
+        if watch:
+            self.watch()
 
     def fetch(self):
-        index, data = consul.health.service(self.id, passing=True)
+        index, data = consul.health.service(self.id, passing=self.get_passing_filter())
         self.parse_data(data)
 
-    @tornado.gen.coroutine
     def watch(self):
-        index = None
-        while True and self.active:
-            try:
-                index, data = yield consul_tornado.health.service(self.id, index, wait=None, passing=True)
-                self.parse_data(data)
-            except ConsulException as e:
-                logger.error('consul exception: %s' % e)
-            except base.Timeout:
-                pass
+        self.watcher = ConsulWatch('service', functools.partial(consul_tornado.health.service, self.id,
+                                                                passing=self.get_passing_filter()),
+                                   self.parse_data, lambda: self.active)
+        return self.watcher.run()
 
     def parse_data(self, data):
         """
@@ -66,6 +97,12 @@ class Service(object):
             self.binds[protocol].clear()
 
         allow_crossdomain = False
+        pinned_port = None
+        balance, hash_key = self.parse_balance(config.UPSTREAM_BALANCE)
+        keepalive = config.UPSTREAM_KEEPALIVE
+        keepalive_timeout = config.UPSTREAM_KEEPALIVE_TIMEOUT
+        cache = None
+        warning_nodes = set()
         self.nodes = {}
         for node in data:
             if not node[u'Service'][u'Port']:
@@ -76,10 +113,20 @@ class Service(object):
                 logger.warn('[service][%s]: Node %s is ignored due no Service Tags' % (self.id, node[u'Node'][u'Node']))
                 continue
 
+            status = self.get_node_status(node.get(u'Checks'))
+            if status == 'critical' or (status == 'warning' and config.WARNING_NODES == 'exclude'):
+                continue
+            if status == 'warning':
+                warning_nodes.add(node['Node']['Node'])
+
+            check_params = self.get_check_params(node.get(u'Checks')) if config.PASSIVE_HEALTH else {}
+
             self.nodes[node['Node']['Node']] = {
                 'port': node[u'Service'][u'Port'],
                 'address': node[u'Service'][u'Address'] or node[u'Node'][u'Address'],
                 'tags': node[u'Service'][u'Tags'],
+                'params': self.parse_server_params(node[u'Service'][u'Tags'], node[u'Node'].get(u'Meta') or {}),
+                'check_params': check_params,
             }
 
             if u'allow_crossdomain' in node[u'Service'][u'Tags']:
@@ -93,9 +140,46 @@ class Service(object):
                     )
 
             for protocol in ['tcp', 'udp']:
-                self.binds[protocol].update({node[u'Service'][u'Port']})
+                if protocol in node[u'Service'][u'Tags']:
+                    self.binds[protocol].update({node[u'Service'][u'Port']})
+
+            for tag in node[u'Service'][u'Tags']:
+                if tag.startswith('port:') and tag[5:].isdigit():
+                    if config.PROXY_PORTS[0] <= int(tag[5:]) < config.PROXY_PORTS[1]:
+                        pinned_port = int(tag[5:])
+                    else:
+                        logger.warn('[service][%s]: pinned port %s is out of PROXY_PORTS range, ignored' %
+                                    (self.id, tag[5:]))
+
+                if tag.startswith('balance:') and self.parse_balance(tag[8:])[0]:
+                    balance, hash_key = self.parse_balance(tag[8:])
+
+                if tag.startswith('keepalive:') and tag[10:].isdigit():
+                    keepalive = int(tag[10:])
+
+                if tag.startswith('keepalive_timeout:') and TIME_PATTERN.match(tag[18:]):
+                    keepalive_timeout = tag[18:]
+
+                if tag.startswith('cache:') and self.parse_cache(tag[6:]):
+                    cache = self.parse_cache(tag[6:])
 
         self.allow_crossdomain = allow_crossdomain
+        self.balance = balance
+        self.hash_key = hash_key
+        self.keepalive = keepalive
+        self.keepalive_timeout = keepalive_timeout
+        self.cache = cache
+        self.demote_nodes(warning_nodes)
+
+        if pinned_port != self.pinned_port:
+            self.pinned_port = pinned_port
+            if self.port and pinned_port and pinned_port != self.port:
+                self.release_port()
+
+        # claim left by http service or by dropped tcp/udp tags, containers of any health tell current tags
+        if data and not any(protocol in (node[u'Service'][u'Tags'] or []) for node in data
+                            for protocol in (u'tcp', u'udp')):
+            self.release_port()
 
         self.flush_nginx_config()
 
@@ -110,34 +194,291 @@ class Service(object):
         if config_type in ['tcp', 'udp']:
             self.check_port()
 
-        return template_loader.load('service_%s.html' % config_type).generate(service=self, config=config)
+        with render_duration.time(config_type=config_type):
+            if config_type == 'stream_upstream':
+                return template_loader.load('service_upstream.html').generate(service=self, config=config,
+                                                                              stream=True)
+
+            return template_loader.load('service_%s.html' % config_type).generate(service=self, config=config,
+                                                                                  stream=False)
+
+    def get_fingerprint(self):
+        """
+        Stable digests of state templates depend on: routing (listeners, servers, certificates)
+        and upstream membership, so membership only changes can be told apart
+        :rtype: tuple
+        """
+        state = {
+            'binds': dict((protocol, sorted(binds)) for protocol, binds in self.binds.items()),
+            'allow_crossdomain': self.allow_crossdomain,
+            'balance': [self.balance, self.hash_key],
+            'keepalive': [self.keepalive, self.keepalive_timeout],
+            'cache': self.cache,
+            # runtime upstream updates do not carry server parameters, so nodes with them are part of routing,
+            # warning nodes demoted to backup or lower weight too
+            'server_params': sorted([self.get_server(node), node.get('params')] for node in self.nodes.values()
+                                    if node.get('params')),
+            # check derived ones are the same for containers of service, added container gets them on next reload
+            'check_params': sorted(set(json.dumps(node.get('check_params'), sort_keys=True)
+                                       for node in self.nodes.values() if node.get('check_params'))),
+            'port': self.port,
+            'certificate': None,
+            # empty upstream is rendered with backup server
+            'has_nodes': bool(self.nodes),
+        }
+
+        if self.certificate:
+            state['certificate'] = [self.certificate.get_key_path(), self.certificate.get_cert_path(),
+                                    bool(self.certificate.private_key and self.certificate.public_key)]
+
+        return (hashlib.sha1(json.dumps(state, sort_keys=True)).hexdigest(),
+                hashlib.sha1(json.dumps(self.nodes, sort_keys=True)).hexdigest())
+
+    def get_upstream_servers(self):
+        return set(self.get_server(node) for node in self.nodes.values())
+
+    @classmethod
+    def get_server(cls, node):
+        return '%s:%s' % (node['address'], node['port'])
+
+    def format_server_params(self, node):
+        """
+        :rtype: string - nginx server parameters, like ' weight=5 max_fails=3'
+        """
+        # tags take precedence over check derived params
+        params = dict(node.get('check_params') or {}, **(node.get('params') or {}))
+        skipped = set()
+        if config.UPSTREAM_BACKEND != 'api' or self.balance in ('hash', 'random'):
+            skipped.add('slow_start')
+
+        return ''.join(' %s=%s' % (name, params[name]) for name, pattern in SERVER_PARAMS
+                       if name in params and name not in skipped) + (' backup' if params.get('backup') else '')
+
+    def get_passing_filter(self):
+        """
+        Critical nodes are skipped by parse_data, consul filters out non passing nodes only when warning ones
+        are not routed either
+        """
+        return config.WARNING_NODES == 'exclude'
+
+    @classmethod
+    def get_node_status(cls, checks):
+        """
+        :type checks: list - node and service checks of health entry
+        :rtype: string - passing, warning or critical, worst of checks
+        """
+        statuses = set(check.get(u'Status') for check in checks or [])
+        if statuses & {u'critical', u'maintenance'}:
+            return 'critical'
+        if u'warning' in statuses:
+            return 'warning'
+        return 'passing'
+
+    @classmethod
+    def get_check_params(cls, checks):
+        """
+        Passive health parameters matching consul checks of service: nginx stops sending requests to failing
+        server for check interval, until consul catches up, after as many failures as check needs to go critical
+        :rtype: dict
+        """
+        params = {}
+        for check in checks or []:
+            if not check.get(u'ServiceID'):
+                continue
+
+            definition = check.get(u'Definition') or {}
+            interval = definition.get(u'Interval') or check.get(u'Interval')
+            if interval and DURATION_PATTERN.match(unicode(interval)):
+                params['fail_timeout'] = interval
+
+            failures = definition.get(u'FailuresBeforeCritical') or check.get(u'FailuresBeforeCritical')
+            if failures and unicode(failures).isdigit():
+                params['max_fails'] = unicode(failures)
+        return params
+
+    def demote_nodes(self, warning_nodes):
+        """
+        Make warning nodes backup servers or reduce their weight. Backup servers can not be used with hash and
+        random balancing, warning nodes are used as usual if there are no passing ones
+        :type warning_nodes: set - node names
+        """
+        if not warning_nodes or not set(self.nodes) - warning_nodes:
+            return
+
+        backup = config.WARNING_NODES == 'backup' and self.balance not in ('hash', 'random')
+        for node_name, node in self.nodes.items():
+            if node_name in warning_nodes and backup:
+                node['params']['backup'] = True
+            elif node_name not in warning_nodes and not backup:
+                weight = int(node['params'].get('weight', 1))
+                node['params']['weight'] = unicode(max(1, weight * 100 // max(config.WARNING_NODE_WEIGHT, 1)))
+
+    @classmethod
+    def parse_balance(cls, value):
+        """
+        :type value: string - least_conn, round_robin, random or hash[:<key>]
+        :return: balancing method and hash key, (None, None) if value is invalid
+        """
+        method, _, key = value.partition(':')
+        if method in ('least_conn', 'round_robin', 'random') and not key:
+            return method, None
+        if method == 'hash' and (not key or HASH_KEY_PATTERN.match(key)):
+            return method, key or '$remote_addr'
+        return None, None
+
+    @classmethod
+    def parse_cache(cls, value):
+        """
+        :type value: string - <max size>:<ttl>, like 100m:10s
+        :rtype: tuple - max size, ttl or None if value is invalid
+        """
+        size, _, ttl = value.partition(':')
+        if SIZE_PATTERN.match(size) and TIME_PATTERN.match(ttl):
+            return size, ttl
+        return None
+
+    def get_cache_path(self):
+        return os.path.join(config.NGINX_CACHE_PATH, self.id)
+
+    @classmethod
+    def parse_server_params(cls, tags, meta):
+        """
+        Server parameters from node meta with vergilius_ prefix, service tags take precedence
+        :rtype: dict
+        """
+        params = {}
+        for name, pattern in SERVER_PARAMS:
+            value = meta.get('vergilius_%s' % name)
+            for tag in tags:
+                if tag.startswith(name + ':'):
+                    value = tag[len(name) + 1:]
+            if value is not None and pattern.match(unicode(value)):
+                params[name] = value
+        return params
+
+    def get_nginx_configs(self):
+        """
+        Render all config types, cached until routing state changes
+        :rtype: dict
+        """
+        if self.get_fingerprint() != self.rendered_fingerprint:
+            self.rendered_configs = dict(
+                    (config_type, self.get_nginx_config(config_type)) for config_type in self.get_config_types())
+            # rendering may allocate port or certificate, so fingerprint is taken after it
+            self.rendered_fingerprint = self.get_fingerprint()
+
+        return self.rendered_configs
 
     def flush_nginx_config(self):
+        if not self.active:
+            return False
+
+        fingerprint = self.get_fingerprint()
+        if fingerprint == self.deployed_fingerprint:
+            return False
+
+        if upstream_backend and self.deployed_fingerprint and fingerprint[0] == self.deployed_fingerprint[0]:
+            self.update_upstream()
+            return True
+
+        if config.NGINX_BATCH_VALIDATION:
+            ConfigValidator.queue_validation(self)
+            return
+
         if not self.validate():
             logger.error('[service][%s]: failed to validate nginx config!' % self.id)
             return False
 
-        has_changes = False
+        nginx_configs = self.get_nginx_configs()
+        return self.write_nginx_configs(nginx_configs, self.rendered_fingerprint)
 
-        for config_type in self.get_config_types():
-            nginx_config = self.get_nginx_config(config_type)
-            deployed_nginx_config = None
+    @tornado.gen.coroutine
+    def update_upstream(self):
+        """
+        Apply upstream membership change to running nginx with upstream backend, without reload.
+        Falls back to full config flush on backend failure
+        """
+        with (yield self.upstream_lock.acquire()):
+            nginx_configs = self.get_nginx_configs()
+            fingerprint = self.rendered_fingerprint
+            deployed_fingerprint = self.deployed_fingerprint
+            if not self.active or fingerprint == deployed_fingerprint:
+                return
 
             try:
-                deployed_nginx_config = self.read_nginx_config_file(config_type)
-            except IOError:
-                pass
+                servers = self.get_upstream_servers()
+                yield upstream_backend.update_upstream(self.id, servers)
+                if len(self.binds['tcp']) or len(self.binds['udp']):
+                    yield upstream_backend.update_upstream(self.id, servers, stream=True)
+            except Exception as e:
+                logger.error('[service][%s]: runtime upstream update failed: %s' % (self.id, e))
+                self.deployed_fingerprint = None
+                self.flush_nginx_config()
+            else:
+                # routing changed while servers were pushed, full flush writes and reloads newer configs
+                if self.deployed_fingerprint != deployed_fingerprint or self.get_fingerprint()[0] != fingerprint[0]:
+                    logger.info('[service][%s]: upstream updated, configs are left to full flush' % self.name)
+                    return
+
+                logger.info('[service][%s]: upstream updated without reload' % self.name)
+                self.write_nginx_configs(nginx_configs, fingerprint, reload=False)
+
+    def write_nginx_configs(self, nginx_configs, fingerprint, reload=True):
+        """
+        :type nginx_configs: dict - validated configs by config type
+        :type fingerprint: tuple - fingerprint of state configs were rendered from
+        :type reload: bool - queue nginx reload if configs changed
+        """
+        # configs validated or pushed before service was deleted are stale
+        if not self.active:
+            return False
+
+        has_changes = host_routing.update(self.id, *self.get_routing())
+
+        service_configs = nginx_configs
+        if config_shards:
+            has_changes = config_shards.update(self.id, nginx_configs) or has_changes
+            # per service files left from previous output mode would duplicate shards
+            service_configs = {}
+
+        for config_type, nginx_config in service_configs.items():
+            digest = hashlib.sha1(nginx_config).hexdigest()
 
-            if deployed_nginx_config != nginx_config:
+            if config_type not in self.deployed_digests:
+                try:
+                    self.deployed_digests[config_type] = hashlib.sha1(
+                            self.read_nginx_config_file(config_type)).hexdigest()
+                except IOError:
+                    pass
+
+            if self.deployed_digests.get(config_type) != digest:
                 config_file = open(self.get_nginx_config_path(config_type), 'w+')
                 config_file.write(nginx_config)
                 config_file.close()
+                self.deployed_digests[config_type] = digest
                 has_changes = True
 
-        if has_changes:
+        # remove configs service does not need anymore, None digest marks absent file
+        for config_type in CONFIG_TYPES:
+            if config_type in service_configs or (config_type in self.deployed_digests and
+                                                  self.deployed_digests[config_type] is None):
+                continue
+
+            try:
+                os.remove(self.get_nginx_config_path(config_type))
+                has_changes = True
+            except OSError:
+                pass
+            self.deployed_digests[config_type] = None
+
+        self.deployed_fingerprint = fingerprint
+
+        if has_changes and reload:
             NginxReloader.queue_reload()
             logger.info('[service][%s]: got new nginx config' % self.name)
 
+        return has_changes
+
     def get_nginx_config_path(self, config_type):
         return os.path.join(config.NGINX_CONFIG_PATH, '%s.%s.conf' % (self.id, config_type))
 
@@ -148,7 +489,36 @@ class Service(object):
             return config_content
 
     def get_config_types(self):
-        return itertools.chain(self.binds.keys(), ['upstream'])
+        """
+        Config types service needs, upstreams are emitted only for contexts that use them
+        :rtype: list
+        """
+        config_types = [protocol for protocol, binds in self.binds.items() if len(binds)]
+        if 'http' in config_types and self.is_map_routed():
+            config_types.remove('http')
+        if len(self.binds['http']) or len(self.binds['http2']):
+            config_types.append('upstream')
+        if len(self.binds['tcp']) or len(self.binds['udp']):
+            config_types.append('stream_upstream')
+        return config_types
+
+    def get_routing(self):
+        """
+        :rtype: tuple - http domains, http2 domains, allow crossdomain
+        """
+        if config.HOST_ROUTING == 'map' and not self.is_map_routed():
+            # hosts with own server block are left out of map, but still sized as server names
+            return host_routing.get_service((), self.binds['http'] | self.binds['http2'], self.allow_crossdomain)
+        return host_routing.get_service(self.binds['http'], self.binds['http2'], self.allow_crossdomain)
+
+    def is_map_routed(self):
+        """
+        http hosts are routed by shared map server in routing file, unless service needs settings it does not have:
+        cache, crossdomain headers or keepalive other than default
+        :rtype: bool
+        """
+        return (config.HOST_ROUTING == 'map' and not self.cache and not self.allow_crossdomain and
+                bool(self.keepalive) == bool(config.UPSTREAM_KEEPALIVE))
 
     def validate(self):
         """
@@ -159,13 +529,18 @@ class Service(object):
         temp_dir = tempfile.mkdtemp()
 
         files = {}
-        for config_type in self.get_config_types():
+        nginx_configs = self.get_nginx_configs()
+        for config_type in CONFIG_TYPES:
             path = os.path.join(temp_dir, config_type)
             config_file = open(path, 'w+')
-            config_file.write(self.get_nginx_config(config_type))
+            config_file.write(nginx_configs.get(config_type, ''))
             config_file.close()
             files['service_%s' % config_type] = path
 
+        files['routing'] = os.path.join(temp_dir, 'routing')
+        with open(files['routing'], 'w+') as routing_file:
+            routing_file.write(host_routing.render({self.id: self.get_routing()}))
+
         files['pid_file'] = os.path.join(temp_dir, 'pid')
 
         nginx_config_file = open(os.path.join(temp_dir, 'service'), 'w+')
@@ -173,7 +548,8 @@ class Service(object):
         nginx_config_file.close()
 
         try:
-            return_code = subprocess.check_call([config.NGINX_BINARY, '-t', '-c', nginx_config_file.name])
+            with nginx_test_duration.time():
+                return_code = subprocess.check_call([config.NGINX_BINARY, '-t', '-c', nginx_config_file.name])
         except subprocess.CalledProcessError:
             return_code = 1
         finally:
@@ -183,25 +559,53 @@ class Service(object):
 
     def delete(self):
         """
-        Destroy service, remove nginx config, stop watcher
+        Destroy service: stop watcher, release port and certificate, remove nginx config and cache
         """
 
         logger.info('[service][%s]: deleting' % self.name)
         self.active = False
 
-        if self.port:
-            self.release_port()
+        if self.watcher:
+            self.watcher.stop()
+            self.watcher = None
+        ConfigValidator.discard(self)
+
+        self.release_port()
 
-        for config_type in self.get_config_types():
+        if self.certificate:
+            self.certificate.delete()
+            self.certificate = None
+
+        has_changes = host_routing.remove(self.id)
+        if config_shards:
+            has_changes = config_shards.remove(self.id) or has_changes
+
+        rmtree(self.get_cache_path(), ignore_errors=True)
+
+        for config_type in CONFIG_TYPES:
             try:
                 os.remove(self.get_nginx_config_path(config_type))
+                has_changes = True
             except OSError:
                 pass
 
-    def __del__(self):
+        self.deployed_fingerprint = None
+        self.deployed_digests = {}
+
+        if has_changes:
+            NginxReloader.queue_reload()
+
+    @tornado.gen.coroutine
+    def shutdown(self):
+        """
+        Delete service and wait for in-flight upstream update, nothing refers to service afterwards
+        """
         if self.active:
             self.delete()
 
+        with (yield self.upstream_lock.acquire()):
+            pass
+
     @classmethod
     def slugify(cls, string):
         """
@@ -218,10 +622,13 @@ class Service(object):
 
     def check_port(self):
         if not self.port:
-            self.port = port_allocator.allocate()
-            consul.kv.put('vergilius/ports/%s' % self.name, str(self.port))
+            self.port = port_allocator.claim(self.name, self.pinned_port)
 
     def release_port(self):
-        if self.port:
-            port_allocator.release(self.port)
-            consul.kv.delete('vergilius/ports/%s' % self.name)
+        """
+        Release port of service, or port claim restored from consul if service did not use it yet
+        """
+        port = self.port or port_allocator.get_port(self.name)
+        if port:
+            port_allocator.unclaim(self.name, port)
+            self.port = None
@@ -0,0 +1,20 @@
+import zope.interface
+from tornado import gen
+
+from vergilius.components.upstream_backend import IUpstreamBackend
+
+
+class StubUpstreamBackend(object):
+    """
+    Keeps upstreams membership in memory, for tests.
+    """
+    zope.interface.implements(IUpstreamBackend)
+
+    def __init__(self):
+        self.upstreams = {}
+        self.updates = 0
+
+    @gen.coroutine
+    def update_upstream(self, upstream, servers, stream=False):
+        self.upstreams[(upstream, stream)] = set(servers)
+        self.updates += 1
@@ -1,11 +1,21 @@
+import time
+
 from mock import mock
+from tornado import concurrent
 
 from base_test import BaseTest
-from vergilius import consul, DummyCertificateProvider
+from vergilius import certificate_issuer, consul, DummyCertificateProvider
 from vergilius.models.certificate import Certificate
 from vergilius.models.service import Service
 
 
+def wait_for(future, timeout=30):
+    deadline = time.time() + timeout
+    while not future.done() and time.time() < deadline:
+        time.sleep(0.1)
+    return future.result()
+
+
 class Test(BaseTest):
     def __init__(self, methodName='runTest'):
         super(Test, self).__init__(methodName)
@@ -18,8 +28,57 @@ class Test(BaseTest):
 
     def test_keys_request(self):
         cert = Certificate(service=self.service, domains={'example.com'})
+        self.assertTrue(wait_for(cert.loading), 'keys issued asynchronously')
         self.assertTrue(cert.validate(), 'got valid keys')
 
         with mock.patch.object(DummyCertificateProvider, 'get_certificate', return_value={}) as mock_method:
-           Certificate(service=self.service, domains={'example.com'})
-           self.assertFalse(mock_method.called, 'existing keys are not requested from provider')
+            cert = Certificate(service=self.service, domains={'example.com'})
+            wait_for(cert.loading)
+            self.assertFalse(mock_method.called, 'existing keys are not requested from provider')
+
+    def test_keys_issued_while_locked(self):
+        cert = Certificate(service=self.service, domains={'example.com'})
+        self.assertTrue(wait_for(cert.loading))
+
+        # other gateway renewed keys while this one waited for lock
+        prefix = 'vergilius/certificates/%s/' % self.service.id
+        consul.kv.put(prefix + 'expires', str(int(cert.expires) + 3600))
+        consul.kv.put(prefix + 'public_key', 'renewed public key')
+
+        issued = concurrent.Future()
+        issued.set_result({'private_key_pem': 'private key', 'public_key_pem': 'public key',
+                           'expires': int(cert.expires) + 7200})
+        with mock.patch.object(certificate_issuer, 'get_certificate_async', return_value=issued) as issue:
+            self.assertTrue(wait_for(cert.request_certificate()), 'keys of other gateway are taken')
+            self.assertFalse(issue.called, 'keys are not issued again')
+            self.assertEqual(cert.public_key, 'renewed public key')
+
+            self.assertTrue(wait_for(cert.request_certificate()))
+            self.assertTrue(issue.called, 'current keys are renewed')
+            self.assertEqual(cert.public_key, 'public key')
+        cert.delete()
+
+    def test_concurrent_requests(self):
+        cert = Certificate(service=self.service, domains={'example.com'})
+        self.assertTrue(wait_for(cert.loading))
+
+        issued = concurrent.Future()
+        with mock.patch.object(certificate_issuer, 'get_certificate_async', return_value=issued) as issue:
+            request = cert.request_certificate()
+            self.assertIs(cert.request_certificate(), request, 'concurrent caller shares request in flight')
+            issued.set_result({'private_key_pem': 'private key', 'public_key_pem': 'public key',
+                               'expires': int(cert.expires) + 3600})
+            self.assertTrue(wait_for(request), 'keys are saved with session holding the lock')
+            self.assertEqual(issue.call_count, 1)
+        cert.delete()
+
+    def test_lock_failed(self):
+        cert = Certificate(service=self.service, domains={'example.com'})
+        self.assertTrue(wait_for(cert.loading))
+
+        with mock.patch.object(consul.kv, 'put', return_value=False), \
+                mock.patch.object(consul.session, 'create', return_value='other-session'), \
+                mock.patch.object(consul.session, 'destroy') as destroy:
+            self.assertFalse(wait_for(cert.request_certificate()), 'lock is held by other gateway')
+            destroy.assert_called_once_with('other-session')
+        cert.delete()
@@ -0,0 +1,43 @@
+from concurrent.futures import Future
+
+from mock import mock
+from tornado import gen, testing
+
+from vergilius.components.certificate_issuer import CertificateIssuer
+
+
+class Provider(object):
+    def get_certificate(self, id, domains):
+        return {'private_key': '%s.key' % id, 'public_key': '%s.pem' % id, 'expires': len(domains)}
+
+
+class Test(testing.AsyncTestCase):
+    def test_issue(self):
+        issuer = CertificateIssuer(Provider(), 2)
+        futures = [issuer.get_certificate_async('service-%s' % i, {'example.com'}) for i in range(4)]
+        self.assertEqual([f.result(timeout=10)['private_key'] for f in futures],
+                         ['service-%s.key' % i for i in range(4)])
+
+    def test_deduplication(self):
+        issuer = CertificateIssuer(Provider(), 2)
+        with mock.patch.object(issuer, 'executor') as executor:
+            first = issuer.get_certificate_async('service', {'example.com', 'www.example.com'})
+            second = issuer.get_certificate_async('service', {'www.example.com', 'example.com'})
+            issuer.get_certificate_async('service', {'example.com'})
+
+        self.assertIs(first, second, 'same domains set shares issuance')
+        self.assertEqual(executor.submit.call_count, 2)
+
+    @testing.gen_test
+    def test_release(self):
+        issuer = CertificateIssuer(Provider(), 2)
+        done = Future()
+        done.set_result({'private_key': 'old.key'})
+        with mock.patch.object(issuer, 'executor') as executor:
+            executor.submit.return_value = done
+            self.assertIs(issuer.get_certificate_async('service', {'example.com'}), done)
+            yield gen.moment
+
+            executor.submit.return_value = Future()
+            self.assertIsNot(issuer.get_certificate_async('service', {'example.com'}), done,
+                             'issuance finished before it was stored is not cached')
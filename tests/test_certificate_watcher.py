@@ -0,0 +1,78 @@
+from mock import mock
+from tornado import concurrent, gen, testing
+
+import vergilius
+
+from vergilius.loop.certificate_watcher import CertificateWatcher
+
+
+def item(key, value):
+    return {'Key': 'vergilius/certificates/%s' % key, 'Value': value}
+
+
+class FakeService(object):
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeCertificate(object):
+    def __init__(self, service_id):
+        self.service = FakeService(service_id)
+        self.loaded = []
+
+    @gen.coroutine
+    def load_keys_from_consul(self, data):
+        self.loaded.append(data)
+
+
+class Test(testing.AsyncTestCase):
+    def setUp(self):
+        super(Test, self).setUp()
+        CertificateWatcher.certificates = {}
+        CertificateWatcher.digests = {}
+        CertificateWatcher.snapshot = None
+
+    @testing.gen_test
+    def test_dispatch(self):
+        first, second = FakeCertificate('first'), FakeCertificate('second')
+        self.assertIsNone(CertificateWatcher.register(first), 'no snapshot yet')
+        CertificateWatcher.register(second)
+
+        data = [item('first/private_key', 'a'), item('second/private_key', 'b')]
+        yield CertificateWatcher.check_certificates(data)
+        self.assertEqual((len(first.loaded), len(second.loaded)), (1, 1))
+
+        data = [item('first/private_key', 'a'), item('first/lock', ''), item('second/private_key', 'c')]
+        yield CertificateWatcher.check_certificates(data)
+        self.assertEqual(len(first.loaded), 1, 'lock changes are ignored')
+        self.assertEqual(second.loaded[-1], [item('second/private_key', 'c')], 'only changed service keys')
+
+    @testing.gen_test
+    def test_register(self):
+        yield CertificateWatcher.check_certificates([item('first/private_key', 'a')])
+        certificate = FakeCertificate('first')
+        self.assertEqual(CertificateWatcher.register(certificate), [item('first/private_key', 'a')])
+        self.assertEqual(CertificateWatcher.register(FakeCertificate('second')), [])
+
+        yield CertificateWatcher.check_certificates([item('first/private_key', 'a')])
+        self.assertEqual(certificate.loaded, [], 'keys from snapshot are not dispatched again')
+
+        CertificateWatcher.unregister(certificate)
+        self.assertNotIn('first', CertificateWatcher.certificates)
+
+    @testing.gen_test
+    def test_concurrent_loads(self):
+        pending, failing, other = FakeCertificate('pending'), FakeCertificate('failing'), FakeCertificate('other')
+        requested = concurrent.Future()
+        pending.load_keys_from_consul = lambda data: requested
+        failing.load_keys_from_consul = mock.Mock(side_effect=gen.coroutine(lambda data: 1 / 0))
+        for certificate in (pending, failing, other):
+            CertificateWatcher.register(certificate)
+
+        with mock.patch.object(vergilius.logger, 'error') as error:
+            yield CertificateWatcher.check_certificates([item('pending/expires', '0'), item('failing/expires', '0'),
+                                                         item('other/private_key', 'a')])
+            self.assertEqual(len(other.loaded), 1, 'keys are delivered while other certificate is requested')
+            yield gen.moment
+            self.assertTrue(error.called, 'failed load is logged')
+        requested.set_result(True)
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from vergilius.components.config_shards import ConfigShards
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.shards = ConfigShards(self.path, 4)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def read(self, shard, config_type):
+        with open(self.shards.get_path(shard, config_type)) as shard_file:
+            return shard_file.read()
+
+    def test_update(self):
+        self.assertTrue(self.shards.update('service-a', {'http': 'server a;', 'upstream': 'upstream a;'}))
+        self.assertFalse(self.shards.update('service-a', {'http': 'server a;', 'upstream': 'upstream a;'}),
+                         'same configs are not written')
+
+        shard = self.shards.get_shard('service-a')
+        self.assertIn('server a;', self.read(shard, 'http'))
+        self.assertFalse(os.path.exists(self.shards.get_path(shard, 'tcp')), 'empty types are skipped')
+
+        self.assertTrue(self.shards.update('service-a', {'http': 'server a;'}))
+        self.assertFalse(os.path.exists(self.shards.get_path(shard, 'upstream')), 'removed type file is deleted')
+
+        self.shards.remove('service-a')
+        self.assertEqual([name for name in os.listdir(self.path)], [], 'no files left, no temporary files')
+
+    def test_sharding(self):
+        service_ids = ['service-%s' % i for i in range(32)]
+        for service_id in service_ids:
+            self.shards.update(service_id, {'http': 'server %s;' % service_id})
+
+        self.assertEqual(len(os.listdir(self.path)), 4, 'one file per shard and type')
+        for service_id in service_ids:
+            self.assertIn('server %s;' % service_id, self.read(self.shards.get_shard(service_id), 'http'))
+
+        shard = self.shards.get_shard('service-0')
+        mtimes = dict((name, os.stat(os.path.join(self.path, name)).st_mtime) for name in os.listdir(self.path))
+        os.utime(self.shards.get_path(shard, 'http'), (0, 0))
+        self.shards.update('service-0', {'http': 'server changed;'})
+        for name, mtime in mtimes.items():
+            if name != os.path.basename(self.shards.get_path(shard, 'http')):
+                self.assertEqual(os.stat(os.path.join(self.path, name)).st_mtime, mtime, 'other shards untouched')
+        self.assertNotEqual(os.stat(self.shards.get_path(shard, 'http')).st_mtime, 0, 'affected shard rewritten')
+
+    def test_load(self):
+        self.shards.update('service-a', {'http': 'server a;\n    location / {}\n'})
+        self.shards.update('service-b', {'http': 'server b;'})
+
+        restored = ConfigShards(self.path, 4)
+        restored.update('service-c', {'http': 'server c;'})
+        for service_id in ['service-a', 'service-b']:
+            shard = restored.get_shard(service_id)
+            self.assertEqual(restored.render(shard, 'http'), self.shards.render(shard, 'http'),
+                             'services from previous run are kept')
+
+    def test_render_overrides(self):
+        self.shards.update('service-a', {'http': 'server a;'})
+        shard = self.shards.get_shard('service-a')
+
+        self.assertIn('server new;', self.shards.render(shard, 'http', {'service-a': {'http': 'server new;'}}))
+        self.assertEqual(self.shards.render(shard, 'http', {'service-a': {}}), '', 'removed by override')
+        self.assertIn('server a;', self.read(shard, 'http'), 'overrides are not written')
+
+    def test_prune(self):
+        self.shards.update('service-a', {'http': 'server a;'})
+        self.shards.update('service-b', {'http': 'server b;', 'upstream': 'upstream b;'})
+
+        restored = ConfigShards(self.path, 4)
+        self.assertTrue(restored.prune({'service-a'}), 'service gone while gateway was down is dropped')
+        self.assertIn('server a;', self.read(restored.get_shard('service-a'), 'http'))
+        for config_type in ['http', 'upstream']:
+            self.assertNotIn('service-b', restored.render(restored.get_shard('service-b'), config_type))
+        self.assertFalse(restored.prune({'service-a'}), 'nothing left to prune')
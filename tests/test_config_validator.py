@@ -0,0 +1,100 @@
+from mock import mock
+from tornado import gen, testing
+
+from vergilius.loop.config_validator import ConfigValidator
+
+
+class FakeService(object):
+    def __init__(self, id):
+        self.id = id
+        self.active = True
+
+
+class Test(testing.AsyncTestCase):
+    def setUp(self):
+        super(Test, self).setUp()
+        ConfigValidator.quarantined = set()
+        self.runs = 0
+
+    @gen.coroutine
+    def nginx_test(self, nginx_configs):
+        self.runs += 1
+        values = [configs['http'] for configs in nginx_configs.values()]
+        raise gen.Return(not any('bad' in value for value in values) and
+                         not ('conflict-a' in values and 'conflict-b' in values))
+
+    @testing.gen_test
+    def test_batch(self):
+        services = [FakeService('service-%s' % i) for i in range(16)]
+        nginx_configs = dict((service, {'http': 'ok'}) for service in services)
+
+        with mock.patch.object(ConfigValidator, 'nginx_test', side_effect=self.nginx_test):
+            valid = yield ConfigValidator.validate_batch(nginx_configs)
+
+        self.assertEqual(len(valid), 16)
+        self.assertEqual(self.runs, 1, 'one nginx -t per batch')
+
+    @testing.gen_test
+    def test_bisection(self):
+        services = [FakeService('service-%s' % i) for i in range(16)]
+        nginx_configs = dict((service, {'http': 'ok'}) for service in services)
+        nginx_configs[services[5]] = {'http': 'bad'}
+
+        with mock.patch.object(ConfigValidator, 'nginx_test', side_effect=self.nginx_test):
+            valid = yield ConfigValidator.validate_batch(nginx_configs)
+
+        self.assertEqual(len(valid), 15)
+        self.assertNotIn(services[5], valid)
+        self.assertEqual(ConfigValidator.quarantined, {'service-5'}, 'only invalid service is quarantined')
+        self.assertLessEqual(self.runs, 9, 'bisection is logarithmic')
+
+    @testing.gen_test
+    def test_conflict(self):
+        services = [FakeService('service-%s' % i) for i in range(8)]
+        nginx_configs = dict((service, {'http': 'ok'}) for service in services)
+        nginx_configs[services[1]] = {'http': 'conflict-a'}
+        nginx_configs[services[6]] = {'http': 'conflict-b'}
+
+        with mock.patch.object(ConfigValidator, 'nginx_test', side_effect=self.nginx_test):
+            valid = yield ConfigValidator.validate_batch(nginx_configs)
+            self.assertTrue((yield self.nginx_test(dict((service, nginx_configs[service]) for service in valid))),
+                            'services valid alone are valid together')
+
+        self.assertEqual(len(valid), 7)
+        self.assertEqual(ConfigValidator.quarantined, {'service-6'})
+
+    @testing.gen_test
+    def test_deploy(self):
+        services = [FakeService('service-%s' % i) for i in range(4)]
+        for service in services:
+            service.get_nginx_configs = mock.Mock(return_value={'http': 'ok'})
+            service.rendered_fingerprint = ('routing', 'servers')
+            service.write_nginx_configs = mock.Mock()
+        services[0].get_nginx_configs.return_value = {'http': 'bad'}
+        ConfigValidator.quarantined = {'service-0', 'service-1'}
+
+        with mock.patch.object(ConfigValidator, 'nginx_test', side_effect=self.nginx_test):
+            yield ConfigValidator.deploy(services)
+
+        self.assertEqual(self.runs, 3, 'quarantined services are validated one by one after the batch')
+        self.assertEqual(ConfigValidator.quarantined, {'service-0'})
+        self.assertFalse(services[0].write_nginx_configs.called)
+        self.assertTrue(all(service.write_nginx_configs.called for service in services[1:]))
+
+    @testing.gen_test
+    def test_failed_batch_is_retried(self):
+        service = FakeService('service-0')
+        service.get_nginx_configs = mock.Mock(side_effect=[IOError('disk full'), {'http': 'ok'}])
+        service.rendered_fingerprint = ('routing', 'servers')
+        service.write_nginx_configs = mock.Mock()
+        ConfigValidator.pending = {}
+        ConfigValidator.validation_event.clear()
+
+        with mock.patch.object(ConfigValidator, 'nginx_test', side_effect=self.nginx_test), \
+                mock.patch('vergilius.config.NGINX_VALIDATION_BATCH_DELAY', 0):
+            ConfigValidator.queue_validation(service)
+            loop = ConfigValidator.validate_configs()
+            while not service.write_nginx_configs.called:
+                yield gen.sleep(0.01)
+
+        self.assertFalse(loop.done(), 'validation loop survives failed batch')
@@ -0,0 +1,93 @@
+from consul import base, std as consul_std, tornado as consul_from_tornado
+from mock import mock
+from tornado import concurrent, gen, httpserver, testing, web
+
+import vergilius
+from vergilius.components import consul_client
+
+
+class Test(testing.AsyncTestCase):
+    def test_pools(self):
+        self.assertIsNot(vergilius.consul_tornado.http.client, vergilius.consul_tornado_requests.http.client,
+                         'watch and request pools are separated')
+        self.assertEqual(vergilius.consul_tornado.http.client.max_clients,
+                         vergilius.config.CONSUL_WATCH_MAX_CLIENTS)
+
+    @testing.gen_test
+    def test_exhaustion_gauge(self):
+        client = consul_client.Consul('test', 1, 10).http
+        futures = [concurrent.Future(), concurrent.Future()]
+
+        with mock.patch.object(consul_from_tornado.HTTPClient, '_request', side_effect=futures):
+            requests = [client.get(lambda r: r, '/v1/kv/a'), client.get(lambda r: r, '/v1/kv/b')]
+            self.assertEqual(consul_client.pool_in_flight.get(pool='test'), 2)
+            self.assertEqual(consul_client.pool_queued.get(pool='test'), 1, 'request over pool size is queued')
+
+            for future in futures:
+                future.set_result('ok')
+            yield requests
+
+        self.assertEqual(consul_client.pool_queued.get(pool='test'), 0)
+        self.assertEqual(consul_client.pool_in_flight.get(pool='test'), 0)
+
+    @testing.gen_test
+    def test_cancel(self):
+        class Blocking(web.RequestHandler):
+            @gen.coroutine
+            def get(self):
+                yield gen.sleep(10)
+
+        sock, port = testing.bind_unused_port()
+        server = httpserver.HTTPServer(web.Application([(r'/.*', Blocking)]), io_loop=self.io_loop)
+        server.add_sockets([sock])
+
+        client = consul_client.Consul('test', 1, 10, port=port).http
+        futures = [client.get(lambda r: r, '/v1/kv/a'), client.get(lambda r: r, '/v1/kv/b')]
+        yield gen.sleep(0.1)
+        self.assertEqual(len(client.client.connections), 1)
+
+        self.assertTrue(futures[1].cancel(), 'queued request is cancelled')
+        self.assertTrue(futures[0].cancel(), 'request in flight is cancelled')
+        for future in futures:
+            with self.assertRaises(base.Timeout):
+                yield future
+        self.assertEqual(client.client.connections, {}, 'connection is released')
+        self.assertFalse(futures[0].cancel())
+        server.stop()
+
+    def test_read_params(self):
+        client = consul_client.Consul('test', 1, 10, 'cached', 5).http
+        self.assertEqual(client.get_read_params('/v1/health/service/web', {'index': 5}),
+                         {'index': 5, 'stale': '1', 'cached': '1'}, 'cached where agent caches endpoint')
+        self.assertEqual(client.get_read_params('/v1/kv/vergilius', {}), {'stale': '1'}, 'stale elsewhere')
+        self.assertIsNone(client.get_read_params('/v1/kv/vergilius', {'consistent': '1'}), 'consistent is kept')
+        self.assertIsNone(consul_client.Consul('test', 1, 10).http.get_read_params('/v1/kv/vergilius', {}))
+
+    @testing.gen_test
+    def test_stale_fallback(self):
+        client = consul_client.Consul('test', 1, 10, 'stale', 5).http
+        requests = []
+
+        @gen.coroutine
+        def request(callback, request):
+            requests.append(request.url)
+            last_contact = '20000' if 'stale' in request.url else '0'
+            raise gen.Return(callback(base.Response(200, {'X-Consul-LastContact': last_contact}, '')))
+
+        with mock.patch.object(consul_from_tornado.HTTPClient, '_request', side_effect=request):
+            response = yield client.get(lambda r: r.headers['X-Consul-LastContact'], '/v1/kv/a')
+
+        self.assertEqual(response, '0', 'too stale read is repeated through leader')
+        self.assertEqual(len(requests), 2)
+        self.assertIn('stale=1', requests[0])
+
+    def test_sync_stale_fallback(self):
+        client = consul_client.SyncConsul('stale', 5).http
+        headers = [{'X-Consul-KnownLeader': 'false'}, {}]
+
+        with mock.patch.object(consul_std.HTTPClient, 'response', side_effect=lambda r: base.Response(
+                200, headers.pop(0), '')), mock.patch.object(client.session, 'get') as get:
+            client.get(lambda r: r, '/v1/kv/a')
+
+        self.assertEqual(get.call_count, 2, 'read without known leader is repeated')
+        self.assertNotIn('stale', get.call_args[0][0])
@@ -0,0 +1,33 @@
+import base64
+import json
+import unittest
+
+from consul import ConsulException
+from consul.base import Response
+from mock import mock
+
+from vergilius.components.consul_txn import Transaction
+
+
+class Test(unittest.TestCase):
+    def test_operations(self):
+        consul = mock.Mock()
+        Transaction(consul).set('a', 'value').set('b', 'value', cas=0).delete('c', cas=5) \
+            .check_session('lock', 'session').commit()
+
+        callback, path = consul.http.put.call_args[0]
+        operations = [operation['KV'] for operation in json.loads(consul.http.put.call_args[1]['data'])]
+        self.assertEqual(path, '/v1/txn')
+        self.assertEqual([operation['Verb'] for operation in operations], ['set', 'cas', 'delete-cas', 'check-session'])
+        self.assertEqual(base64.b64decode(operations[1]['Value']), 'value')
+        self.assertEqual(operations[1]['Index'], 0)
+
+        with self.assertRaises(ConsulException):
+            Transaction(consul).check_session('lock', None)
+
+    def test_response(self):
+        txn = Transaction(mock.Mock())
+        self.assertTrue(txn.parse_response(Response(200, {}, '{"Results": []}')))
+        self.assertFalse(txn.parse_response(Response(409, {}, '{"Errors": [{"OpIndex": 0, "What": "failed"}]}')))
+        with self.assertRaises(ConsulException):
+            txn.parse_response(Response(500, {}, 'error'))
@@ -0,0 +1,85 @@
+from consul import base, ConsulException
+from mock import mock
+from tornado import gen, testing
+
+import vergilius
+from vergilius.components.consul_watch import ConsulWatch
+
+
+class Test(testing.AsyncTestCase):
+    def setUp(self):
+        super(Test, self).setUp()
+        self.patches = [mock.patch.object(vergilius.config, 'CONSUL_WATCH_BACKOFF_MIN', 0.001),
+                        mock.patch.object(vergilius.config, 'CONSUL_WATCH_BACKOFF_MAX', 0.004)]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        super(Test, self).tearDown()
+
+    def make_watch(self, responses):
+        """
+        :type responses: list - (index, data) tuples or exceptions, watch stops when they run out
+        """
+        self.queries = []
+        self.data = []
+
+        @gen.coroutine
+        def query(index, wait):
+            self.queries.append((index, wait))
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            raise gen.Return(response)
+
+        return ConsulWatch('test', query, self.data.append, lambda: len(responses) > 0)
+
+    @testing.gen_test
+    def test_index(self):
+        watch = self.make_watch([(5, 'a'), (5, 'a'), (7, 'b'), (3, 'c'), (0, 'd'), (4, 'e')])
+        yield watch.run()
+
+        self.assertEqual([index for index, wait in self.queries], [None, 5, 5, 7, None, 1],
+                         'index going backwards is reset, index is at least 1')
+        self.assertEqual(self.data, ['a', 'b', 'c', 'd', 'e'], 'unchanged index is not passed to callback')
+        self.assertEqual(watch.index, 4)
+
+    @testing.gen_test
+    def test_backoff(self):
+        watch = self.make_watch([ConsulException('500'), base.Timeout(), ConsulException('500'), (5, 'a'),
+                                 ConsulException('500'), (6, 'b')])
+        yield watch.run()
+
+        self.assertEqual(self.data, ['a', 'b'])
+        self.assertEqual(watch.errors, 4, 'all errors are counted')
+        self.assertEqual(watch.failures, 0, 'failures are reset after success')
+        self.assertEqual(self.queries[4][0], 5, 'index is kept over failures')
+
+    @testing.gen_test
+    def test_stop(self):
+        pending = gen.Future()
+        pending.cancel = mock.Mock()
+        query = mock.Mock(return_value=pending)
+        watch = ConsulWatch('test', query, mock.Mock())
+        running = watch.run()
+        watch.stop()
+        yield running
+
+        self.assertEqual(query.call_count, 1)
+        self.assertTrue(pending.cancel.called, 'blocked query is cancelled')
+        self.assertIsNone(watch.callback, 'references to callbacks are dropped')
+
+    def test_get_backoff(self):
+        with mock.patch.object(vergilius.config, 'CONSUL_WATCH_BACKOFF_MIN', 1), \
+                mock.patch.object(vergilius.config, 'CONSUL_WATCH_BACKOFF_MAX', 60):
+            self.assertTrue(0.5 <= ConsulWatch.get_backoff(1) <= 1)
+            self.assertTrue(4 <= ConsulWatch.get_backoff(4) <= 8)
+            self.assertTrue(30 <= ConsulWatch.get_backoff(100) <= 60, 'backoff is capped')
+
+    def test_get_wait(self):
+        with mock.patch.object(vergilius.config, 'CONSUL_WATCH_WAIT', 320):
+            waits = set(ConsulWatch.get_wait() for _ in range(100))
+        self.assertTrue(all(300 <= int(wait[:-1]) <= 320 for wait in waits))
+        self.assertTrue(len(waits) > 1, 'wait is jittered')
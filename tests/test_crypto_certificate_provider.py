@@ -0,0 +1,27 @@
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from base_test import BaseTest
+from vergilius.components.crypto_certificate_provider import CryptoCertificateProvider
+
+
+class Test(BaseTest):
+    def check_certificate(self, provider):
+        data = provider.get_certificate(id='example.com|foo.example.com', domains={'example.com', 'foo.example.com'})
+        certificate = x509.load_pem_x509_certificate(data['public_key_pem'], default_backend())
+        ca_certificate = provider.get_ca()[1]
+
+        self.assertEqual(certificate.issuer, ca_certificate.subject, 'signed by identity')
+        self.assertEqual(
+                certificate.extensions.get_extension_for_class(x509.SubjectAlternativeName).value.get_values_for_type(
+                        x509.DNSName), [u'example.com', u'foo.example.com'])
+        self.assertIn('PRIVATE KEY', data['private_key_pem'])
+        return certificate
+
+    def test_rsa(self):
+        self.check_certificate(CryptoCertificateProvider())
+
+    def test_ecdsa(self):
+        certificate = self.check_certificate(CryptoCertificateProvider(key_type='ecdsa'))
+        self.assertIsInstance(certificate.public_key(), ec.EllipticCurvePublicKey)
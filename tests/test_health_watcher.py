@@ -0,0 +1,34 @@
+import unittest
+
+from vergilius.loop.health_watcher import HealthWatcher
+
+
+def check(node, service_name, status='passing', check_id=None):
+    return {
+        u'Node': node,
+        u'CheckID': check_id or (u'service:%s' % service_name if service_name else u'serfHealth'),
+        u'Status': status,
+        u'ServiceID': service_name,
+        u'ServiceName': service_name,
+    }
+
+
+class Test(unittest.TestCase):
+    def test_snapshot(self):
+        snapshot = HealthWatcher.build_snapshot([check('n1', 'web'), check('n2', 'web'), check('n1', 'db')])
+        self.assertEqual(set(snapshot.keys()), {'web', 'db'})
+        self.assertEqual(HealthWatcher.build_snapshot(None), {})
+
+    def test_diff(self):
+        previous = HealthWatcher.build_snapshot([check('n1', 'web'), check('n2', 'db')])
+        current = HealthWatcher.build_snapshot([check('n1', 'web'), check('n2', 'db', 'critical')])
+        self.assertEqual(HealthWatcher.diff(previous, current), {'db'}, 'only changed service')
+
+        current = HealthWatcher.build_snapshot([check('n1', 'web')])
+        self.assertEqual(HealthWatcher.diff(previous, current), {'db'}, 'removed service')
+
+    def test_node_check(self):
+        previous = HealthWatcher.build_snapshot([check('n1', 'web'), check('n1', ''), check('n2', 'db')])
+        current = HealthWatcher.build_snapshot(
+                [check('n1', 'web'), check('n1', '', 'critical'), check('n2', 'db')])
+        self.assertEqual(HealthWatcher.diff(previous, current), {'web'}, 'node check affects node services')
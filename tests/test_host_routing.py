@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import mock
+
+from vergilius.components.host_routing import HostRouting, ROUTING_FILE, get_hash_sizes
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.routing = HostRouting(self.path, 'map')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def read(self, routing=None):
+        (routing or self.routing).flush()
+        with open(os.path.join(self.path, ROUTING_FILE)) as routing_file:
+            return routing_file.read()
+
+    def test_map(self):
+        self.assertTrue(self.routing.update('service-a', ['a.example.com'], [], True))
+        self.assertTrue(self.routing.update('service-b', ['b.example.com'], ['secure.example.com'], False))
+
+        content = self.read()
+        self.assertIn('.a.example.com service-a;', content)
+        self.assertIn('.b.example.com service-b;', content)
+        self.assertIn('.a.example.com 1;', content, 'crossdomain map has service-a domains')
+        self.assertNotIn('.b.example.com 1;', content)
+        self.assertNotIn('secure.example.com service-b;', content, 'http2 hosts keep server blocks')
+        self.assertEqual(content.count('server {'), 1, 'single server for all hosts')
+
+        self.routing.remove('service-a')
+        self.assertNotIn('a.example.com', self.read())
+
+    def test_server_mode(self):
+        routing = HostRouting(self.path, 'server')
+        routing.update('service-a', ['a.example.com'], [], False)
+
+        content = self.read(routing)
+        self.assertIn('server_names_hash_bucket_size 64;', content)
+        self.assertNotIn('map ', content, 'server blocks are rendered per service')
+        self.assertNotIn('server {', content)
+
+    def test_routes(self):
+        self.routing.update('service-b', ['shared.example.com', 'b.example.com'], [], False)
+        self.routing.update('service-a', ['shared.example.com', 'bad;host', '$host'], [], False)
+
+        content = self.read()
+        self.assertIn('.shared.example.com service-a;', content, 'first service by id wins')
+        self.assertNotIn('.shared.example.com service-b;', content)
+        self.assertNotIn('bad;host service-a', content, 'invalid domains are not routed')
+        self.assertNotIn('$host service-a', content)
+
+    def test_hash_sizes(self):
+        self.assertEqual(get_hash_sizes([]), (64, 512))
+        self.assertEqual(get_hash_sizes(['a' * 40]), (128, 512))
+        self.assertEqual(get_hash_sizes(['%s.example.com' % i for i in range(1000)]), (64, 2048))
+
+        long_domain = '%s.example.com' % ('a' * 100)
+        self.routing.update('service-a', [long_domain], [], False)
+        self.assertIn('map_hash_bucket_size 256;', self.read())
+
+    def test_load(self):
+        self.routing.update('service-a', ['a.example.com'], [], True)
+        self.routing.update('service-b', ['b.example.com'], ['b2.example.com'], False)
+        self.routing.flush()
+
+        restored = HostRouting(self.path, 'map')
+        self.assertFalse(restored.update('service-a', ['a.example.com'], [], True), 'restored state is not rewritten')
+        restored.update('service-c', ['c.example.com'], [], False)
+
+        content = self.read(restored)
+        for domain in ['a.example.com', 'b.example.com', 'c.example.com']:
+            self.assertIn('.%s service-' % domain, content, 'services of previous run are kept')
+        self.assertIn('http2=b2.example.com', content)
+
+    def test_unchanged(self):
+        self.routing.update('service-a', ['a.example.com'], [], False)
+        self.routing.flush()
+        os.utime(os.path.join(self.path, ROUTING_FILE), (0, 0))
+
+        self.assertFalse(self.routing.update('service-a', ['a.example.com'], [], False))
+        self.assertFalse(self.routing.remove('service-unknown'), 'unknown service removal changes nothing')
+        self.assertFalse(self.routing.flush())
+        self.assertEqual(os.stat(os.path.join(self.path, ROUTING_FILE)).st_mtime, 0)
+        self.assertEqual(os.listdir(self.path), [ROUTING_FILE], 'no temporary files')
+
+    def test_flush(self):
+        for i in range(100):
+            self.assertTrue(self.routing.update('service-%s' % i, ['%s.example.com' % i], [], False))
+        self.assertFalse(os.path.exists(os.path.join(self.path, ROUTING_FILE)), 'updates do not write file')
+
+        with mock.patch.object(self.routing, 'write', wraps=self.routing.write) as write:
+            self.assertTrue(self.routing.flush())
+            self.assertFalse(self.routing.flush(), 'nothing to write after flush')
+            self.assertEqual(write.call_count, 1, 'file is written once for all updates')
+        self.assertIn('.99.example.com service-99;', self.read())
+
+    def test_prune(self):
+        self.routing.update('service-a', ['a.example.com'], [], False)
+        self.routing.update('service-b', ['shared.example.com'], [], False)
+        self.routing.flush()
+
+        restored = HostRouting(self.path, 'map')
+        self.assertTrue(restored.prune({'service-a', 'service-c'}), 'service gone while gateway was down is dropped')
+        restored.update('service-c', ['shared.example.com'], [], False)
+        content = self.read(restored)
+        self.assertIn('.a.example.com service-a;', content)
+        self.assertIn('.shared.example.com service-c;', content, 'domain of stale service is routed to live one')
+        self.assertNotIn('service-b', content)
+        self.assertFalse(restored.prune({'service-a', 'service-c'}))
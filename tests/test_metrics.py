@@ -0,0 +1,47 @@
+import unittest
+
+from vergilius.components import metrics
+from vergilius.components.metrics import Counter, Gauge, Histogram
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.registry = list(metrics.registry)
+
+    def tearDown(self):
+        metrics.registry[:] = self.registry
+
+    def test_exposition(self):
+        counter = Counter('test_events_total', 'Test events', ('kind',))
+        counter.inc(kind='a')
+        counter.inc(2, kind='a')
+        counter.inc(kind='b"c')
+        gauge = Gauge('test_items', 'Test items')
+        gauge.set_function(lambda: 42)
+
+        lines = metrics.exposition().splitlines()
+        self.assertIn('# TYPE test_events_total counter', lines)
+        self.assertIn('test_events_total{kind="a"} 3', lines)
+        self.assertIn('test_events_total{kind="b\\"c"} 1', lines)
+        self.assertIn('# TYPE test_items gauge', lines)
+        self.assertIn('test_items 42', lines)
+
+    def test_histogram(self):
+        histogram = Histogram('test_duration_seconds', 'Test duration', ('type',), buckets=(0.1, 1))
+        histogram.observe(0.05, type='a')
+        histogram.observe(0.5, type='a')
+        histogram.observe(5, type='a')
+
+        data = histogram.get(type='a')
+        self.assertEqual(data['buckets'], [1, 2])
+        self.assertEqual(data['count'], 3)
+        self.assertAlmostEqual(data['sum'], 5.55)
+
+        lines = list(histogram.samples())
+        self.assertIn('test_duration_seconds_bucket{type="a",le="0.1"} 1', lines)
+        self.assertIn('test_duration_seconds_bucket{type="a",le="+Inf"} 3', lines)
+        self.assertIn('test_duration_seconds_count{type="a"} 3', lines)
+
+        with histogram.time(type='b'):
+            pass
+        self.assertEqual(histogram.get(type='b')['count'], 1)
@@ -0,0 +1,50 @@
+import unittest
+
+from mock import mock
+from tornado import concurrent, ioloop
+
+import vergilius
+from vergilius.loop.nginx_reloader import NginxReloader
+
+
+@mock.patch.multiple('vergilius.config', NGINX_RELOAD_QUIET_PERIOD=1, NGINX_RELOAD_MIN_INTERVAL=5,
+                     NGINX_RELOAD_MAX_DELAY=10)
+class Test(unittest.TestCase):
+    def setUp(self):
+        NginxReloader.pending_changes = 0
+        NginxReloader.first_change = None
+        NginxReloader.last_change = None
+        NginxReloader.last_reload = 0
+
+    def queue(self, now):
+        with mock.patch('time.time', return_value=now):
+            NginxReloader.queue_reload()
+
+    def test_quiet_period(self):
+        self.queue(100)
+        self.assertEqual(NginxReloader.get_reload_delay(100), 1)
+        self.queue(100.5)
+        self.assertEqual(NginxReloader.get_reload_delay(100.5), 1, 'new change extends quiet period')
+        self.assertEqual(NginxReloader.get_reload_delay(101.5), 0)
+        self.assertEqual(NginxReloader.pending_changes, 2, 'changes are coalesced')
+
+    def test_max_delay(self):
+        for now in range(100, 110):
+            self.queue(now)
+        self.assertEqual(NginxReloader.get_reload_delay(109.5), 0.5, 'reload is not postponed forever')
+
+    def test_min_interval(self):
+        NginxReloader.last_reload = 100
+        self.queue(101)
+        self.assertEqual(NginxReloader.get_reload_delay(101), 4)
+
+    def test_reload_flushes_routing(self):
+        calls = []
+        exit_future = concurrent.Future()
+        exit_future.set_result(0)
+        proc = mock.Mock(wait_for_exit=mock.Mock(return_value=exit_future))
+
+        with mock.patch.object(vergilius.host_routing, 'flush', side_effect=lambda: calls.append('flush')), \
+                mock.patch('tornado.process.Subprocess', side_effect=lambda *a, **kw: calls.append('reload') or proc):
+            ioloop.IOLoop.current().run_sync(lambda: NginxReloader.reload(1))
+        self.assertEqual(calls, ['flush', 'reload'], 'routing file is written once before reload')
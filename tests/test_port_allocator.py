@@ -0,0 +1,41 @@
+import unittest
+
+from vergilius.components.port_allocator import PortAllocator
+
+
+class Test(unittest.TestCase):
+    def test_allocate(self):
+        allocator = PortAllocator(7000, 7003)
+        self.assertEqual([allocator.allocate() for _ in range(3)], [7000, 7001, 7002])
+        with self.assertRaises(Exception):
+            allocator.allocate()
+
+        allocator.release(7001)
+        self.assertFalse(7001 in allocator)
+        self.assertEqual(allocator.allocate(), 7001, 'released port is reused')
+
+    def test_reserve(self):
+        allocator = PortAllocator(7000, 7003)
+        allocator.reserve(7000, 'pinned')
+        allocator.reserve(7000, 'pinned')
+        with self.assertRaises(Exception):
+            allocator.reserve(7000, 'other')
+        with self.assertRaises(Exception):
+            allocator.reserve(80, 'pinned')
+        with self.assertRaises(Exception):
+            allocator.reserve(7003, 'pinned')
+
+        self.assertEqual(allocator.allocate(), 7001, 'reserved port is skipped')
+        allocator.release(7000)
+        allocator.release(7000)
+        self.assertEqual(len(allocator.free), 2, 'free list has no duplicates')
+
+    def test_owners(self):
+        allocator = PortAllocator(7000, 7003)
+        allocator.reserve(7001, 'service')
+        self.assertEqual(allocator.get_port('service'), 7001)
+        self.assertEqual(allocator.allocate('service'), 7000, 'service moves to other port')
+        allocator.release(7001)
+        self.assertEqual(allocator.get_port('service'), 7000, 'old port release keeps new one')
+        allocator.release(7000)
+        self.assertIsNone(allocator.get_port('service'))
@@ -0,0 +1,77 @@
+import time
+
+from mock import mock
+from tornado import gen, testing
+
+from vergilius.loop.renewal_scheduler import RenewalScheduler
+
+
+class FakeService(object):
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeCertificate(object):
+    def __init__(self, service_id, expires):
+        self.service = FakeService(service_id)
+        self.expires = expires
+        self.active = True
+        self.renewals = 0
+
+    @gen.coroutine
+    def renew(self):
+        self.renewals += 1
+        raise gen.Return(True)
+
+
+@mock.patch.multiple('vergilius.config', CERTIFICATE_RENEWAL_LEAD_TIME=100, CERTIFICATE_RENEWAL_JITTER=10,
+                     CERTIFICATE_RENEWAL_RETRY=60)
+class Test(testing.AsyncTestCase):
+    def setUp(self):
+        super(Test, self).setUp()
+        RenewalScheduler.heap = []
+        RenewalScheduler.entries = {}
+        RenewalScheduler.timeout = None
+
+    def get_new_ioloop(self):
+        from tornado import ioloop
+        return ioloop.IOLoop.instance()
+
+    def test_schedule(self):
+        now = time.time()
+        first, second = FakeCertificate('first', now + 1000), FakeCertificate('second', now + 500)
+        RenewalScheduler.schedule(first)
+        RenewalScheduler.schedule(second)
+
+        renew_at = RenewalScheduler.get_next_renewal()
+        self.assertTrue(now + 390 <= renew_at <= now + 400, 'lead time with jitter before expiry')
+
+        RenewalScheduler.unschedule(second)
+        self.assertTrue(now + 890 <= RenewalScheduler.get_next_renewal() <= now + 900)
+
+        RenewalScheduler.schedule(first, now + 50)
+        self.assertEqual(RenewalScheduler.get_next_renewal(), now + 50, 'rescheduled')
+        self.assertEqual(len(RenewalScheduler.entries), 1)
+        self.assertTrue(49 < RenewalScheduler.get_seconds_until_next_renewal() <= 50)
+
+    @testing.gen_test
+    def test_renew(self):
+        certificate = FakeCertificate('first', time.time() + 50)
+        RenewalScheduler.schedule(certificate)
+
+        yield gen.sleep(0.1)
+        self.assertEqual(certificate.renewals, 1, 'expiring certificate renewed')
+        self.assertIsNone(RenewalScheduler.get_next_renewal())
+
+    @testing.gen_test
+    def test_colliding_service_ids(self):
+        first, second = FakeCertificate('foo-bar', time.time() + 40), FakeCertificate('foo-bar', time.time() + 50)
+        RenewalScheduler.schedule(first)
+        RenewalScheduler.schedule(second)
+        later = FakeCertificate('later', time.time() + 1000)
+        RenewalScheduler.schedule(later)
+
+        yield gen.sleep(0.1)
+        self.assertEqual((first.renewals, second.renewals), (1, 1))
+        self.assertEqual(RenewalScheduler.entries.keys(), ['later'])
+        self.assertIsNotNone(RenewalScheduler.timeout, 'timer is set for remaining renewals')
@@ -1,8 +1,19 @@
+import gc
+import os
+import weakref
+
 from mock import mock
+from tornado import concurrent, ioloop
 
 from base_test import BaseTest
+from stub_upstream_backend import StubUpstreamBackend
+import vergilius
 from vergilius import consul
 from vergilius.components import port_allocator
+from vergilius.components.config_shards import ConfigShards
+from vergilius.components.consul_watch import ConsulWatch
+from vergilius.components.host_routing import HostRouting
+from vergilius.loop.nginx_reloader import NginxReloader
 from vergilius.models.service import Service
 
 
@@ -12,6 +23,7 @@ class Test(BaseTest):
 
     def test_base(self):
         service = Service(name='test service')
+        service.binds['http'] = {'example.com'}
         service.flush_nginx_config()
 
         config_file = service.get_nginx_config_path('upstream')
@@ -81,7 +93,346 @@ class Test(BaseTest):
         self.assertIsNotNone(consul_port_data)
         self.assertEqual('7000', consul_port_data[1][u'Value'])
 
+        port_allocator.rebuild()
+        self.assertTrue(7000 in port_allocator.allocator, 'allocations are restored from consul')
+        self.assertEqual(port_allocator.claim('test service'), 7000, 'existing port is reused')
+        self.assertEqual(port_allocator.claim('other service'), 7001)
+
         service.delete()
-        self.assertFalse(7000 in port_allocator.allocated)
+        port_allocator.unclaim('other service', 7001)
+        self.assertFalse(7000 in port_allocator.allocator)
         consul_port_data = consul.kv.get('vergilius/ports/test service')
         self.assertIsNotNone(consul_port_data)
+
+    @mock.patch.object(Service, 'watch')
+    def test_port_release(self, _):
+        def node(tags):
+            return {
+                u'Node': {u'Node': 'test_node', u'Address': '127.0.0.1'},
+                u'Service': {u'Port': 10000, u'Address': '', u'Tags': tags},
+            }
+
+        port_allocator.claim('test service')
+        port_allocator.rebuild()
+        service = Service(name='test service')
+        service.parse_data([node([u'http', u'http:example.com'])])
+        self.assertIsNone(port_allocator.get_port('test service'), 'claim of http service is released')
+        self.assertIsNone(consul.kv.get('vergilius/ports/test service')[1])
+
+        service.parse_data([node([u'tcp'])])
+        self.assertTrue(service.port)
+        service.parse_data([node([u'http', u'http:example.com'])])
+        self.assertIsNone(service.port, 'claim is released when tcp tag is dropped')
+        self.assertIsNone(port_allocator.get_port('test service'))
+        service.delete()
+
+    @mock.patch.object(Service, 'watch')
+    def test_pinned_port_range(self, _):
+        service = Service(name='test service')
+        service.parse_data([{
+            u'Node': {u'Node': 'test_node', u'Address': '127.0.0.1'},
+            u'Service': {u'Port': 10000, u'Address': '', u'Tags': [u'tcp', u'port:443']},
+        }])
+        self.assertIsNone(service.pinned_port, 'port out of PROXY_PORTS is not pinned')
+        self.assertNotEqual(service.port, 443)
+
+        # pinned by older version
+        consul.kv.put('vergilius/ports/other service', '443')
+        self.assertEqual(port_allocator.claim('other service'), 7001, 'service is moved into range')
+        port_allocator.unclaim('other service', 7001)
+        service.delete()
+
+    @mock.patch.object(Service, 'watch')
+    def test_render_cache(self, _):
+        service = Service(name='test service')
+        service.binds['http'] = {'example.com'}
+        service.nodes['test_node'] = {'address': '127.0.0.1', 'port': '10000'}
+        self.assertTrue(service.flush_nginx_config(), 'new config written')
+
+        with mock.patch.object(Service, 'get_nginx_config') as render, \
+                mock.patch.object(Service, 'validate') as validate, \
+                mock.patch.object(Service, 'read_nginx_config_file') as read:
+            self.assertFalse(service.flush_nginx_config(), 'same state is not flushed')
+            self.assertFalse(render.called, 'configs are not rendered')
+            self.assertFalse(validate.called, 'configs are not validated')
+            self.assertFalse(read.called, 'configs are not read from disk')
+
+        service.nodes['test_node']['port'] = '10001'
+        self.assertTrue(service.flush_nginx_config(), 'changed state is flushed')
+        self.assertNotEqual(service.read_nginx_config_file('upstream').find('server 127.0.0.1:10001;'), -1)
+
+    @mock.patch.object(Service, 'watch')
+    def test_upstream_backend(self, _):
+        backend = StubUpstreamBackend()
+        service = Service(name='test service')
+        service.binds['http'] = {'example.com'}
+        service.nodes['test_node'] = {'address': '127.0.0.1', 'port': '10000'}
+
+        with mock.patch('vergilius.models.service.upstream_backend', backend), \
+                mock.patch.object(NginxReloader, 'queue_reload') as queue_reload:
+            service.flush_nginx_config()
+            self.assertTrue(queue_reload.called, 'new service is reloaded')
+            queue_reload.reset_mock()
+
+            service.nodes['test_node_2'] = {'address': '127.0.0.1', 'port': '10001'}
+            service.flush_nginx_config()
+            self.assertFalse(queue_reload.called, 'membership change is applied without reload')
+            self.assertEqual(backend.upstreams[('test-service', False)], {'127.0.0.1:10000', '127.0.0.1:10001'})
+            self.assertNotEqual(service.read_nginx_config_file('upstream').find('server 127.0.0.1:10001;'), -1,
+                                'upstream config is kept in sync')
+
+            service.binds['http'] = {'example.org'}
+            service.flush_nginx_config()
+            self.assertTrue(queue_reload.called, 'routing change is reloaded')
+            self.assertEqual(backend.updates, 1)
+
+    @mock.patch.object(Service, 'watch')
+    def test_upstream_update_race(self, _):
+        backend = StubUpstreamBackend()
+        service = Service(name='test service')
+        service.binds['http'] = {'example.com'}
+        service.nodes['test_node'] = {'address': '127.0.0.1', 'port': '10000'}
+
+        with mock.patch('vergilius.models.service.upstream_backend', backend), \
+                mock.patch.object(NginxReloader, 'queue_reload'):
+            service.flush_nginx_config()
+
+            pending = concurrent.Future()
+            with mock.patch.object(backend, 'update_upstream', return_value=pending):
+                service.nodes['test_node_2'] = {'address': '127.0.0.1', 'port': '10001'}
+                update = service.update_upstream()
+
+                # routing change is flushed with full reload while servers are pushed
+                service.binds['http'] = {'example.org'}
+                service.flush_nginx_config()
+                deployed_fingerprint = service.deployed_fingerprint
+
+                pending.set_result(None)
+                ioloop.IOLoop.current().run_sync(lambda: update)
+
+            self.assertEqual(service.deployed_fingerprint, deployed_fingerprint, 'late write is dropped')
+            self.assertNotEqual(service.read_nginx_config_file('http').find('example.org'), -1)
+        service.delete()
+
+    @mock.patch.object(Service, 'watch')
+    def test_keepalive(self, _):
+        service = Service(name='test service')
+        service.parse_data([{
+            u'Node': {u'Node': 'test_node', u'Address': '127.0.0.1'},
+            u'Service': {u'Port': 10000, u'Address': '', u'Tags': [u'http', u'http:example.com', u'keepalive:32',
+                                                                    u'keepalive_timeout:30s']},
+        }])
+
+        self.assertEqual(service.keepalive, 32)
+        self.assertNotEqual(service.get_nginx_config('upstream').find('keepalive 32;'), -1, 'keepalive pool sized')
+        self.assertNotEqual(service.get_nginx_config('upstream').find('keepalive_timeout 30s;'), -1)
+        self.assertEqual(service.get_nginx_config('stream_upstream').find('keepalive'), -1, 'no keepalive in stream')
+        self.assertNotEqual(service.get_nginx_config('http').find('proxy_http_version 1.1;'), -1)
+        self.assertTrue(service.validate(), 'nginx config is valid')
+
+        service.keepalive = 0
+        self.assertEqual(service.get_nginx_config('http').find('proxy_http_version'), -1, 'keepalive disabled')
+
+    @mock.patch.object(Service, 'watch')
+    def test_balance(self, _):
+        service = Service(name='test service')
+        self.assertNotEqual(service.get_nginx_config('upstream').find('least_conn;'), -1, 'least_conn by default')
+        self.assertNotEqual(service.get_nginx_config('upstream').find('zone test-service '), -1, 'upstream has zone')
+
+        service.parse_data([{
+            u'Node': {u'Node': 'test_node', u'Address': '127.0.0.1', u'Meta': {u'vergilius_weight': u'2',
+                                                                            u'vergilius_max_fails': u'5'}},
+            u'Service': {u'Port': 10000, u'Address': '', u'Tags': [u'http', u'http:example.com', u'weight:5',
+                                                                    u'fail_timeout:30s', u'balance:hash:$cookie_id']},
+        }])
+
+        upstream = service.get_nginx_config('upstream')
+        self.assertNotEqual(upstream.find('hash $cookie_id consistent;'), -1, 'hash by custom key')
+        self.assertNotEqual(upstream.find('server 127.0.0.1:10000 weight=5 max_fails=5 fail_timeout=30s;'), -1,
+                            'server params from tags and node meta')
+        self.assertNotEqual(service.get_nginx_config('stream_upstream').find('hash $remote_addr consistent;'), -1,
+                            'stream is hashed by address')
+        self.assertTrue(service.validate(), 'nginx config is valid')
+
+        self.assertEqual(Service.parse_balance('random'), ('random', None))
+        self.assertEqual(Service.parse_balance('hash'), ('hash', '$remote_addr'))
+        self.assertEqual(Service.parse_balance('hash:$a; b'), (None, None))
+        self.assertEqual(Service.parse_balance('ip_hash'), (None, None))
+
+    @mock.patch.object(Service, 'watch')
+    def test_config_types(self, _):
+        service = Service(name='test service')
+        service.binds['http'] = {'example.com'}
+        service.flush_nginx_config()
+
+        self.assertEqual(sorted(service.get_config_types()), ['http', 'upstream'], 'http only service')
+        self.assertIsNone(service.port, 'no port for http only service')
+        with self.assertRaises(IOError):
+            service.read_nginx_config_file('stream_upstream')
+
+        service.binds['http'] = set()
+        service.binds['tcp'] = {'10000'}
+        service.nodes['test_node'] = {'address': '127.0.0.1', 'port': '10000'}
+        service.flush_nginx_config()
+
+        self.assertEqual(sorted(service.get_config_types()), ['stream_upstream', 'tcp'], 'tcp only service')
+        self.assertNotEqual(service.read_nginx_config_file('stream_upstream').find('server 127.0.0.1:10000;'), -1)
+        with self.assertRaises(IOError):
+            service.read_nginx_config_file('upstream')
+        service.delete()
+
+    @mock.patch.object(Service, 'watch')
+    def test_sharded_output(self, _):
+        shards = ConfigShards(vergilius.config.NGINX_CONFIG_PATH, 4)
+        with mock.patch('vergilius.models.service.config_shards', shards):
+            service = Service(name='test service')
+            service.binds['http'] = {'example.com'}
+            service.nodes['test_node'] = {'address': '127.0.0.1', 'port': '10000'}
+            self.assertTrue(service.flush_nginx_config(), 'new config written')
+
+            with open(shards.get_path(shards.get_shard(service.id), 'upstream')) as shard_file:
+                self.assertNotEqual(shard_file.read().find('server 127.0.0.1:10000;'), -1, 'upstream in shard')
+            with self.assertRaises(IOError):
+                service.read_nginx_config_file('upstream')
+
+            service.delete()
+            self.assertFalse(os.path.exists(shards.get_path(shards.get_shard(service.id), 'upstream')))
+
+    @mock.patch.object(Service, 'watch')
+    def test_map_routing(self, _):
+        routing = HostRouting(vergilius.config.NGINX_CONFIG_PATH, 'map')
+        with mock.patch('vergilius.models.service.host_routing', routing), \
+                mock.patch.object(vergilius.config, 'HOST_ROUTING', 'map'):
+            service = Service(name='test service')
+            service.binds['http'] = {'example.com'}
+            service.nodes['test_node'] = {'address': '127.0.0.1', 'port': '10000'}
+            self.assertTrue(service.flush_nginx_config(), 'new config written')
+
+            self.assertEqual(service.get_config_types(), ['upstream'], 'no server block per service')
+            routing.flush()
+            with open(routing.get_path()) as routing_file:
+                self.assertNotEqual(routing_file.read().find('.example.com %s;' % service.id), -1, 'host routed')
+
+            service.allow_crossdomain = True
+            self.assertEqual(sorted(service.get_config_types()), ['http', 'upstream'], 'crossdomain has own server')
+            self.assertNotEqual(service.get_nginx_config('http').find('proxy_hide_header'), -1, 'backend acao hidden')
+            self.assertEqual(service.get_routing()[0], frozenset(), 'crossdomain host is left out of map')
+
+            service.allow_crossdomain = False
+            service.keepalive = 0
+            self.assertEqual(sorted(service.get_config_types()), ['http', 'upstream'], 'keepalive off has own server')
+            self.assertEqual(service.get_nginx_config('http').find('proxy_http_version'), -1)
+
+            service.delete()
+            routing.flush()
+            with open(routing.get_path()) as routing_file:
+                self.assertEqual(routing_file.read().find('example.com'), -1, 'route removed')
+
+    @mock.patch.object(Service, 'watch')
+    def test_cache(self, _):
+        service = Service(name='test service')
+        service.parse_data([{
+            u'Node': {u'Node': 'test_node', u'Address': '127.0.0.1'},
+            u'Service': {u'Port': 10000, u'Address': '', u'Tags': [u'http', u'http:example.com', u'cache:100m:10s']},
+        }])
+
+        self.assertEqual(service.cache, ('100m', '10s'))
+        upstream_config = service.get_nginx_config('upstream')
+        self.assertNotEqual(upstream_config.find('keys_zone=%s_cache:' % service.id), -1, 'cache zone per service')
+        self.assertNotEqual(upstream_config.find('max_size=100m'), -1)
+        self.assertEqual(service.get_nginx_config('stream_upstream').find('proxy_cache_path'), -1)
+        self.assertNotEqual(service.get_nginx_config('http').find('proxy_cache_valid 200 301 302 10s;'), -1)
+        self.assertNotEqual(service.get_nginx_config('http').find('proxy_cache_bypass $http_x_cache_bypass;'), -1)
+        self.assertTrue(service.validate(), 'nginx config is valid')
+
+        os.makedirs(service.get_cache_path())
+        service.delete()
+        self.assertFalse(os.path.exists(service.get_cache_path()), 'cache removed with service')
+
+        self.assertIsNone(Service.parse_cache('100m'), 'ttl is required')
+        self.assertIsNone(Service.parse_cache('100m:10s; x'))
+
+    @mock.patch.object(Service, 'watch')
+    def test_warning_nodes(self, _):
+        def node(name, port, status, tags=()):
+            return {
+                u'Node': {u'Node': name, u'Address': '127.0.0.1'},
+                u'Service': {u'Port': port, u'Address': '', u'Tags': [u'http', u'http:example.com'] + list(tags)},
+                u'Checks': [{u'Node': name, u'CheckID': u'serfHealth', u'ServiceID': u'', u'Status': u'passing'},
+                            {u'Node': name, u'CheckID': u'service:test', u'ServiceID': u'test', u'Status': status,
+                             u'Definition': {u'Interval': u'15s'}, u'FailuresBeforeCritical': 3}],
+            }
+
+        service = Service(name='test service')
+        service.parse_data([node('n1', 10001, 'passing'), node('n2', 10002, 'warning'),
+                            node('n3', 10003, 'critical')])
+
+        upstream = service.get_nginx_config('upstream')
+        self.assertNotEqual(upstream.find('server 127.0.0.1:10001 max_fails=3 fail_timeout=15s;'), -1,
+                            'passive health params from check definition')
+        self.assertNotEqual(upstream.find('server 127.0.0.1:10002 max_fails=3 fail_timeout=15s backup;'), -1,
+                            'warning node is backup')
+        self.assertEqual(upstream.find('10003'), -1, 'critical node is skipped')
+        self.assertTrue(service.validate(), 'nginx config is valid')
+
+        service.parse_data([node('n1', 10001, 'passing', [u'balance:hash', u'fail_timeout:5s']),
+                            node('n2', 10002, 'warning')])
+        upstream = service.get_nginx_config('upstream')
+        self.assertNotEqual(upstream.find('server 127.0.0.1:10001 weight=10 max_fails=3 fail_timeout=5s;'), -1,
+                            'tags take precedence, passing node outweighs warning one if backup is not allowed')
+        self.assertNotEqual(upstream.find('server 127.0.0.1:10002 max_fails=3 fail_timeout=15s;'), -1)
+
+        service.parse_data([node('n2', 10002, 'warning')])
+        self.assertEqual(service.get_nginx_config('upstream').find('backup'), -1, 'warning nodes used if no passing')
+
+        with mock.patch.object(vergilius.config, 'WARNING_NODES', 'exclude'):
+            service.parse_data([node('n1', 10001, 'passing'), node('n2', 10002, 'warning')])
+            self.assertEqual(service.get_nginx_config('upstream').find('10002'), -1, 'warning node excluded')
+            self.assertTrue(service.get_passing_filter())
+
+    @mock.patch.object(Service, 'watch')
+    def test_check_params_fingerprint(self, _):
+        def node(name, port, status=u'passing', interval=u'15s'):
+            return {
+                u'Node': {u'Node': name, u'Address': '127.0.0.1'},
+                u'Service': {u'Port': port, u'Address': '', u'Tags': [u'http', u'http:example.com']},
+                u'Checks': [{u'Node': name, u'CheckID': u'service:test', u'ServiceID': u'test', u'Status': status,
+                             u'Definition': {u'Interval': interval}, u'FailuresBeforeCritical': 3}],
+            }
+
+        service = Service(name='test service')
+        service.parse_data([node('n1', 10001)])
+        routing = service.get_fingerprint()[0]
+
+        service.parse_data([node('n1', 10001), node('n2', 10002)])
+        self.assertEqual(service.get_fingerprint()[0], routing, 'added container does not change routing')
+        self.assertNotEqual(service.get_nginx_config('upstream').find('127.0.0.1:10002 max_fails=3 fail_timeout=15s;'),
+                            -1, 'check params are still rendered')
+
+        service.parse_data([node('n1', 10001, interval=u'5s'), node('n2', 10002, interval=u'5s')])
+        self.assertNotEqual(service.get_fingerprint()[0], routing, 'check change is reloaded')
+
+        routing = service.get_fingerprint()[0]
+        service.parse_data([node('n1', 10001, interval=u'5s'), node('n2', 10002, u'warning', u'5s')])
+        self.assertNotEqual(service.get_fingerprint()[0], routing, 'warning node demotion is reloaded')
+
+    @mock.patch.object(ConsulWatch, 'run')
+    def test_shutdown(self, _):
+        service = Service(name='test service')
+        service.binds['http'] = {'example.com'}
+        service.nodes['test_node'] = {'address': '127.0.0.1', 'port': '10000'}
+        service.flush_nginx_config()
+        config_file = service.get_nginx_config_path('upstream')
+        watcher = service.watcher
+
+        self.assertTrue(service.shutdown().done(), 'nothing in flight to wait for')
+        self.assertTrue(watcher.stopped, 'watch stopped')
+        self.assertFalse(os.path.exists(config_file))
+        self.assertFalse(service.flush_nginx_config(), 'deleted service does not write configs')
+        self.assertFalse(os.path.exists(config_file))
+
+        reference = weakref.ref(service)
+        del service, watcher
+        gc.collect()
+        self.assertIsNone(reference(), 'service is collected')
+        self.assertEqual(gc.garbage, [])
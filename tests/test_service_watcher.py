@@ -1,7 +1,10 @@
 import time
 
+from mock import mock
+
 from base_test import BaseTest
 from vergilius import consul
+from vergilius.loop.service_watcher import ServiceWatcher
 
 
 class Test(BaseTest):
@@ -19,5 +22,22 @@ class Test(BaseTest):
         time.sleep(2)
         self.assertFalse('test' in self.watcher.services, 'service not registered')
 
+    def test_prune_restored(self):
+        watcher = ServiceWatcher()
+        shards = mock.Mock(**{'prune.return_value': True})
+        routing = mock.Mock(**{'prune.return_value': False})
+        with mock.patch('vergilius.loop.service_watcher.Service') as service, \
+                mock.patch('vergilius.config_shards', shards), mock.patch('vergilius.host_routing', routing), \
+                mock.patch('vergilius.loop.service_watcher.NginxReloader') as reloader:
+            service.side_effect = lambda name, watch: mock.Mock(id=name)
+            watcher.check_services({'live': ['http'], 'untagged': []})
+            shards.prune.assert_called_once_with({'live'})
+            routing.prune.assert_called_once_with({'live'})
+            self.assertTrue(reloader.queue_reload.called, 'pruned configs are reloaded')
+
+            watcher.check_services({'live': ['http']})
+            self.assertEqual(shards.prune.call_count, 1, 'only configs restored on start are pruned')
+            self.assertEqual(routing.prune.call_count, 1)
+
     def tearDown(self):
         consul.agent.service.deregister('test')
@@ -0,0 +1,93 @@
+import base64
+import json
+import os
+import shutil
+import tempfile
+
+from mock import mock
+from tornado import gen, testing
+
+import vergilius
+from vergilius.loop.nginx_reloader import NginxReloader
+from vergilius.loop.ticket_key_watcher import TicketKeyWatcher, TICKETS_FILE
+
+
+class FakeKV(object):
+    def __init__(self):
+        self.data = None
+
+    @gen.coroutine
+    def get(self, key, consistency=None):
+        raise gen.Return((1, self.data))
+
+    @gen.coroutine
+    def put(self, key, value, cas=None):
+        if cas != (self.data['ModifyIndex'] if self.data else 0):
+            raise gen.Return(False)
+        self.data = {'Key': key, 'Value': value, 'ModifyIndex': cas + 1}
+        raise gen.Return(True)
+
+
+class FakeConsul(object):
+    def __init__(self):
+        self.kv = FakeKV()
+
+
+class Test(testing.AsyncTestCase):
+    def setUp(self):
+        super(Test, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.consul = FakeConsul()
+        self.patches = [mock.patch.object(vergilius.config, 'NGINX_CONFIG_PATH', self.path),
+                        mock.patch.object(vergilius, 'consul_tornado_requests', self.consul),
+                        mock.patch.object(NginxReloader, 'queue_reload')]
+        for patch in self.patches:
+            patch.start()
+        TicketKeyWatcher.keys = None
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        if TicketKeyWatcher.timeout:
+            self.io_loop.remove_timeout(TicketKeyWatcher.timeout)
+            TicketKeyWatcher.timeout = None
+        shutil.rmtree(self.path, ignore_errors=True)
+        super(Test, self).tearDown()
+
+    def read_config(self):
+        with open(os.path.join(self.path, TICKETS_FILE)) as config_file:
+            return [line.split()[1].rstrip(';') for line in config_file if line.startswith('ssl_session_ticket_key')]
+
+    @testing.gen_test
+    def test_rotate(self):
+        self.assertTrue((yield TicketKeyWatcher.rotate()), 'keys are created')
+        self.assertTrue((yield TicketKeyWatcher.rotate()))
+        keys = json.loads(self.consul.kv.data['Value'])['keys']
+        self.assertEqual(len(keys), 2, 'new key is added in front')
+        self.assertEqual(len(base64.b64decode(keys[0])), 80)
+
+        for _ in range(5):
+            yield TicketKeyWatcher.rotate()
+        self.assertEqual(len(json.loads(self.consul.kv.data['Value'])['keys']), vergilius.config.TLS_TICKET_KEYS)
+
+        stale = dict(self.consul.kv.data, ModifyIndex=self.consul.kv.data['ModifyIndex'] + 1)
+        with mock.patch.object(self.consul.kv, 'get', side_effect=lambda key, **kwargs: gen.maybe_future((1, stale))):
+            self.assertFalse((yield TicketKeyWatcher.rotate()), 'concurrent rotation is not overwritten')
+
+    def test_write_keys(self):
+        keys = [TicketKeyWatcher.generate_key() for _ in range(3)]
+        TicketKeyWatcher.check_keys({'Value': json.dumps({'keys': keys[1:], 'rotated': 0}), 'ModifyIndex': 1})
+        self.assertEqual(len(self.read_config()), 2)
+        with open(self.read_config()[0], 'rb') as key_file:
+            self.assertEqual(key_file.read(), base64.b64decode(keys[2]), 'current key encrypts, staged decrypts')
+        self.assertEqual(NginxReloader.queue_reload.call_count, 1)
+
+        TicketKeyWatcher.check_keys({'Value': json.dumps({'keys': keys[1:], 'rotated': 0}), 'ModifyIndex': 1})
+        self.assertEqual(NginxReloader.queue_reload.call_count, 1, 'same keys do not reload')
+
+        old_paths = self.read_config()
+        TicketKeyWatcher.check_keys({'Value': json.dumps({'keys': keys[:2], 'rotated': 0}), 'ModifyIndex': 2})
+        self.assertEqual(self.read_config()[0], old_paths[1], 'staged key becomes current')
+        self.assertFalse(os.path.exists(old_paths[0]), 'dropped key removed')
+        self.assertEqual(sorted(os.listdir(TicketKeyWatcher.get_path())),
+                         sorted(os.path.basename(key_path) for key_path in self.read_config()))